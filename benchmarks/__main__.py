@@ -0,0 +1,136 @@
+"""
+Run the benchmarks, print the results as JSON and compare them with the stored baseline.
+
+Run from the repository root:
+
+>> python -m benchmarks                              # hot paths, compared with benchmarks/baseline.json
+>> python -m benchmarks --suite all --runs 1 --output out.json
+>> python -m benchmarks --save-baseline              # after an intended change of performance
+
+The exit status is 1 if the throughput of a case dropped by more than `--tolerance` compared to the baseline. The
+baseline is only meaningful on the machine it was recorded on, so record it again when the machine changes.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import sys
+
+from benchmarks import (
+    bench_control_loop,
+    bench_hot_paths,
+    bench_patterns,
+    bench_routing,
+    bench_startup,
+)
+from benchmarks.harness import compare
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+SUITES = {
+    "hot_paths": bench_hot_paths.main,
+    "patterns": bench_patterns.main,
+    "startup": bench_startup.main,
+    "control_loop": bench_control_loop.main,
+    "routing": bench_routing.main,
+}
+
+
+def _median_run(runs: list):
+    """Per case, the run with the median throughput."""
+    if not all(isinstance(r, dict) and "ops_per_sec" in r for r in runs[0].values()):
+        return runs[-1]
+    return {
+        case: sorted((run[case] for run in runs), key=lambda r: r["ops_per_sec"])[
+            len(runs) // 2
+        ]
+        for case in runs[0]
+    }
+
+
+def run(suites: list, runs: int = 1) -> dict:
+    results = {}
+    # The code under test prints progress messages, keep stdout for the JSON results.
+    with contextlib.redirect_stdout(sys.stderr):
+        for suite in suites:
+            results[suite] = _median_run([SUITES[suite]() for _ in range(runs)])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OSC Toys benchmarks")
+    parser.add_argument(
+        "--suite",
+        choices=list(SUITES) + ["all"],
+        default="hot_paths",
+        help="benchmarks to run (default: hot_paths)",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=3,
+        help="run the suites several times and keep the median of each case (default: 3)",
+    )
+    parser.add_argument("--output", help="write the results to this file too")
+    parser.add_argument(
+        "--baseline", default=BASELINE_PATH, help="results to compare with"
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the new baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.3,
+        help="accepted drop of throughput before failing (default: 0.3, i.e. 30 %%)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    suites = list(SUITES) if args.suite == "all" else [args.suite]
+    report = {
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+        },
+        "results": run(suites, args.runs),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.baseline}", file=sys.stderr)
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}", file=sys.stderr)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for suite, results in report["results"].items():
+        # Only the suites made of cases measured by benchmarks.harness can be compared.
+        if suite in baseline and all(
+            isinstance(r, dict) and "ops_per_sec" in r for r in results.values()
+        ):
+            regressions += compare(results, baseline[suite], args.tolerance)
+    for case, reference, current in regressions:
+        print(
+            f"Regression: {case} {current:.0f} ops/s, baseline {reference:.0f} ops/s",
+            file=sys.stderr,
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
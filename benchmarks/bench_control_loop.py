@@ -0,0 +1,128 @@
+"""
+Jitter of the pattern-state writes of a mock Coyote, with the control pipeline on the web server's loop ("shared") or on
+its own thread ("thread", see common/control_loop.py), while the web server is idle or under a heavy request load.
+
+The load is generated in process: LOAD_CLIENTS clients request the stats, devices and metrics routes in a loop through
+httpx's ASGI transport, so the route handlers run on the web server's loop like they do under uvicorn.
+
+Run from the repository root:
+
+>> python -m benchmarks.bench_control_loop
+"""
+
+import asyncio
+import importlib.util
+import json
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+
+from common import metrics
+from common.control_loop import control_loop
+from routers import coyote, devices
+from settings import settings
+from toys.estim.coyote import dg_mock
+from toys.estim.coyote.dg_interface import CoyoteInterface
+
+DURATION = 5.0
+LOAD_CLIENTS = 8
+LOAD_PATHS = ("/api/coyote/stats", "/api/devices", "/metrics")
+# Shorter than the default tick, to collect more states in DURATION.
+TICK = 0.02
+
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+    app.include_router(coyote.router)
+    app.include_router(devices.router)
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def get_metrics():
+        return PlainTextResponse(metrics.registry.render())
+
+    return app
+
+
+async def http_load(app: FastAPI, stop: asyncio.Event) -> int:
+    """
+    Request the routes until stopped.
+
+    :return: Number of requests served.
+    """
+    served = 0
+
+    async def client_loop(client: httpx.AsyncClient):
+        nonlocal served
+        while not stop.is_set():
+            for path in LOAD_PATHS:
+                await client.get(path)
+                served += 1
+                # In-process requests never wait for a socket, yield like a real client would.
+                await asyncio.sleep(0)
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        await asyncio.gather(*(client_loop(client) for _ in range(LOAD_CLIENTS)))
+    return served
+
+
+async def play(thread: bool, load: bool, use_uvloop: bool = False) -> dict:
+    if thread:
+        control_loop.start(use_uvloop)
+    try:
+        ci = CoyoteInterface(
+            device_uid=dg_mock.MOCK_ADDRESS, power_multiplier=1.28, safe_mode=True
+        )
+        coyote.set_interface(ci)
+        await control_loop.run(ci.connect())
+        playback = control_loop.spawn(
+            ci.play(
+                100,
+                100,
+                {"a": settings.coyote_pattern_a, "b": settings.coyote_pattern_b},
+                duration=100000000,
+            )
+        )
+        stop = asyncio.Event()
+        loader = asyncio.ensure_future(http_load(build_app(), stop)) if load else None
+        await asyncio.sleep(DURATION)
+        stop.set()
+        served = await loader if loader is not None else 0
+        jitter = ci.player.jitter["a"].stats()
+        await control_loop.run(coyote.disconnect_coyote())
+        playback.cancel()
+    finally:
+        control_loop.stop()
+    return {"requests": served, **jitter}
+
+
+def main() -> dict:
+    dg_mock.enabled = True
+    saved = (
+        settings.coyote_pattern_tick,
+        settings.coyote_mock_latency,
+        settings.coyote_mock_jitter,
+    )
+    settings.coyote_pattern_tick = TICK
+    settings.coyote_mock_latency = 0.001
+    settings.coyote_mock_jitter = 0.0
+    cases = {
+        "shared_idle": (False, False),
+        "shared_http_load": (False, True),
+        "thread_idle": (True, False),
+        "thread_http_load": (True, True),
+    }
+    if importlib.util.find_spec("uvloop") is not None:
+        cases["uvloop_thread_http_load"] = (True, True, True)
+    try:
+        return {case: asyncio.run(play(*args)) for case, args in cases.items()}
+    finally:
+        (
+            settings.coyote_pattern_tick,
+            settings.coyote_mock_latency,
+            settings.coyote_mock_jitter,
+        ) = saved
+
+
+if __name__ == "__main__":
+    print(json.dumps(main(), indent=2))
@@ -0,0 +1,171 @@
+"""
+Micro-benchmarks of the control hot paths: encoding, input filters and curves, OSC dispatch, pattern loading and a
+full signal() cycle against the mock coyote.
+
+Run from the repository root:
+
+>> python -m benchmarks.bench_hot_paths
+"""
+
+import json
+
+from pythonosc.osc_bundle_builder import IMMEDIATELY, OscBundleBuilder
+from pythonosc.osc_message_builder import OscMessageBuilder
+
+from benchmarks.harness import bench, bench_async
+from common.curves import build_curve
+from common.filters import FILTER_KINDS, build_filter
+from settings import settings
+import toys.estim.coyote.dg_encoding as dg_encoding
+from toys.estim.coyote import dg_mock
+
+# Calls of the slower cases (pattern loading, signal()).
+SLOW_NUMBER = 2000
+
+# Avatar parameters sent by VRChat which are not routed to a device.
+UNROUTED = (
+    "/avatar/parameters/VelocityX",
+    "/avatar/parameters/VelocityY",
+    "/avatar/parameters/VelocityZ",
+    "/avatar/parameters/Grounded",
+    "/avatar/parameters/AngularY",
+    "/avatar/parameters/Upright",
+    "/avatar/parameters/GestureLeftWeight",
+)
+
+
+def bench_encoding() -> dict:
+    states = [[i % 32, (i * 7) % 1024, (i * 3) % 32] for i in range(64)]
+    return {
+        "encode_power": bench(lambda: dg_encoding.encode_power(300, 512)),
+        "encode_pattern": bench(lambda: dg_encoding.encode_pattern(10, 90, 20)),
+        "encode_pattern_lut": bench(lambda: dg_encoding.encode_pattern_lut(10, 90, 20)),
+        "encode_pattern_batch_64": bench(
+            lambda: dg_encoding.encode_pattern_batch(states)
+        ),
+    }
+
+
+def bench_filters() -> dict:
+    curve = build_curve(
+        "linear",
+        settings.start_limit,
+        settings.min_limit,
+        settings.max_limit,
+        settings.min_power,
+    )
+    results = {}
+    for kind in FILTER_KINDS:
+        input_filter = build_filter(kind, settings.window_size)
+        now = [0.0]
+
+        # One OSC sample at 200 Hz: push it, then map the filtered value through the curve, as get_avg() does.
+        def step(input_filter=input_filter):
+            now[0] += 0.005
+            input_filter.push(0.5, now[0])
+            return curve(input_filter.value(now[0]))
+
+        results[f"filter_{kind}"] = bench(step)
+    return results
+
+
+def _message(address: str, value):
+    builder = OscMessageBuilder(address=address)
+    builder.add_arg(value)
+    return builder.build()
+
+
+def bench_dispatch() -> dict:
+    """
+    The python-osc dispatcher against the fast path protocol, for a routed message, for one of the avatar parameters
+    which are not routed, and for a bundle mixing both.
+    """
+    from routers import coyote
+
+    coyote.get_interface()
+    dispatcher = coyote.build_dispatcher(record=False)
+    protocol = coyote.TimedOSCProtocol(
+        coyote.osc_handler, dispatcher.call_handlers_for_packet
+    )
+    protocol.subscribe(
+        [addr for addr, route in coyote.config.routes.items() if route is not None],
+        coyote.config.routes.is_routed,
+    )
+    datagram = _message(settings.coyote_addr_a, 0.5).dgram
+    unrouted = _message(UNROUTED[0], 0.5).dgram
+    builder = OscBundleBuilder(IMMEDIATELY)
+    builder.add_content(_message(settings.coyote_addr_a, 0.5))
+    for address in UNROUTED:
+        builder.add_content(_message(address, 0.5))
+    bundle = builder.build().dgram
+    client = ("127.0.0.1", settings.vrc_osc_port)
+    return {
+        "osc_dispatch": bench(
+            lambda: dispatcher.call_handlers_for_packet(datagram, client)
+        ),
+        "osc_fast_dispatch": bench(
+            lambda: protocol.datagram_received(datagram, client)
+        ),
+        "osc_dispatch_unrouted": bench(
+            lambda: dispatcher.call_handlers_for_packet(unrouted, client)
+        ),
+        "osc_fast_dispatch_unrouted": bench(
+            lambda: protocol.datagram_received(unrouted, client)
+        ),
+        "osc_dispatch_bundle": bench(
+            lambda: dispatcher.call_handlers_for_packet(bundle, client)
+        ),
+        "osc_fast_dispatch_bundle": bench(
+            lambda: protocol.datagram_received(bundle, client)
+        ),
+    }
+
+
+def bench_patterns() -> dict:
+    from toys.estim.estim import Estim
+
+    return {
+        "load_patterns": bench(
+            lambda: Estim.load_patterns(None), number=SLOW_NUMBER, alloc_number=50
+        )
+    }
+
+
+def bench_signal() -> dict:
+    from toys.estim.coyote.dg_interface import CoyoteInterface
+
+    ci = CoyoteInterface(device_uid=dg_mock.MOCK_ADDRESS)
+    # No simulated latency, only the cost of the pipeline is measured.
+    ci.device = dg_mock.MockCoyoteClient(dg_mock.MOCK_ADDRESS)
+    power = [100]
+
+    # The shortest signal: write the power, play the first state of the pattern and stop. The power changes on
+    # every call, so that it is actually written.
+    async def signal():
+        power[0] = 200 if power[0] == 100 else 100
+        await ci.signal(power[0], "vibrator_4", 1)
+
+    return {
+        "signal_cycle": bench_async(
+            signal,
+            number=SLOW_NUMBER,
+            alloc_number=50,
+            setup=ci.connect,
+            teardown=ci.disconnect,
+        ),
+    }
+
+
+def main() -> dict:
+    dg_mock.enabled = True
+    return {
+        **bench_encoding(),
+        **bench_filters(),
+        **bench_dispatch(),
+        **bench_patterns(),
+        **bench_signal(),
+    }
+
+
+if __name__ == "__main__":
+    print(json.dumps(main(), indent=2))
@@ -0,0 +1,48 @@
+"""
+Startup time and memory of loading the e-stim patterns, JSON sources vs. the binary pattern pack.
+
+Every CoyoteInterface loads the patterns, so the benchmark loads them once per simulated instance.
+
+Run from the repository root:
+
+>> python -m benchmarks.bench_patterns
+"""
+
+import json
+import time
+import tracemalloc
+
+import toys.estim.pattern_pack as pattern_pack
+
+# The CoyoteInterface created on first use of the coyote routes (see get_interface()), and the one of /api/coyote/start.
+INSTANCES = 2
+
+
+def measure(load, instances: int = INSTANCES) -> dict:
+    tracemalloc.start()
+    start = time.perf_counter()
+    loaded = [load() for _ in range(instances)]
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del loaded
+    return {
+        "seconds": elapsed,
+        "retained_bytes": retained,
+        "peak_bytes": peak,
+    }
+
+
+def main() -> dict:
+    pattern_pack.build_pack()
+    results = {
+        "json": measure(pattern_pack.load_json_patterns),
+        "pack_first": measure(pattern_pack.load_pack, instances=1),
+        # The mapping is shared now, following instances only create a dict of views.
+        "pack": measure(pattern_pack.load_pack),
+    }
+    return results
+
+
+if __name__ == "__main__":
+    print(json.dumps(main(), indent=2))
@@ -0,0 +1,103 @@
+"""
+Per-message cost of the OSC routing table (see routers/coyote.py) as the number of routes grows: an exact address, an
+address resolved through a pattern and an address which is not routed, through osc_handler. The pattern matching
+itself is compared with trying every pattern in turn, which is what python-osc does with its mapped addresses.
+
+Half of the routes are exact addresses, the other half patterns, all to the channels of the primary device.
+
+Run from the repository root:
+
+>> python -m benchmarks.bench_routing
+"""
+
+import json
+
+from benchmarks.harness import bench
+from common.osc_routing import compile_part, is_pattern
+from settings import RouteSettings, settings
+from toys.estim.coyote import dg_mock
+
+ROUTE_COUNTS = (2, 16, 128, 1024)
+UNROUTED = "/avatar/parameters/VelocityX"
+
+
+def make_routes(count: int) -> list:
+    routes = []
+    for i in range(count):
+        channel = "a" if i % 2 == 0 else "b"
+        if i % 4 < 2:
+            address = f"/avatar/parameters/Touch{i}"
+        else:
+            address = f"/avatar/parameters/Zone{i}/{{Ear,Tail}}*"
+        routes.append(RouteSettings(address=address, channel=channel, weight=0.5))
+    return routes
+
+
+def compile_linear(patterns: list) -> list:
+    """Full-address regular expressions of the patterns, to be tried one by one."""
+    compiled = []
+    for pattern in patterns:
+        parts = pattern.split("/")
+        compiled.append(
+            [compile_part(part) if is_pattern(part) else part for part in parts]
+        )
+    return compiled
+
+
+def match_linear(compiled: list, address: str) -> list:
+    parts = address.split("/")
+    matched = []
+    for pattern in compiled:
+        if len(pattern) != len(parts):
+            continue
+        for expected, part in zip(pattern, parts):
+            if isinstance(expected, str):
+                if expected != part:
+                    break
+            elif expected.fullmatch(part) is None:
+                break
+        else:
+            matched.append(pattern)
+    return matched
+
+
+def bench_routes(count: int) -> dict:
+    from routers import coyote
+
+    settings.osc_routes = make_routes(count)
+    coyote.configure_routes()
+    exact = settings.osc_routes[0].address
+    patterns = [
+        route.address for route in settings.osc_routes if is_pattern(route.address)
+    ]
+    resolved = patterns[-1].replace("{Ear,Tail}*", "TailTip") if patterns else exact
+    compiled = compile_linear(patterns)
+    table = coyote.config.routes
+    return {
+        f"route_exact_{count}": bench(lambda: coyote.osc_handler(exact, 0.5)),
+        f"route_pattern_{count}": bench(lambda: coyote.osc_handler(resolved, 0.5)),
+        f"route_unrouted_{count}": bench(lambda: coyote.osc_handler(UNROUTED, 0.5)),
+        f"match_trie_{count}": bench(lambda: table.patterns.match(resolved)),
+        f"match_linear_{count}": bench(lambda: match_linear(compiled, resolved)),
+        f"rebuild_{count}": bench(coyote.configure_routes, number=200, alloc_number=20),
+    }
+
+
+def main() -> dict:
+    from routers import coyote
+
+    dg_mock.enabled = True
+    coyote.get_interface()
+    saved = settings.osc_routes
+    results = {}
+    try:
+        for count in ROUTE_COUNTS:
+            results.update(bench_routes(count))
+    finally:
+        settings.osc_routes = saved
+        coyote.configure_routes()
+    return results
+
+
+if __name__ == "__main__":
+    print(json.dumps(main(), indent=2))
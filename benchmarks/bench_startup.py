@@ -0,0 +1,55 @@
+"""
+Time from process start to the first successful `GET /health` of the headless server.
+
+Run from the repository root:
+
+>> python -m benchmarks.bench_startup
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+PORT = 38081
+RUNS = 5
+TIMEOUT = 30.0
+
+
+def time_to_health(port: int = PORT) -> float:
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "main.py", "--headless", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < TIMEOUT:
+            try:
+                with urllib.request.urlopen(
+                    f"http://127.0.0.1:{port}/health", timeout=1
+                ) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError(f"/health did not answer within {TIMEOUT} s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(runs: int = RUNS) -> dict:
+    samples = [time_to_health() for _ in range(runs)]
+    return {
+        "runs": runs,
+        "median_seconds": statistics.median(samples),
+        "min_seconds": min(samples),
+        "max_seconds": max(samples),
+    }
+
+
+if __name__ == "__main__":
+    print(json.dumps(main(), indent=2))
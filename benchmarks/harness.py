@@ -0,0 +1,154 @@
+"""
+Measurement helpers shared by the benchmarks.
+
+Every case is measured twice: once timing each call to get the throughput and the latency percentiles, and once under
+tracemalloc to get the memory allocated by the calls. Tracing slows the calls down, so the two are never mixed.
+
+Like `timeit`, the timed calls are repeated a few times with the garbage collector disabled and the fastest repetition
+is kept, which is the least disturbed by the rest of the machine.
+"""
+
+import asyncio
+import gc
+import time
+import tracemalloc
+
+# Calls timed per repetition, repetitions, and calls traced to measure the allocations.
+NUMBER = 20000
+REPEAT = 5
+ALLOC_NUMBER = 1000
+
+
+def _percentile(samples: list, q: float) -> float:
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def _summary(samples: list, total: float) -> dict:
+    samples.sort()
+    return {
+        "calls": len(samples),
+        "ops_per_sec": len(samples) / total if total else 0.0,
+        "p50_us": _percentile(samples, 0.50) / 1000,
+        "p99_us": _percentile(samples, 0.99) / 1000,
+    }
+
+
+def _allocations(run, number: int) -> dict:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    run(number)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "peak_bytes": peak - before,
+        "retained_bytes_per_call": (after - before) / number,
+    }
+
+
+def _best(timed, repeat: int) -> dict:
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        runs = [timed() for _ in range(repeat)]
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return max(runs, key=lambda run: run["ops_per_sec"])
+
+
+def bench(
+    func, number: int = NUMBER, alloc_number: int = ALLOC_NUMBER, repeat: int = REPEAT
+) -> dict:
+    """
+    Measure a function without arguments.
+
+    :param func: The function to measure.
+    :param number: Number of timed calls per repetition.
+    :param alloc_number: Number of calls traced by tracemalloc.
+    :param repeat: Number of repetitions, the fastest one is reported.
+    :return: calls, ops_per_sec, p50_us, p99_us, peak_bytes, retained_bytes_per_call
+    """
+    clock = time.perf_counter_ns
+    for _ in range(min(number, 100)):  # warm up caches
+        func()
+
+    def timed() -> dict:
+        samples = [0] * number
+        start = clock()
+        for i in range(number):
+            t = clock()
+            func()
+            samples[i] = clock() - t
+        return _summary(samples, (clock() - start) / 1e9)
+
+    def run(n: int):
+        for _ in range(n):
+            func()
+
+    return {**_best(timed, repeat), **_allocations(run, alloc_number)}
+
+
+def bench_async(
+    func,
+    number: int = NUMBER,
+    alloc_number: int = ALLOC_NUMBER,
+    repeat: int = REPEAT,
+    setup=None,
+    teardown=None,
+) -> dict:
+    """
+    Measure a coroutine function without arguments, awaiting one call at a time in a new event loop.
+
+    :param func: The coroutine function to measure.
+    :param setup: Coroutine function run in the same event loop before the measurement.
+    :param teardown: Coroutine function run in the same event loop after the measurement.
+    """
+    clock = time.perf_counter_ns
+
+    async def timed() -> dict:
+        samples = [0] * number
+        start = clock()
+        for i in range(number):
+            t = clock()
+            await func()
+            samples[i] = clock() - t
+        return _summary(samples, (clock() - start) / 1e9)
+
+    async def run(n: int):
+        for _ in range(n):
+            await func()
+
+    loop = asyncio.new_event_loop()
+    try:
+        if setup is not None:
+            loop.run_until_complete(setup())
+        loop.run_until_complete(run(min(number, 10)))  # warm up caches
+        result = _best(lambda: loop.run_until_complete(timed()), repeat)
+        result.update(
+            _allocations(lambda n: loop.run_until_complete(run(n)), alloc_number)
+        )
+        if teardown is not None:
+            loop.run_until_complete(teardown())
+    finally:
+        loop.close()
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Find the cases whose throughput dropped by more than `tolerance` compared to the baseline.
+
+    :param results: Results by case, as returned by bench().
+    :param baseline: Results of a previous run.
+    :param tolerance: Accepted slowdown, e.g. 0.2 for 20 %.
+    :return: List of (case, baseline ops/s, current ops/s).
+    """
+    regressions = []
+    for case, result in results.items():
+        reference = baseline.get(case)
+        if reference is None:
+            continue
+        if result["ops_per_sec"] < reference["ops_per_sec"] * (1 - tolerance):
+            regressions.append((case, reference["ops_per_sec"], result["ops_per_sec"]))
+    return regressions
@@ -0,0 +1,138 @@
+"""
+Event loop of the control pipeline: the OSC listener, the power writers, the pattern players and the battery monitors.
+
+It can run in a dedicated thread (`settings.control_loop_thread`), so that the requests served by the web server never
+delay a pattern state or a power write. The routes then reach the devices only through `control_loop`: run() and
+call() execute on the control loop and hand the result back to the calling loop, spawn() starts a task there. When the
+thread is not started, they execute directly on the calling loop, i.e. everything shares the web server's loop.
+
+The control loop is a uvloop loop if `settings.control_loop_uvloop` is set and uvloop is installed (not available on
+Windows).
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import sys
+import threading
+
+# Longest time (seconds) a thread holding the GIL keeps the control thread waiting, Python's default is 5 ms.
+SWITCH_INTERVAL = 0.001
+
+
+def _new_loop(use_uvloop: bool) -> asyncio.AbstractEventLoop:
+    if use_uvloop:
+        try:
+            import uvloop
+
+            return uvloop.new_event_loop()
+        except ImportError:
+            logging.warning("uvloop is not available, using the default event loop")
+    return asyncio.new_event_loop()
+
+
+class ControlLoop:
+    """
+    Attributes:
+        loop (asyncio.AbstractEventLoop): The control loop, None while its thread is not running.
+        thread (threading.Thread): The thread running the control loop.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+
+    def start(self, use_uvloop: bool = False):
+        """
+        Start the control loop in its thread, and return once it runs.
+
+        :param use_uvloop: Use uvloop if it is installed.
+        """
+        if self.loop is not None:
+            return
+        loop = _new_loop(use_uvloop)
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(started.set)
+            try:
+                loop.run_forever()
+                tasks = asyncio.all_tasks(loop)
+                for task in tasks:
+                    task.cancel()
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            finally:
+                loop.close()
+
+        sys.setswitchinterval(SWITCH_INTERVAL)
+        self.thread = threading.Thread(target=run, name="control-loop", daemon=True)
+        self.thread.start()
+        started.wait()
+        self.loop = loop
+        logging.info(f"Control loop running in its own thread ({type(loop).__name__})")
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Stop the control loop and its thread, the tasks still running on it are cancelled.
+        """
+        loop = self.loop
+        if loop is None:
+            return
+        self.loop = None
+        loop.call_soon_threadsafe(loop.stop)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def _is_local(self) -> bool:
+        """Whether the calling code can run the control code itself."""
+        loop = self.loop
+        if loop is None:
+            return True
+        try:
+            return asyncio.get_running_loop() is loop
+        except RuntimeError:
+            return False
+
+    async def run(self, coroutine):
+        """
+        Run a coroutine on the control loop and wait for its result. Cancelling the caller cancels the coroutine.
+        """
+        if self._is_local():
+            return await coroutine
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        )
+
+    async def call(self, func, *args):
+        """
+        Call a function on the control loop and wait for its result.
+        """
+        if self._is_local():
+            return func(*args)
+        future = concurrent.futures.Future()
+
+        def call():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(call)
+        return await asyncio.wrap_future(future)
+
+    def spawn(self, coroutine):
+        """
+        Start a coroutine on the control loop without waiting for it. Must be called from an event loop.
+
+        :return: The asyncio.Task, or a concurrent.futures.Future if the control loop runs in its thread.
+        """
+        if self._is_local():
+            return asyncio.ensure_future(coroutine)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+
+control_loop = ControlLoop()
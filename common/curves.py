@@ -0,0 +1,190 @@
+"""
+Transfer curves mapping the filtered OSC input (0-1) to a power rate of the e-stim device (0-1).
+
+A curve is evaluated on every power update, so it is compiled once into a dense lookup table and the hot path is a
+single index into that table. Curves must be recompiled when their parameters change.
+"""
+
+import math
+from array import array
+
+CURVE_LINEAR = "linear"
+CURVE_EXPONENTIAL = "exponential"
+CURVE_S = "s_curve"
+CURVE_POINTS = "points"
+CURVE_KINDS = (CURVE_LINEAR, CURVE_EXPONENTIAL, CURVE_S, CURVE_POINTS)
+
+# Number of entries of the lookup table, i.e. the input is quantized to steps of 1 / (CURVE_RESOLUTION - 1).
+CURVE_RESOLUTION = 1024
+
+
+def _clamp(x: float) -> float:
+    return 0.0 if x < 0.0 else 1.0 if x > 1.0 else x
+
+
+def linear_curve(
+    start_limit: float, min_limit: float, max_limit: float, min_power: float
+):
+    """
+    The piecewise-linear curve:
+
+              ▲
+              │
+              │
+              │                max_limit
+          1.0 │               xx───────
+              │              xx
+              │             xx
+              │            xx
+              │           xx
+              │          xx
+    min_power │   ┌─────xx
+              │   │       min_limit
+              └───┴──────────────────────────►
+              start_limit
+    """
+    span = max_limit - min_limit
+
+    def curve(x: float) -> float:
+        if x < start_limit:
+            return 0.0
+        if x <= min_limit:
+            return min_power
+        if x >= max_limit or span <= 0:
+            return 1.0
+        return (x - min_limit) / span * (1 - min_power) + min_power
+
+    return curve
+
+
+def exponential_curve(
+    start_limit: float, max_limit: float, min_power: float, rate: float
+):
+    """
+    Exponential rise from `min_power` at `start_limit` to 1 at `max_limit`.
+
+    :param rate: Growth rate, the larger the flatter the start of the curve. 0 degrades to a straight line.
+    """
+    span = max_limit - start_limit
+
+    def curve(x: float) -> float:
+        if x < start_limit:
+            return 0.0
+        t = _clamp((x - start_limit) / span) if span > 0 else 1.0
+        if rate:
+            t = math.expm1(rate * t) / math.expm1(rate)
+        return t * (1 - min_power) + min_power
+
+    return curve
+
+
+def s_curve(start_limit: float, max_limit: float, min_power: float, steepness: float):
+    """
+    Logistic curve from `min_power` at `start_limit` to 1 at `max_limit`, steepest halfway.
+
+    :param steepness: Slope of the logistic function, the larger the closer to a step.
+    """
+    span = max_limit - start_limit
+    low = 1 / (1 + math.exp(steepness / 2))
+    high = 1 / (1 + math.exp(-steepness / 2))
+
+    def curve(x: float) -> float:
+        if x < start_limit:
+            return 0.0
+        t = _clamp((x - start_limit) / span) if span > 0 else 1.0
+        if steepness > 0:
+            t = (1 / (1 + math.exp(-steepness * (t - 0.5))) - low) / (high - low)
+        return t * (1 - min_power) + min_power
+
+    return curve
+
+
+def points_curve(points: list):
+    """
+    User defined curve, interpolated linearly between control points.
+
+    :param points: Control points [[x, y], [x, y], ...], with x and y between 0 and 1. The curve is constant beyond
+        the first and the last point.
+    """
+    if not points:
+        raise ValueError("A control point curve needs at least one point")
+    points = sorted((_clamp(x), _clamp(y)) for x, y in points)
+
+    def curve(x: float) -> float:
+        if x <= points[0][0]:
+            return points[0][1]
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            if x <= x1:
+                return y0 + (y1 - y0) * (x - x0) / (x1 - x0) if x1 > x0 else y1
+        return points[-1][1]
+
+    return curve
+
+
+class TransferCurve:
+    """
+    Curve compiled into a lookup table.
+
+    Attributes:
+        kind (str): One of CURVE_KINDS.
+        table (array): Power rate of the inputs 0, 1 / (resolution - 1), ..., 1.
+    """
+
+    __slots__ = ("kind", "table", "_scale", "_last")
+
+    def __init__(self, kind: str, function, resolution: int = CURVE_RESOLUTION):
+        """
+        :param kind: One of CURVE_KINDS.
+        :param function: The curve to compile, a function of the input (0-1).
+        :param resolution: Number of entries of the lookup table.
+        """
+        self.kind = kind
+        self._scale = resolution - 1
+        self._last = resolution - 1
+        self.table = array(
+            "d", (_clamp(function(i / self._scale)) for i in range(resolution))
+        )
+
+    def __call__(self, x: float) -> float:
+        i = int(x * self._scale + 0.5)
+        return self.table[0 if i < 0 else self._last if i > self._last else i]
+
+    def sample(self, count: int) -> list:
+        """
+        Evenly spaced samples of the curve, e.g. to plot it.
+
+        :param count: Number of samples, at least 2.
+        :return: [[x, y], [x, y], ...]
+        """
+        return [[i / (count - 1), self(i / (count - 1))] for i in range(count)]
+
+
+def build_curve(
+    kind: str,
+    start_limit: float,
+    min_limit: float,
+    max_limit: float,
+    min_power: float,
+    rate: float = 3.0,
+    steepness: float = 10.0,
+    points: list = None,
+) -> TransferCurve:
+    """
+    Compile a curve of the given kind.
+
+    :param kind: One of CURVE_KINDS.
+    :param rate: Growth rate of the exponential curve.
+    :param steepness: Steepness of the S-curve.
+    :param points: Control points of the "points" curve.
+    """
+    if kind == CURVE_LINEAR:
+        function = linear_curve(start_limit, min_limit, max_limit, min_power)
+    elif kind == CURVE_EXPONENTIAL:
+        function = exponential_curve(start_limit, max_limit, min_power, rate)
+    elif kind == CURVE_S:
+        function = s_curve(start_limit, max_limit, min_power, steepness)
+    elif kind == CURVE_POINTS:
+        function = points_curve(points)
+    else:
+        raise ValueError(f"Unknown curve {kind}, expected one of {CURVE_KINDS}")
+    return TransferCurve(kind, function)
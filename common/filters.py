@@ -0,0 +1,369 @@
+"""
+Input filters for the float parameters received over OSC.
+
+VRChat contact receivers can send hundreds of updates per second, so the filters in this module are designed to be
+fed one sample at a time from the OSC handlers: every update is O(1), except for the median which shifts its sorted
+buffer in place (a memmove of at most `capacity` floats), and no buffer grows or shrinks after construction.
+
+All filters share the same interface:
+
+    push(value, now=None)   add a sample
+    value(now=None)         current output of the filter
+    clear()                 forget all samples
+    latency                 estimated delay (in seconds) the filter adds to a change of the input
+"""
+
+import math
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+FILTER_MOVING_AVERAGE = "moving_average"
+FILTER_EMA = "ema"
+FILTER_MEDIAN = "median"
+FILTER_ONE_EURO = "one_euro"
+FILTER_KINDS = (FILTER_MOVING_AVERAGE, FILTER_EMA, FILTER_MEDIAN, FILTER_ONE_EURO)
+
+# Upper bound of the expected OSC update rate (Hz). Used to size the ring buffer of a time based window.
+MAX_SAMPLE_RATE = 1000
+# The ring buffer never holds less samples than this, even for very small windows.
+MIN_CAPACITY = 16
+
+
+class MovingAverageFilter:
+    """
+    Sliding window moving average over the samples received in the last `window` seconds.
+
+    Samples and their (monotonic) timestamps are stored in a preallocated ring buffer together with a running sum, so
+    that both `push()` and `mean()` are O(1) amortized. If more samples arrive within one window than the ring can
+    hold, the oldest ones are dropped.
+
+    Attributes:
+        window (float): Length of the sliding window in seconds.
+        capacity (int): Maximum number of samples kept in the window.
+    """
+
+    def __init__(self, window: float, capacity: int = None, clock=time.monotonic):
+        """
+        :param window: Length of the sliding window in seconds.
+        :param capacity: Size of the ring buffer, derived from `window` and `MAX_SAMPLE_RATE` if omitted.
+        :param clock: Monotonic clock used to timestamp the samples.
+        """
+        self.clock = clock
+        self.window = window
+        self.capacity = capacity or self._capacity_for(window)
+        self._values = array("d", bytes(8 * self.capacity))
+        self._stamps = array("d", bytes(8 * self.capacity))
+        self._head = 0  # index of the oldest sample
+        self._count = 0
+        self._sum = 0.0
+
+    @staticmethod
+    def _capacity_for(window: float) -> int:
+        return max(MIN_CAPACITY, math.ceil(window * MAX_SAMPLE_RATE))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _evict(self, now: float):
+        """Drop the samples which are older than the window."""
+        horizon = now - self.window
+        while self._count and self._stamps[self._head] < horizon:
+            self._sum -= self._values[self._head]
+            self._head = (self._head + 1) % self.capacity
+            self._count -= 1
+        if not self._count:
+            # Reset the running sum to get rid of accumulated rounding errors.
+            self._sum = 0.0
+
+    def push(self, value: float, now: float = None):
+        """
+        Add a sample to the window.
+
+        :param value: The sample.
+        :param now: Timestamp of the sample, defaults to `clock()`.
+        """
+        if now is None:
+            now = self.clock()
+        self._evict(now)
+        if self._count == self.capacity:
+            # Ring is full, overwrite the oldest sample.
+            self._sum -= self._values[self._head]
+            self._head = (self._head + 1) % self.capacity
+            self._count -= 1
+        tail = (self._head + self._count) % self.capacity
+        self._values[tail] = value
+        self._stamps[tail] = now
+        self._sum += value
+        self._count += 1
+
+    def mean(self, now: float = None) -> float:
+        """
+        Return the average of the samples in the window, or 0.0 if the window is empty.
+
+        :param now: Current timestamp, defaults to `clock()`.
+        """
+        if now is None:
+            now = self.clock()
+        self._evict(now)
+        if not self._count:
+            return 0.0
+        return self._sum / self._count
+
+    def value(self, now: float = None) -> float:
+        return self.mean(now)
+
+    @property
+    def latency(self) -> float:
+        """A step of the input reaches half of its height after half a window."""
+        return self.window / 2
+
+    def clear(self):
+        self._head = 0
+        self._count = 0
+        self._sum = 0.0
+
+    def resize(self, window: float):
+        """
+        Change the length of the window, keeping the most recent samples.
+
+        The ring buffer is only reallocated if the required capacity changes.
+
+        :param window: New length of the window in seconds.
+        """
+        self.window = window
+        capacity = self._capacity_for(window)
+        if capacity == self.capacity:
+            return
+        keep = min(self._count, capacity)
+        start = self._head + self._count - keep
+        values = array("d", bytes(8 * capacity))
+        stamps = array("d", bytes(8 * capacity))
+        total = 0.0
+        for i in range(keep):
+            j = (start + i) % self.capacity
+            values[i] = self._values[j]
+            stamps[i] = self._stamps[j]
+            total += values[i]
+        self._values = values
+        self._stamps = stamps
+        self.capacity = capacity
+        self._head = 0
+        self._count = keep
+        self._sum = total
+
+
+class ExponentialMovingAverageFilter:
+    """
+    Exponential moving average with a time constant, i.e. irregular sample intervals are weighted correctly.
+
+    Attributes:
+        time_constant (float): Time (in seconds) for the output to cover 63% of a step of the input.
+    """
+
+    def __init__(self, time_constant: float, clock=time.monotonic):
+        """
+        :param time_constant: Time constant in seconds, 0 disables the smoothing.
+        :param clock: Monotonic clock used to timestamp the samples.
+        """
+        self.clock = clock
+        self.time_constant = time_constant
+        self._value = 0.0
+        self._stamp = None
+
+    def __len__(self) -> int:
+        return 0 if self._stamp is None else 1
+
+    def push(self, value: float, now: float = None):
+        if now is None:
+            now = self.clock()
+        if self._stamp is None or self.time_constant <= 0:
+            self._value = value
+        else:
+            alpha = 1 - math.exp(-max(now - self._stamp, 0.0) / self.time_constant)
+            self._value += alpha * (value - self._value)
+        self._stamp = now
+
+    def value(self, now: float = None) -> float:
+        return self._value
+
+    @property
+    def latency(self) -> float:
+        return self.time_constant
+
+    def clear(self):
+        self._value = 0.0
+        self._stamp = None
+
+
+class MedianFilter:
+    """
+    Sliding window median over the samples received in the last `window` seconds.
+
+    Unlike an average, the median ignores isolated spikes. Samples are kept in a ring buffer in arrival order, and in
+    a sorted buffer preallocated at `capacity`: a sample is located by binary search, and the samples after it are
+    shifted in place, so a push is O(window) but the median itself is O(1).
+
+    Attributes:
+        window (float): Length of the sliding window in seconds.
+        capacity (int): Maximum number of samples kept in the window.
+    """
+
+    def __init__(self, window: float, capacity: int = None, clock=time.monotonic):
+        """
+        :param window: Length of the sliding window in seconds.
+        :param capacity: Size of the ring buffer, derived from `window` and `MAX_SAMPLE_RATE` if omitted.
+        :param clock: Monotonic clock used to timestamp the samples.
+        """
+        self.clock = clock
+        self.window = window
+        self.capacity = capacity or max(
+            MIN_CAPACITY, math.ceil(window * MAX_SAMPLE_RATE)
+        )
+        self._values = array("d", bytes(8 * self.capacity))
+        self._stamps = array("d", bytes(8 * self.capacity))
+        # The first self._count entries are the samples of the window, in ascending order.
+        self._sorted = array("d", bytes(8 * self.capacity))
+        self._shift = memoryview(self._sorted)
+        self._head = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _drop_oldest(self):
+        value = self._values[self._head]
+        n = self._count
+        i = bisect_left(self._sorted, value, 0, n)
+        self._shift[i : n - 1] = self._shift[i + 1 : n]
+        self._head = (self._head + 1) % self.capacity
+        self._count -= 1
+
+    def _evict(self, now: float):
+        horizon = now - self.window
+        while self._count and self._stamps[self._head] < horizon:
+            self._drop_oldest()
+
+    def push(self, value: float, now: float = None):
+        if now is None:
+            now = self.clock()
+        self._evict(now)
+        if self._count == self.capacity:
+            self._drop_oldest()
+        tail = (self._head + self._count) % self.capacity
+        self._values[tail] = value
+        self._stamps[tail] = now
+        n = self._count
+        i = bisect_right(self._sorted, value, 0, n)
+        self._shift[i + 1 : n + 1] = self._shift[i:n]
+        self._sorted[i] = value
+        self._count += 1
+
+    def value(self, now: float = None) -> float:
+        """
+        Return the median of the samples in the window, or 0.0 if the window is empty.
+        """
+        if now is None:
+            now = self.clock()
+        self._evict(now)
+        n = self._count
+        if not n:
+            return 0.0
+        if n % 2:
+            return self._sorted[n // 2]
+        return (self._sorted[n // 2 - 1] + self._sorted[n // 2]) / 2
+
+    @property
+    def latency(self) -> float:
+        """A step of the input reaches the output once it fills half of the window."""
+        return self.window / 2
+
+    def clear(self):
+        self._head = 0
+        self._count = 0
+
+
+class OneEuroFilter:
+    """
+    One Euro filter (Casiez et al., 2012): a low-pass filter whose cutoff frequency rises with the speed of the input.
+
+    Slow movements are smoothed strongly, fast ones pass with little lag.
+
+    Attributes:
+        min_cutoff (float): Cutoff frequency (Hz) when the input doesn't change.
+        beta (float): Increase of the cutoff frequency per unit of speed of the input.
+        d_cutoff (float): Cutoff frequency (Hz) of the speed estimate.
+    """
+
+    def __init__(
+        self,
+        min_cutoff: float = 1.0,
+        beta: float = 0.0,
+        d_cutoff: float = 1.0,
+        clock=time.monotonic,
+    ):
+        self.clock = clock
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.cutoff = min_cutoff
+        self._value = 0.0
+        self._speed = 0.0
+        self._stamp = None
+
+    @staticmethod
+    def _alpha(cutoff: float, dt: float) -> float:
+        tau = 1 / (2 * math.pi * cutoff)
+        return dt / (dt + tau)
+
+    def __len__(self) -> int:
+        return 0 if self._stamp is None else 1
+
+    def push(self, value: float, now: float = None):
+        if now is None:
+            now = self.clock()
+        if self._stamp is None:
+            self._value = value
+            self._stamp = now
+            return
+        dt = now - self._stamp
+        if dt <= 0:
+            dt = 1 / MAX_SAMPLE_RATE
+        speed = (value - self._value) / dt
+        self._speed += self._alpha(self.d_cutoff, dt) * (speed - self._speed)
+        self.cutoff = self.min_cutoff + self.beta * abs(self._speed)
+        self._value += self._alpha(self.cutoff, dt) * (value - self._value)
+        self._stamp = now
+
+    def value(self, now: float = None) -> float:
+        return self._value
+
+    @property
+    def latency(self) -> float:
+        """Time constant of the low-pass filter at the current cutoff frequency."""
+        return 1 / (2 * math.pi * self.cutoff)
+
+    def clear(self):
+        self.cutoff = self.min_cutoff
+        self._value = 0.0
+        self._speed = 0.0
+        self._stamp = None
+
+
+def build_filter(kind: str, window: float = 0.1, **params):
+    """
+    Create a filter of the given kind.
+
+    :param kind: One of FILTER_KINDS.
+    :param window: Window (moving average, median) or time constant (EMA) of the filter in seconds.
+    :param params: Parameters of the One Euro filter: min_cutoff, beta, d_cutoff.
+    """
+    if kind == FILTER_MOVING_AVERAGE:
+        return MovingAverageFilter(window)
+    if kind == FILTER_EMA:
+        return ExponentialMovingAverageFilter(window)
+    if kind == FILTER_MEDIAN:
+        return MedianFilter(window)
+    if kind == FILTER_ONE_EURO:
+        return OneEuroFilter(**params)
+    raise ValueError(f"Unknown filter {kind}, expected one of {FILTER_KINDS}")
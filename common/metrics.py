@@ -0,0 +1,323 @@
+"""
+Latency histograms and counters of the control pipeline, rendered in the Prometheus text format.
+
+The pipeline is timed with monotonic timestamps at each stage, from the UDP receive of an OSC message to the end of the
+bluetooth write. Recording a sample is a handful of integer operations on a preallocated list, cheap enough to stay
+enabled in production. All samples are recorded from the thread of the control loop (see common/control_loop.py), so
+no locking is needed; /metrics renders them from the web server's thread, so reading a metric never modifies it.
+
+Histograms are HDR-style: values are counted in buckets whose width grows with the value, 8 linear sub-buckets per
+power of two microseconds, i.e. every percentile is reported with a relative error below 12.5 %.
+"""
+
+import time
+
+# Linear sub-buckets per power of two.
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Values above 2**MAX_EXPONENT microseconds (~9.5 hours) are counted in the last bucket.
+MAX_EXPONENT = 35
+BUCKETS = SUB_BUCKETS * (MAX_EXPONENT - SUB_BUCKET_BITS + 2)
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+# Length (in seconds) of the window over which the rates of the counters are computed.
+RATE_WINDOW = 10
+
+
+def _bucket_bounds(index: int) -> tuple:
+    if index < SUB_BUCKETS:
+        return index, index + 1
+    shift = index // SUB_BUCKETS - 1
+    mantissa = index % SUB_BUCKETS + SUB_BUCKETS
+    return mantissa << shift, (mantissa + 1) << shift
+
+
+class Histogram:
+    """
+    Distribution of durations.
+
+    Attributes:
+        count (int): Number of samples.
+        sum (float): Sum of the samples (seconds).
+        max (float): Largest sample (seconds).
+    """
+
+    __slots__ = ("_counts", "count", "sum", "max")
+
+    def __init__(self):
+        # A list rather than an array: incrementing its items does not convert from and to C integers.
+        self._counts = [0] * BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        """
+        Add a sample.
+
+        :param seconds: The duration, negative values are counted as 0.
+        """
+        us = int(seconds * 1e6)
+        if us < SUB_BUCKETS:
+            if seconds < 0:
+                seconds = 0.0
+            index = us if us > 0 else 0
+        else:
+            # Values of [2**n, 2**(n+1)) microseconds are split into SUB_BUCKETS buckets: the top SUB_BUCKET_BITS + 1
+            # bits of the value, offset by the shift, give the index.
+            shift = us.bit_length() - SUB_BUCKET_BITS - 1
+            index = (shift << SUB_BUCKET_BITS) + (us >> shift)
+            if index >= BUCKETS:
+                index = BUCKETS - 1
+        self._counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def record_since(self, start: float, now: float = None):
+        """
+        Add the time elapsed since `start` (a time.monotonic() timestamp).
+        """
+        self.record((time.monotonic() if now is None else now) - start)
+
+    def percentile(self, q: float) -> float:
+        """
+        Estimate a percentile of the samples (seconds), 0.0 if there are none.
+
+        :param q: The percentile, between 0 and 1.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, n in enumerate(self._counts):
+            seen += n
+            if n and seen >= rank:
+                low, high = _bucket_bounds(index)
+                return min((low + high) / 2 / 1e6, self.max)
+        return self.max
+
+    def clear(self):
+        self._counts = [0] * BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class Counter:
+    """
+    Monotonic counter, which also keeps the rate of the last RATE_WINDOW seconds.
+
+    Attributes:
+        value (int): Total count.
+    """
+
+    __slots__ = ("value", "_slots", "_second", "clock")
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.value = 0
+        # Counts of the last RATE_WINDOW seconds, indexed by second modulo RATE_WINDOW.
+        self._slots = [0] * RATE_WINDOW
+        self._second = 0
+
+    def _advance(self, second: int):
+        if second - self._second >= RATE_WINDOW:
+            self._slots = [0] * RATE_WINDOW
+        else:
+            for s in range(self._second + 1, second + 1):
+                self._slots[s % RATE_WINDOW] = 0
+        self._second = second
+
+    def inc(self, n: int = 1):
+        second = int(self.clock())
+        if second != self._second:
+            self._advance(second)
+        self._slots[second % RATE_WINDOW] += n
+        self.value += n
+
+    def rate(self) -> float:
+        """Average count per second over the last RATE_WINDOW complete seconds."""
+        second = int(self.clock())
+        slots = self._slots
+        # The slots of the seconds after the last increment are stale: they count as 0, instead of being cleared
+        # here, which would race with inc().
+        last = min(second - 1, self._second)
+        return sum(
+            slots[s % RATE_WINDOW] for s in range(second - RATE_WINDOW + 1, last + 1)
+        ) / (RATE_WINDOW - 1)
+
+
+class Family:
+    """
+    Metrics of the same name, one per combination of label values.
+    """
+
+    def __init__(self, name: str, help: str, kind: str, label_names: tuple, factory):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = label_names
+        self._factory = factory
+        self.children = {}
+
+    def labels(self, *values):
+        """
+        Return the metric of the given label values, creating it on first use.
+
+        Look the metric up once and keep it, instead of calling this on the hot path.
+        """
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._factory()
+        return child
+
+
+class Registry:
+    """
+    The metrics of the process, and collectors of the values which are already counted elsewhere.
+    """
+
+    def __init__(self):
+        self.families = {}
+        self.collectors = []
+
+    def _family(self, name: str, help: str, kind: str, label_names, factory):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(
+                name, help, kind, tuple(label_names), factory
+            )
+        return family
+
+    def histogram(self, name: str, help: str, label_names=()) -> Family:
+        return self._family(name, help, "summary", label_names, Histogram)
+
+    def counter(self, name: str, help: str, label_names=()) -> Family:
+        return self._family(name, help, "counter", label_names, Counter)
+
+    def add_collector(self, collector):
+        """
+        Register a function returning extra samples at every scrape.
+
+        :param collector: Function returning a list of (name, kind, help, labels dict, value).
+        """
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        # Copies, as the control loop adds metrics while they are rendered.
+        for family in list(self.families.values()):
+            # The samples of a counter are named with the "_total" suffix, and declared under that name as the text
+            # format 0.0.4 expects (like client_python does).
+            declared = (
+                family.name + "_total" if family.kind == "counter" else family.name
+            )
+            lines.append(f"# HELP {declared} {family.help}")
+            lines.append(f"# TYPE {declared} {family.kind}")
+            rates = []
+            for values, metric in list(family.children.items()):
+                labels = dict(zip(family.label_names, values))
+                if family.kind == "summary":
+                    for q in QUANTILES:
+                        lines.append(
+                            _sample(
+                                family.name,
+                                {**labels, "quantile": q},
+                                metric.percentile(q),
+                            )
+                        )
+                    lines.append(_sample(family.name + "_sum", labels, metric.sum))
+                    lines.append(_sample(family.name + "_count", labels, metric.count))
+                else:
+                    lines.append(_sample(family.name + "_total", labels, metric.value))
+                    rates.append((labels, metric.rate()))
+            if rates:
+                name = family.name + "_per_second"
+                lines.append(
+                    f"# HELP {name} {family.help}, average of the last {RATE_WINDOW} s"
+                )
+                lines.append(f"# TYPE {name} gauge")
+                lines.extend(_sample(name, labels, rate) for labels, rate in rates)
+        for collector in self.collectors:
+            declared = set()
+            for name, kind, help, labels, value in collector():
+                if name not in declared:
+                    lines.append(f"# HELP {name} {help}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    declared.add(name)
+                lines.append(_sample(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+def _sample(name: str, labels: dict, value) -> str:
+    if labels:
+        text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+        return f"{name}{{{text}}} {value}"
+    return f"{name} {value}"
+
+
+registry = Registry()
+
+# Stages of the OSC input, timed per OSC address:
+# UDP receive -> entry of the handler
+STAGE_OSC_DISPATCH = "osc_dispatch"
+# handler entry -> power requested from every channel mapped to the address
+STAGE_FILTER = "filter"
+
+# Stages of the output, timed per channel ("a", "b", or "ab" for the power characteristic shared by both):
+# power request -> start of its write by the PowerScheduler
+STAGE_POWER_QUEUE = "power_queue"
+# write_gatt_char() of the power
+STAGE_POWER_WRITE = "power_write"
+# UDP receive -> end of the power write
+STAGE_OSC_TO_POWER = "osc_to_power"
+# deadline of a pattern state -> start of its write
+STAGE_PATTERN_LATENESS = "pattern_lateness"
+# write_gatt_char() of a pattern state
+STAGE_PATTERN_WRITE = "pattern_write"
+# command posted to the BLE worker process -> read by the worker (see toys/estim/coyote/dg_worker.py)
+STAGE_IPC_COMMAND = "ipc_command"
+# telemetry posted by the BLE worker process -> read by the app
+STAGE_IPC_TELEMETRY = "ipc_telemetry"
+
+osc_stage_latency = registry.histogram(
+    "osctoys_osc_stage_latency_seconds",
+    "Latency of the stages of the OSC input",
+    ("stage", "address"),
+)
+stage_latency = registry.histogram(
+    "osctoys_stage_latency_seconds",
+    "Latency of the stages of the output to the devices",
+    ("stage", "channel"),
+)
+osc_messages = registry.counter(
+    "osctoys_osc_messages", "OSC messages received", ("address",)
+)
+power_writes = registry.counter("osctoys_power_writes", "Power writes to the devices")
+pattern_writes = registry.counter(
+    "osctoys_pattern_writes", "Pattern states written to the devices", ("channel",)
+)
+
+
+def osc_stage(name: str, address: str) -> Histogram:
+    """
+    The latency histogram of a stage of the OSC input.
+
+    :param name: STAGE_OSC_DISPATCH or STAGE_FILTER.
+    :param address: The OSC address.
+    """
+    return osc_stage_latency.labels(name, address)
+
+
+def stage(name: str, channel: str) -> Histogram:
+    """
+    The latency histogram of a stage of the output, the samples of all the devices are merged.
+
+    :param name: One of the other STAGE_* constants.
+    :param channel: "a", "b" or "ab".
+    """
+    return stage_latency.labels(name, channel)
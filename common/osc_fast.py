@@ -0,0 +1,156 @@
+"""
+Fast path of the OSC listener: a DatagramProtocol which only decodes the messages sent to the subscribed addresses.
+
+VRChat sends hundreds of avatar parameters per second, of which only a few are mapped to a device. python-osc parses
+every datagram into message objects and pattern-matches every address before finding out that nobody listens to it.
+Here the raw address bytes of each message are looked up in a dict of the subscribed addresses first, and the single
+argument of a subscribed message is read with struct.unpack_from at its offset in the datagram. Bundles are walked in
+place the same way, without copying their elements.
+
+Anything unusual is passed to a fallback, normally Dispatcher.call_handlers_for_packet of python-osc:
+    - messages to a subscribed address with other arguments than a single float, int or boolean,
+    - messages whose address is an OSC pattern,
+    - packets which cannot be parsed (python-osc drops them).
+
+Unlike python-osc, the messages of a bundle are handled at once, whatever its time tag.
+"""
+
+import asyncio
+import re
+import struct
+
+BUNDLE_PREFIX = b"#bundle\0"
+# Prefix, time tag
+BUNDLE_HEADER_SIZE = 16
+
+_FLOAT = struct.Struct(">f")
+_INT = struct.Struct(">i")
+_TAG_FLOAT = b",f\0\0"
+_TAG_INT = b",i\0\0"
+_TAG_TRUE = b",T\0\0"
+_TAG_FALSE = b",F\0\0"
+# Addresses remembered as subscribed or not, beyond this number the other addresses are looked up every time.
+MAX_KNOWN_ADDRESSES = 4096
+_UNKNOWN = object()
+# Characters which make an address an OSC pattern, matched by python-osc against the mapped addresses.
+_PATTERN = re.compile(rb"[*?\[\]{}]")
+
+
+class FastOSCProtocol(asyncio.DatagramProtocol):
+    """
+    Attributes:
+        accept_all (bool): Also decode the messages to the addresses which are not subscribed, e.g. to record them.
+        packets (int): Number of datagrams received.
+        fallbacks (int): Number of messages or packets passed to the fallback.
+    """
+
+    def __init__(self, handler, fallback):
+        """
+        :param handler: Function called as handler(address, value) for every decoded message.
+        :param fallback: Function called as fallback(data, client_address) with the packets, or the single messages,
+            that the fast path does not decode.
+        """
+        self.handler = handler
+        self.fallback = fallback
+        self.accept_all = False
+        self.packets = 0
+        self.fallbacks = 0
+        # ({encoded address: address, None if it is not subscribed}, match function), swapped at once.
+        self._subscription = ({}, None)
+
+    def subscribe(self, addresses, match=None):
+        """
+        Set the addresses whose messages are decoded, replacing the previous ones at once.
+
+        :param addresses: Iterable of OSC addresses.
+        :param match: Function called as match(address) on the first message of any other address, e.g. to match it
+            against OSC patterns; its messages are decoded if it returns True. The result is remembered until the next
+            subscription.
+        """
+        self._subscription = (
+            {address.encode(): address for address in addresses},
+            match,
+        )
+
+    def datagram_received(self, data: bytes, addr):
+        self.packets += 1
+        if data.startswith(BUNDLE_PREFIX):
+            if not self._handle_bundle(data, BUNDLE_HEADER_SIZE, len(data), addr):
+                self.fallbacks += 1
+                self.fallback(data, addr)
+        else:
+            self._handle_message(data, 0, len(data), addr)
+
+    def _handle_bundle(self, data: bytes, offset: int, end: int, addr) -> bool:
+        """
+        Handle the elements of the bundle in data[offset - BUNDLE_HEADER_SIZE:end].
+
+        :return: False if the bundle is malformed, nothing was handled then.
+        """
+        elements = []
+        while offset < end:
+            if offset + 4 > end:
+                return False
+            size = _INT.unpack_from(data, offset)[0]
+            offset += 4
+            if size <= 0 or offset + size > end:
+                return False
+            elements.append((offset, offset + size))
+            offset += size
+        for start, stop in elements:
+            if data.startswith(BUNDLE_PREFIX, start):
+                if not self._handle_bundle(
+                    data, start + BUNDLE_HEADER_SIZE, stop, addr
+                ):
+                    self.fallbacks += 1
+                    self.fallback(data[start:stop], addr)
+            else:
+                self._handle_message(data, start, stop, addr)
+        return True
+
+    def _handle_message(self, data: bytes, start: int, end: int, addr):
+        """
+        Handle the message in data[start:end].
+        """
+        nul = data.find(b"\0", start, end)
+        if nul < 0:
+            self._fall_back(data, start, end, addr)
+            return
+        raw_address = data[start:nul]
+        addresses, match = self._subscription
+        address = addresses.get(raw_address, _UNKNOWN)
+        if address is _UNKNOWN:
+            if _PATTERN.search(raw_address) is not None:
+                self._fall_back(data, start, end, addr)
+                return
+            address = raw_address.decode(errors="replace")
+            if match is None or not match(address):
+                address = None
+            if len(addresses) < MAX_KNOWN_ADDRESSES:
+                addresses[raw_address] = address
+        if address is None:
+            if not self.accept_all:
+                return
+            address = raw_address.decode(errors="replace")
+        # The address is null-terminated and padded to a multiple of 4 bytes, the type tags follow.
+        tags = start + ((nul - start) // 4 + 1) * 4
+        size = end - tags
+        if size == 8 and data.startswith(_TAG_FLOAT, tags):
+            value = _FLOAT.unpack_from(data, tags + 4)[0]
+        elif size == 8 and data.startswith(_TAG_INT, tags):
+            value = _INT.unpack_from(data, tags + 4)[0]
+        elif size == 4 and data.startswith(_TAG_TRUE, tags):
+            value = True
+        elif size == 4 and data.startswith(_TAG_FALSE, tags):
+            value = False
+        else:
+            self._fall_back(data, start, end, addr)
+            return
+        self.handler(address, value)
+
+    def _fall_back(self, data: bytes, start: int, end: int, addr):
+        self.fallbacks += 1
+        if start == 0 and end == len(data):
+            self.fallback(data, addr)
+        else:
+            self.fallback(data[start:end], addr)
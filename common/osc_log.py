@@ -0,0 +1,284 @@
+"""
+Binary log of received OSC messages, and deterministic replay of such a log.
+
+A log records real input (e.g. a VRChat session) once, so that the filters, curves and the rest of the control path
+can be tuned and benchmarked offline by feeding the same messages through the same handlers.
+
+Layout (little-endian, append-only):
+
+    header      "<4sHHd"    magic b"OSCL", version, reserved, wall clock time (s since epoch) of the start
+    address     "<BHH"      RECORD_ADDRESS, address id, length; followed by the utf-8 encoded address.
+                            Written before the first message of every address.
+    message     "<BHdf"     RECORD_MESSAGE, address id, time (s) since the start, value
+
+Run `python -m common.osc_log info <log>` to summarize a log, `python -m common.osc_log replay <log>` to replay it
+(add `--mock` to replay into a simulated coyote).
+"""
+
+import asyncio
+import logging
+import os
+import struct
+import time
+
+MAGIC = b"OSCL"
+VERSION = 1
+HEADER = struct.Struct("<4sHHd")
+RECORD_ADDRESS = 0
+RECORD_MESSAGE = 1
+ADDRESS = struct.Struct("<BHH")
+MESSAGE = struct.Struct("<BHdf")
+
+
+class OscRecorder:
+    """
+    Appends the received OSC messages to a log.
+
+    `handler` is meant to be mapped on the dispatcher for every address of interest (and as its default handler). It
+    returns immediately while the recorder is stopped, so it can stay mapped.
+
+    Attributes:
+        path (str): Path of the log being written, None while stopped.
+        count (int): Number of messages recorded since the last start.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """
+        :param clock: Monotonic clock used to timestamp the messages.
+        """
+        self.clock = clock
+        self.path = None
+        self.count = 0
+        self._file = None
+        self._start = 0.0
+        self._ids = {}
+
+    @property
+    def active(self) -> bool:
+        return self._file is not None
+
+    def start(self, path: str):
+        """
+        Start recording into a new log, stopping the current recording first.
+        """
+        self.stop()
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION, 0, time.time()))
+        self._start = self.clock()
+        self._ids = {}
+        self.path = path
+        self.count = 0
+
+    def stop(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.path = None
+
+    def record(self, address: str, value: float, now: float = None):
+        """
+        Append a message to the log.
+
+        :param address: OSC address of the message.
+        :param value: First argument of the message, booleans and ints are stored as floats.
+        :param now: Timestamp of the message, defaults to `clock()`.
+        """
+        if self._file is None:
+            return
+        if now is None:
+            now = self.clock()
+        address_id = self._ids.get(address)
+        if address_id is None:
+            address_id = self._ids[address] = len(self._ids)
+            encoded = address.encode("utf-8")
+            self._file.write(ADDRESS.pack(RECORD_ADDRESS, address_id, len(encoded)))
+            self._file.write(encoded)
+        self._file.write(
+            MESSAGE.pack(RECORD_MESSAGE, address_id, now - self._start, float(value))
+        )
+        self.count += 1
+
+    def handler(self, address: str, *args):
+        """
+        Dispatcher handler, records the first argument of the message.
+        """
+        if self._file is None or not args:
+            return
+        try:
+            self.record(address, float(args[0]))
+        except (TypeError, ValueError):
+            # Not a number (e.g. a string parameter), nothing to replay.
+            pass
+
+
+def log_path(directory: str, name: str) -> str:
+    """
+    Path of a log given by a client, which must stay within `directory`.
+
+    :param directory: Directory of the logs.
+    :param name: Path of the log, relative to `directory`.
+    :raise ValueError: The path points outside of `directory`.
+    """
+    base = os.path.realpath(directory)
+    path = os.path.realpath(os.path.join(base, name))
+    if path == base or os.path.commonpath([base, path]) != base:
+        raise ValueError(f"{name} is not a log within {directory}")
+    return path
+
+
+def read_log(path: str):
+    """
+    Read the messages of a log.
+
+    :return: Iterator of (time (s) since the start, address, value).
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, _, _ = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not an OSC log of version {VERSION}")
+    addresses = {}
+    pos = HEADER.size
+    # A truncated last record (e.g. the recording was killed) is ignored.
+    while pos < len(data):
+        kind = data[pos]
+        if kind == RECORD_ADDRESS:
+            if pos + ADDRESS.size > len(data):
+                break
+            _, address_id, length = ADDRESS.unpack_from(data, pos)
+            pos += ADDRESS.size
+            addresses[address_id] = data[pos : pos + length].decode("utf-8")
+            pos += length
+        elif kind == RECORD_MESSAGE:
+            if pos + MESSAGE.size > len(data):
+                break
+            _, address_id, t, value = MESSAGE.unpack_from(data, pos)
+            pos += MESSAGE.size
+            yield t, addresses[address_id], value
+        else:
+            raise ValueError(f"Corrupted OSC log {path} at offset {pos}")
+
+
+class VirtualClock:
+    """
+    Clock driven by the replayer: it returns the time of the message being replayed, whatever the replay speed.
+    """
+
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+async def replay(messages, dispatch, speed: float = 1.0, clock: VirtualClock = None):
+    """
+    Feed logged messages to `dispatch`.
+
+    The handlers see the recorded timing through `clock`, so a replay gives the same results at any speed.
+
+    :param messages: Iterator of (time, address, value), e.g. from `read_log()`.
+    :param dispatch: Function (address, value) handling a message.
+    :param speed: Replay speed, 1 for real time, N for N times faster, 0 for as fast as possible.
+    :param clock: Clock set to the time of each message before dispatching it.
+    :return: Number of messages replayed.
+    """
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    first = None
+    count = 0
+    for t, address, value in messages:
+        if first is None:
+            first = t
+        if speed > 0:
+            delay = start + (t - first) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif count % 1000 == 0:
+            # Let the other tasks (e.g. the power scheduler) run.
+            await asyncio.sleep(0)
+        if clock is not None:
+            clock.now = t
+        dispatch(address, value)
+        count += 1
+    return count
+
+
+def summarize(path: str) -> dict:
+    """
+    Number of messages, duration and message rate of a log, per address.
+    """
+    addresses = {}
+    duration = 0.0
+    for t, address, value in read_log(path):
+        addresses[address] = addresses.get(address, 0) + 1
+        duration = t
+    return {
+        "messages": sum(addresses.values()),
+        "duration": duration,
+        "addresses": {
+            address: {"messages": n, "rate": n / duration if duration else 0.0}
+            for address, n in addresses.items()
+        },
+    }
+
+
+async def _replay_main(path: str, speed: float, mock: bool):
+    from routers import coyote
+
+    if mock:
+        from toys.estim.coyote import dg_mock
+
+        dg_mock.enabled = True
+    ci = coyote.get_interface()
+    channels = None
+    if mock:
+        # Run the whole pipeline as in the app: power scheduler, pattern player and the simulated device.
+        await ci.connect()
+        channels = asyncio.ensure_future(coyote.start_channels())
+    started = time.perf_counter()
+    stats = await coyote.replay_log(path, speed)
+    elapsed = time.perf_counter() - started
+    print(
+        f"Replayed {stats['messages']} messages in {elapsed:.3f} s "
+        f"({stats['messages'] / elapsed if elapsed else 0:.0f} messages/s), "
+        f"{stats['requests']} power requests (digest {stats['digest']})"
+    )
+    if mock:
+        # Let the last power request reach the device.
+        await asyncio.sleep(2 * ci.power_scheduler.interval)
+        print(f"Device {ci.device.stats()}")
+        print(f"Playback {ci.player.stats()}")
+        channels.cancel()
+        await ci.disconnect()
+    print(f"Power scheduler {ci.power_scheduler.stats()}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="OSC session logs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    info_parser = subparsers.add_parser("info", help="summarize a log")
+    info_parser.add_argument("log")
+    replay_parser = subparsers.add_parser(
+        "replay", help="replay a log through the coyote OSC handlers"
+    )
+    replay_parser.add_argument("log")
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        default=0,
+        help="1 for real time, N for N times faster, 0 (default) for as fast as possible",
+    )
+    replay_parser.add_argument(
+        "--mock",
+        action="store_true",
+        help="replay into a simulated coyote, through the power scheduler and the pattern player",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "info":
+        print(summarize(args.log))
+    else:
+        asyncio.run(_replay_main(args.log, args.speed, args.mock))
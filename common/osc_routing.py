@@ -0,0 +1,153 @@
+"""
+OSC address patterns, and the ways to combine the inputs routed to the same channel.
+
+Patterns follow the OSC 1.0 syntax, within each part of the address (between slashes):
+
+    ?           any single character
+    *           any sequence of characters
+    [abc]       any of the characters, [a-z] for a range, [!abc] for any other character
+    {foo,bar}   any of the strings
+
+A PatternTrie holds many patterns split on the slashes: the literal parts of the patterns are followed with a dict
+lookup, and only the parts containing wildcards are matched with their precompiled regular expression, so matching an
+address does not try every pattern.
+"""
+
+import re
+
+COMBINE_MAX = "max"
+COMBINE_SUM = "sum"
+COMBINE_MEAN = "mean"
+# max: the strongest weighted input; sum: the sum of the weighted inputs, capped at 1; mean: the weighted mean.
+COMBINE_MODES = (COMBINE_MAX, COMBINE_SUM, COMBINE_MEAN)
+
+_WILDCARDS = re.compile(r"[*?\[\]{}]")
+
+
+def is_pattern(address: str) -> bool:
+    return _WILDCARDS.search(address) is not None
+
+
+def compile_part(part: str) -> re.Pattern:
+    """
+    Compile one part of an OSC pattern (without slashes) to a regular expression.
+
+    :raise ValueError: The pattern is malformed.
+    """
+    regex = []
+    i = 0
+    while i < len(part):
+        c = part[i]
+        if c == "*":
+            regex.append(".*")
+        elif c == "?":
+            regex.append(".")
+        elif c == "[":
+            end = part.find("]", i + 1)
+            if end < 0:
+                raise ValueError(f"Unclosed [ in {part}")
+            chars = part[i + 1 : end]
+            negate = chars.startswith("!")
+            if negate:
+                chars = chars[1:]
+            if not chars:
+                raise ValueError(f"Empty [] in {part}")
+            # Keep the ranges, escape anything else
+            chars = "".join(
+                ch if ch == "-" and 0 < j < len(chars) - 1 else re.escape(ch)
+                for j, ch in enumerate(chars)
+            )
+            regex.append(f"[{'^' if negate else ''}{chars}]")
+            i = end
+        elif c == "{":
+            end = part.find("}", i + 1)
+            if end < 0:
+                raise ValueError(f"Unclosed {{ in {part}")
+            options = part[i + 1 : end].split(",")
+            regex.append(f"(?:{'|'.join(re.escape(option) for option in options)})")
+            i = end
+        elif c in "]}":
+            raise ValueError(f"Unexpected {c} in {part}")
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    try:
+        return re.compile("".join(regex))
+    except re.error as e:
+        raise ValueError(f"Invalid pattern {part}: {e}")
+
+
+def check_pattern(pattern: str):
+    """
+    :raise ValueError: The pattern is malformed.
+    """
+    for part in pattern.split("/"):
+        if is_pattern(part):
+            compile_part(part)
+
+
+class _Node:
+    __slots__ = ("literals", "wildcards", "values")
+
+    def __init__(self):
+        # {part: _Node}
+        self.literals = {}
+        # [(compiled part, _Node)]
+        self.wildcards = []
+        # Values of the patterns ending at this node
+        self.values = []
+
+
+class PatternTrie:
+    """
+    OSC patterns, each with an associated value.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._wildcard_nodes = {}
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, pattern: str, value):
+        """
+        :raise ValueError: The pattern is malformed.
+        """
+        node = self._root
+        for part in pattern.split("/"):
+            if not is_pattern(part):
+                child = node.literals.get(part)
+                if child is None:
+                    child = node.literals[part] = _Node()
+            else:
+                # Patterns sharing a wildcard part share its node
+                key = (id(node), part)
+                child = self._wildcard_nodes.get(key)
+                if child is None:
+                    regex = compile_part(part)
+                    child = self._wildcard_nodes[key] = _Node()
+                    node.wildcards.append((regex, child))
+            node = child
+        node.values.append(value)
+        self.size += 1
+
+    def match(self, address: str) -> list:
+        """
+        The values of all the patterns matching an address.
+        """
+        nodes = [self._root]
+        for part in address.split("/"):
+            matched = []
+            for node in nodes:
+                child = node.literals.get(part)
+                if child is not None:
+                    matched.append(child)
+                for regex, child in node.wildcards:
+                    if regex.fullmatch(part) is not None:
+                        matched.append(child)
+            if not matched:
+                return []
+            nodes = matched
+        return [value for node in nodes for value in node.values]
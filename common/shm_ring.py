@@ -0,0 +1,145 @@
+"""
+Lock-free single-producer single-consumer ring of fixed-size records in shared memory, to pass commands and
+telemetry between two processes without pickling, pipes or locks.
+
+Layout of the shared memory block:
+
+    [0, 8)      head: number of records ever written, only written by the producer
+    [64, 72)    tail: number of records ever read, only written by the consumer
+    [128, ...)  `capacity` slots of `SLOT.size` bytes
+
+The producer writes the record into the slot first and publishes it by incrementing `head` afterwards; the consumer
+reads the record and releases the slot by incrementing `tail` afterwards. Each index has a single writer, aligned
+8-byte stores are atomic, and x86 does not reorder stores, so a published record is always complete and neither side
+ever waits for the other. Head and tail live in separate cache lines, so the two processes do not contend on them.
+
+Weakly ordered CPUs (ARM, e.g. Windows on ARM or Apple silicon) may make the stores visible in another order, and
+Python has no memory barrier to prevent it: the ring must not be used where ORDERED_STORES is False.
+"""
+
+import platform
+import struct
+from multiprocessing import shared_memory
+
+# Whether the CPU keeps the stores in order (x86), which the ring relies on.
+ORDERED_STORES = platform.machine().lower() in (
+    "x86_64",
+    "amd64",
+    "x86",
+    "i386",
+    "i686",
+)
+# Size (bytes) of the payload of a record, longer payloads are truncated.
+PAYLOAD_SIZE = 100
+# kind, channel, a, b, t1, t2, payload
+SLOT = struct.Struct(f"<BBxxiidd{PAYLOAD_SIZE}s")
+INDEX = struct.Struct("<Q")
+HEAD_OFFSET = 0
+TAIL_OFFSET = 64
+DATA_OFFSET = 128
+
+
+class SpscRing:
+    """
+    Attributes:
+        name (str): Name of the shared memory block, to attach to the ring from the other process.
+        capacity (int): Number of slots.
+        dropped (int): Number of records not written because the ring was full (producer side).
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, capacity: int, owner: bool):
+        self._shm = shm
+        self._buf = shm.buf
+        self.name = shm.name
+        self.capacity = capacity
+        self.owner = owner
+        self.dropped = 0
+
+    @classmethod
+    def create(cls, capacity: int = 1024) -> "SpscRing":
+        """
+        Allocate a new ring, owned (and eventually unlinked) by the calling process.
+        """
+        shm = shared_memory.SharedMemory(
+            create=True, size=DATA_OFFSET + capacity * SLOT.size
+        )
+        ring = cls(shm, capacity, owner=True)
+        ring.reset()
+        return ring
+
+    @classmethod
+    def attach(cls, name: str, capacity: int) -> "SpscRing":
+        """
+        Attach to a ring created by another process.
+
+        The block stays registered with the resource tracker that the processes started with multiprocessing share
+        with their parent, so it is not unlinked when this process exits, only if the creator exits without closing.
+        """
+        shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, capacity, owner=False)
+
+    def reset(self):
+        """Empty the ring. Only safe while no other process uses it."""
+        INDEX.pack_into(self._buf, HEAD_OFFSET, 0)
+        INDEX.pack_into(self._buf, TAIL_OFFSET, 0)
+
+    def __len__(self) -> int:
+        return (
+            INDEX.unpack_from(self._buf, HEAD_OFFSET)[0]
+            - INDEX.unpack_from(self._buf, TAIL_OFFSET)[0]
+        )
+
+    def put(
+        self,
+        kind: int,
+        channel: int = 0,
+        a: int = 0,
+        b: int = 0,
+        t1: float = 0.0,
+        t2: float = 0.0,
+        payload: bytes = b"",
+    ) -> bool:
+        """
+        Write a record, producer side. Never blocks.
+
+        :return: False if the ring is full, the record is dropped.
+        """
+        buf = self._buf
+        head = INDEX.unpack_from(buf, HEAD_OFFSET)[0]
+        if head - INDEX.unpack_from(buf, TAIL_OFFSET)[0] >= self.capacity:
+            self.dropped += 1
+            return False
+        SLOT.pack_into(
+            buf,
+            DATA_OFFSET + (head % self.capacity) * SLOT.size,
+            kind,
+            channel,
+            a,
+            b,
+            t1,
+            t2,
+            payload,
+        )
+        INDEX.pack_into(buf, HEAD_OFFSET, head + 1)
+        return True
+
+    def get(self):
+        """
+        Read the oldest record, consumer side. Never blocks.
+
+        :return: (kind, channel, a, b, t1, t2, payload), or None if the ring is empty.
+        """
+        buf = self._buf
+        tail = INDEX.unpack_from(buf, TAIL_OFFSET)[0]
+        if tail == INDEX.unpack_from(buf, HEAD_OFFSET)[0]:
+            return None
+        record = SLOT.unpack_from(buf, DATA_OFFSET + (tail % self.capacity) * SLOT.size)
+        INDEX.pack_into(buf, TAIL_OFFSET, tail + 1)
+        return record
+
+    def close(self):
+        """Detach from the ring, and free it if this process created it."""
+        self._buf = None
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
@@ -0,0 +1,38 @@
+import { useEffect, useState } from 'react';
+
+const RECONNECT_DELAY = 2000;
+
+// Live device state pushed by the backend, see routers/telemetry.py.
+// The first message holds the full snapshot, the following ones only the changed fields.
+export function useTelemetry() {
+  const [telemetry, setTelemetry] = useState(null);
+
+  useEffect(() => {
+    let socket = null;
+    let timeout = null;
+    let closed = false;
+
+    const connect = () => {
+      const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+      socket = new WebSocket(`${protocol}//${window.location.host}/api/telemetry/ws`);
+      socket.onmessage = (event) => {
+        const delta = JSON.parse(event.data);
+        setTelemetry((prevState) => ({ ...prevState, ...delta }));
+      };
+      socket.onclose = () => {
+        if (!closed) {
+          timeout = setTimeout(connect, RECONNECT_DELAY);
+        }
+      };
+    };
+
+    connect();
+    return () => {
+      closed = true;
+      clearTimeout(timeout);
+      socket.close();
+    };
+  }, []);
+
+  return telemetry;
+}
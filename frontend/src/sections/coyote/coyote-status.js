@@ -29,31 +29,19 @@ import BluetoothConnectedIcon from '@mui/icons-material/BluetoothConnected';
 import { red, orange, green } from '@mui/material/colors';
 import { useEffect } from 'react';
 import { set } from 'nprogress';
+import { useTelemetry } from 'src/hooks/use-telemetry';
 
 export const CoyoteStats = () => {
   const [uid, setUid] = useState('');
-  const [battery, setBattery] = useState(0);
-  const [connected, setConnected] = useState(false);
-  const [firstPoll, setFirstPoll] = useState(true);
-  const [wantedStatus, setWantedStatus] = useState(false);
+  const telemetry = useTelemetry();
+  const battery = telemetry ? telemetry.battery : 0;
+  const connected = telemetry ? telemetry.connected : false;
+  const [wantedStatus, setWantedStatus] = useState(null);
 
   const [openSuccess, setOpenSuccess] = useState(false);
   const [openError, setOpenError] = useState(false);
   const [message, setMessage] = useState('');
 
-  const getStatus = () => {
-    axios.get('/api/coyote/status').then((res) => {
-      setBattery(res.data.battery_level);
-      setConnected(res.data.is_connected);
-      if (firstPoll) {
-        setWantedStatus(res.data.is_connected);
-        setFirstPoll(false);
-      }
-    }).catch((err) => {
-      console.error(err);
-    });
-  }
-
   const getUid = () => {
     axios.get('/api/coyote/uid').then((res) => {
       setUid(res.data.uid);
@@ -99,10 +87,13 @@ export const CoyoteStats = () => {
 
   useEffect(() => {
     getUid();
-    getStatus();
-    const id = setInterval(getStatus, 3000);
-    return () => clearInterval(id);
-  }, [firstPoll]);
+  }, []);
+
+  useEffect(() => {
+    if (telemetry && wantedStatus === null) {
+      setWantedStatus(telemetry.connected);
+    }
+  }, [telemetry, wantedStatus]);
 
   return (
     <Card>
@@ -1,7 +1,5 @@
-import axios from 'axios';
 import PropTypes from 'prop-types';
 import { Avatar, Box, Card, CardContent, Stack, SvgIcon, Typography } from '@mui/material';
-import { useState, useEffect } from 'react';
 
 import Battery20Icon from '@mui/icons-material/Battery20';
 import Battery30Icon from '@mui/icons-material/Battery30';
@@ -14,25 +12,14 @@ import BluetoothDisabledIcon from '@mui/icons-material/BluetoothDisabled';
 import BluetoothConnectedIcon from '@mui/icons-material/BluetoothConnected';
 import BoltSharpIcon from '@mui/icons-material/BoltSharp';
 import { red, orange, green, yellow } from '@mui/material/colors';
+import { useTelemetry } from 'src/hooks/use-telemetry';
 
 export const OverviewCoyote = (props) => {
   const { sx } = props;
 
-  const [battery, setBattery] = useState(0);
-  const [connected, setConnected] = useState(false);
-
-  const getStatus = () => {
-    axios.get('/api/coyote/status').then((res) => {
-      setBattery(res.data.battery_level);
-      setConnected(res.data.is_connected);
-    }).catch((err) => {
-      console.error(err);
-    });
-  }
-
-  useEffect(() => {
-    getStatus();
-  }, []);
+  const telemetry = useTelemetry();
+  const battery = telemetry ? telemetry.battery : 0;
+  const connected = telemetry ? telemetry.connected : false;
 
   return (
     <Card sx={sx}>
@@ -1,27 +1,78 @@
+import time
+
+# Startup phases are timed from here, see log_startup_phase()
+startup_time = time.perf_counter()
+startup_phases = []
+
+
+def log_startup_phase(phase: str):
+    startup_phases.append((phase, time.perf_counter()))
+
+
+import argparse
 import logging
 import multiprocessing
 import uvicorn
-from settings import Settings, settings
-from pythonosc import osc_server
-from routers import coyote, osc_server
+from settings import Settings, persistence, settings
+from routers import coyote, devices, osc_server, telemetry
+from common import metrics
+from common.control_loop import control_loop
 from fastapi import BackgroundTasks, FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 
+log_startup_phase("imports")
+
+parser = argparse.ArgumentParser(description="OSC Toys")
+parser.add_argument(
+    "--headless",
+    action="store_true",
+    help="only serve the API and the OSC listener, without the webview window and the frontend",
+)
+parser.add_argument("--port", type=int, default=38080, help="port of the API server")
+parser.add_argument(
+    "--mock",
+    action="store_true",
+    help="simulate the coyote instead of connecting to it over bluetooth",
+)
+args, _ = parser.parse_known_args()
+if args.mock:
+    from toys.estim.coyote import dg_mock
+
+    dg_mock.enabled = True
+
 app = FastAPI()
 
 app.include_router(coyote.router)
+app.include_router(devices.router)
 app.include_router(osc_server.router)
-app.mount("/", StaticFiles(directory="frontend\\out", html=True), name="frontend")
+app.include_router(telemetry.router)
+if not args.headless:
+    app.mount("/", StaticFiles(directory="frontend\\out", html=True), name="frontend")
+
+log_startup_phase("app")
 
 
 @app.on_event("startup")
 async def app_startup():
     logging.basicConfig(level=logging.INFO)
+    log_startup_phase("server")
+    last = startup_time
+    for phase, t in startup_phases:
+        logging.info(f"Startup phase {phase}: {(t - last) * 1000:.1f} ms")
+        last = t
+    logging.info(f"Startup total: {(last - startup_time) * 1000:.1f} ms")
+    if settings.control_loop_thread:
+        control_loop.start(settings.control_loop_uvloop)
 
 
 @app.on_event("shutdown")
 async def app_shutdown():
-    await coyote.stop_coyote()
+    try:
+        await coyote.stop_coyote()
+    finally:
+        control_loop.stop()
+        await persistence.flush()
 
 
 @app.get("/health")
@@ -29,22 +80,32 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Latency histograms and counters of the control pipeline, in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        metrics.registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
 @app.get("/settings")
 async def get_settings() -> Settings:
     return settings
 
 
-import webview
-
+def run_webview(port: int):
+    import webview
 
-def run_webview():
     webview.create_window(
-        "OSC Toys", "http://localhost:38080/index.html", width=1920, height=1080
+        "OSC Toys", f"http://localhost:{port}/index.html", width=1920, height=1080
     )
-    webview.start(http_port=38080)
+    webview.start(http_port=port)
 
 
 if __name__ == "__main__":
-    process = multiprocessing.Process(target=run_webview)
-    process.start()
-    uvicorn.run(app, port=38080)
+    if not args.headless:
+        process = multiprocessing.Process(target=run_webview, args=(args.port,))
+        process.start()
+    uvicorn.run(app, port=args.port)
@@ -1,11 +1,30 @@
 from fastapi import APIRouter, HTTPException, status
 import asyncio
-from typing import List
+import hashlib
+import logging
+import os
 
 from pydantic import BaseModel
-from settings import settings
+from settings import RouteSettings, persistence, settings
+from typing import List, NamedTuple
 import time
+from common import metrics
+from common.control_loop import control_loop
+from common.curves import CURVE_KINDS, TransferCurve, build_curve
+from common.osc_fast import FastOSCProtocol
+from common.osc_log import OscRecorder, VirtualClock, log_path, read_log, replay
+from common.osc_routing import (
+    COMBINE_MAX,
+    COMBINE_MODES,
+    COMBINE_SUM,
+    PatternTrie,
+    check_pattern,
+    is_pattern,
+)
+from common.filters import FILTER_KINDS, FILTER_MOVING_AVERAGE, build_filter
 from toys.estim.coyote.dg_interface import CoyoteInterface
+from toys.estim.coyote.dg_registry import DeviceRegistry, create_interface
+from toys.estim.coyote.dg_worker import CoyoteWorkerClient
 from pythonosc.dispatcher import Dispatcher
 from pythonosc import osc_server
 from fastapi import BackgroundTasks
@@ -14,184 +33,706 @@ from fastapi import BackgroundTasks
 router = APIRouter(prefix="/api/coyote")
 
 
-ci = CoyoteInterface(
-    device_uid=settings.coyote_uid, power_multiplier=1.28, safe_mode=True
-)
+# Created on first use by get_interface() or ensure_interface(), so that bleak and the patterns are not loaded before
+# the server is up.
+ci = None
+# All the devices, `ci` being the primary one; the additional devices are registered by get_registry().
+registry = DeviceRegistry()
+devices_loaded = False
 
 transport = None
+# The fast path protocol of the OSC listener, None if it is not running or `osc_fast_path` is off.
+protocol = None
+recorder = OscRecorder()
+# Number of logs being replayed, the live OSC messages are not routed meanwhile (see replay_log()).
+replaying = 0
+# Monotonic time at which the datagram being dispatched was received, None outside of TimedDispatcher.
+received_at = None
 
+# Input of every OSC address seen {address: Input}, see configure_filters()
+inputs = {}
+# Snapshot of the configuration read by the OSC handler, see ControlConfig. Replaced as a whole, never modified.
+config = None
+# Addresses which are not routed are remembered as such, up to this number of addresses.
+MAX_UNROUTED_ADDRESSES = 4096
 
-async def start_channel_a():
-    print(ci.patterns[settings.coyote_pattern_a])
-    await ci.signal(
-        power=int(settings.coyote_max_power_a * settings.min_power),
-        pattern_name=settings.coyote_pattern_a,
-        duration=100000000,
-        channel="a",
+
+class Input:
+    """
+    An OSC address mapped to channels. Kept when the routing table is rebuilt, so that the filter and the state of the
+    address do not depend on the other routes.
+
+    Attributes:
+        params (dict): Settings of the filter, see filter_params().
+        input_filter: Filter of the values of the address, shared by all the channels.
+        active (bool): Whether the last value received was above the dead zone.
+    """
+
+    __slots__ = (
+        "params",
+        "input_filter",
+        "active",
+        "messages",
+        "dispatch_latency",
+        "filter_latency",
     )
 
+    def __init__(self, address: str, params: dict):
+        self.params = params
+        options = dict(params)
+        self.input_filter = build_filter(
+            options.pop("kind"), options.pop("window"), **options
+        )
+        self.active = False
+        self.messages = metrics.osc_messages.labels(address)
+        self.dispatch_latency = metrics.osc_stage(metrics.STAGE_OSC_DISPATCH, address)
+        self.filter_latency = metrics.osc_stage(metrics.STAGE_FILTER, address)
+
+
+class Channel:
+    """
+    A channel of a device, and the inputs combined into its power.
+
+    Attributes:
+        curve (TransferCurve): Transfer curve of the channel.
+        inputs (dict): {Input: weight} of every address mapped to the channel.
+        active (dict): {Input: weight} of the active inputs only, so that combining them does not depend on the number
+            of inputs mapped to the channel.
+    """
+
+    __slots__ = (
+        "interface",
+        "channel",
+        "max_power",
+        "combine",
+        "curve",
+        "inputs",
+        "active",
+    )
+
+    def __init__(
+        self,
+        interface: CoyoteInterface,
+        channel: str,
+        max_power: int,
+        combine: str,
+        curve: TransferCurve,
+    ):
+        self.interface = interface
+        self.channel = channel
+        self.max_power = max_power
+        self.combine = combine
+        self.curve = curve
+        self.inputs = {}
+        self.active = {}
+
+    def update(self, input_state: Input):
+        """
+        Follow the activity of an input, must be called whenever it changes.
+        """
+        if input_state.active:
+            self.active[input_state] = self.inputs[input_state]
+        else:
+            self.active.pop(input_state, None)
+
+    def value(self, now: float) -> float:
+        """
+        Combine the filtered values of the active inputs, None if no input is active.
+        """
+        combine = self.combine
+        result = None
+        weights = 0.0
+        for input_state, weight in self.active.items():
+            value = input_state.input_filter.value(now) * weight
+            weights += weight
+            if result is None:
+                result = value
+            elif combine == COMBINE_MAX:
+                if value > result:
+                    result = value
+            else:
+                result += value
+        if result is None or combine == COMBINE_MAX:
+            return result
+        if combine == COMBINE_SUM:
+            return min(result, 1.0)
+        return result / weights if weights > 0 else 0.0
+
+
+class Route:
+    """
+    The channels fed by an OSC address.
+    """
+
+    __slots__ = ("input", "targets")
+
+    def __init__(self, input_state: Input):
+        self.input = input_state
+        self.targets = []
+
+    def add(self, target: Channel, weight: float):
+        if target not in self.targets:
+            self.targets.append(target)
+            target.inputs[self.input] = weight
+            target.update(self.input)
+
+
+class RoutingTable(dict):
+    """
+    OSC routing table {address: Route}.
+
+    The exact addresses are routed when the table is built. Any other address is matched against the patterns on its
+    first message, and its Route, or None if it is not routed, is then added to the dict: after the first message,
+    routing any address is a single dict lookup. Only the thread of the control loop adds addresses.
+    """
+
+    def __init__(self, input_states: dict):
+        """
+        :param input_states: Inputs of the addresses {address: Input}, shared with the previous tables.
+        """
+        super().__init__()
+        self.patterns = PatternTrie()
+        self.input_states = input_states
+
+    def route(self, address: str) -> Route:
+        """Get the route of an address, creating it."""
+        route = self.get(address)
+        if route is None:
+            route = self[address] = Route(get_input(address, self.input_states))
+        return route
+
+    def route_patterns(self, address: str) -> Route:
+        """
+        Route an address to the channels of the patterns it matches.
+
+        :return: The route, None if the address is not routed.
+        """
+        matches = self.patterns.match(address) if self.patterns else ()
+        if not matches:
+            return self.get(address)
+        route = self.route(address)
+        for target, weight in matches:
+            route.add(target, weight)
+        return route
+
+    def __missing__(self, address: str) -> Route:
+        route = self.route_patterns(address)
+        if route is None and len(self) < MAX_UNROUTED_ADDRESSES:
+            self[address] = None
+        return route
+
+    def is_routed(self, address: str) -> bool:
+        return self[address] is not None
+
+
+class ControlConfig(NamedTuple):
+    """
+    Snapshot of everything the OSC handler reads: the routing table, whose routes hold the input filters and whose
+    channels hold their transfer curve, and the address of the OSC listener.
+
+    A change of settings builds a new snapshot and publishes it by assigning `config` (see publish()), while the
+    handler reads `config` once per message: every message is handled entirely with the old or the new configuration,
+    without any lock, and the devices keep playing. Only the cache of the addresses resolved through the patterns
+    grows in a published routing table.
+    """
+
+    routes: RoutingTable
+    # {"a": TransferCurve, "b": TransferCurve}
+    curves: dict
+    # (host, port) of the OSC listener
+    osc_address: tuple
+
 
-async def start_channel_b():
+def get_interface() -> CoyoteInterface:
+    """
+    Get the primary device, creating it on first use. Runs on the control loop, the routes use ensure_interface().
+    """
+    if ci is None:
+        set_interface(create_interface(settings.coyote_uid))
+    return ci
+
+
+async def ensure_interface() -> CoyoteInterface:
+    """
+    Get the primary device from a route, creating it on first use. The interface is created on the calling loop, as
+    it loads the patterns, and installed on the control loop.
+    """
+    if ci is None:
+        await control_loop.call(adopt_interface, create_interface(settings.coyote_uid))
+    return ci
+
+
+def adopt_interface(interface: CoyoteInterface):
+    """
+    Install an interface created beforehand as the primary device, unless one was installed meanwhile. Runs on the
+    control loop.
+    """
+    if ci is None:
+        set_interface(interface)
+
+
+def set_interface(interface: CoyoteInterface):
+    """
+    Replace the primary device. Runs on the control loop.
+    """
+    global ci
+    ci = interface
+    registry.set_primary(ci)
+    configure_routes()
+
+
+def get_registry() -> DeviceRegistry:
+    """
+    Get the registry of all the devices, registering the ones of `settings.coyote_devices` on first use. Runs on the
+    control loop, the routes use ensure_registry().
+    """
+    global devices_loaded
+    get_interface()
+    if not devices_loaded:
+        devices_loaded = True
+        for config in settings.coyote_devices:
+            registry.add(config)
+        configure_routes()
+    return registry
+
+
+async def ensure_registry() -> DeviceRegistry:
+    """
+    Get the registry of all the devices from a route, see get_registry().
+    """
+    await ensure_interface()
+    if not devices_loaded:
+        await control_loop.call(get_registry)
+    return registry
+
+
+async def start_channels():
+    print(ci.patterns[settings.coyote_pattern_a])
     print(ci.patterns[settings.coyote_pattern_b])
-    await ci.signal(
-        power=int(settings.coyote_max_power_b * settings.min_power),
-        pattern_name=settings.coyote_pattern_b,
+    await ci.play(
+        pow_a=int(settings.coyote_max_power_a * settings.min_power),
+        pow_b=int(settings.coyote_max_power_b * settings.min_power),
+        patterns={"a": settings.coyote_pattern_a, "b": settings.coyote_pattern_b},
         duration=100000000,
-        channel="b",
     )
 
 
+class TimedDispatcher(Dispatcher):
+    """
+    Dispatcher which stamps the time at which every datagram was received, for the latency metrics of the handlers.
+    """
+
+    def call_handlers_for_packet(self, data: bytes, client_address):
+        global received_at
+        # Keep the stamp of TimedOSCProtocol when called as its fallback.
+        outer = received_at
+        if outer is None:
+            received_at = time.monotonic()
+        try:
+            super().call_handlers_for_packet(data, client_address)
+        finally:
+            received_at = outer
+
+
+class TimedOSCProtocol(FastOSCProtocol):
+    """
+    FastOSCProtocol which stamps the time at which every datagram was received, like TimedDispatcher.
+    """
+
+    def datagram_received(self, data: bytes, addr):
+        global received_at
+        received_at = time.monotonic()
+        try:
+            super().datagram_received(data, addr)
+        finally:
+            received_at = None
+
+
+def build_dispatcher(record: bool = True) -> Dispatcher:
+    """
+    Pass every OSC message to the router, which looks the address up in the routing table, so that the dispatcher
+    does not need to be rebuilt when devices or addresses change.
+
+    :param record: Also pass every message to the OSC recorder.
+    """
+    dispatcher = TimedDispatcher()
+    dispatcher.set_default_handler(record_and_route if record else osc_handler)
+    return dispatcher
+
+
+def record_and_route(addr, *args):
+    recorder.handler(addr, *args)
+    if not replaying:
+        osc_handler(addr, *args)
+
+
 async def serve_osc():
-    global transport
-    dispatcher = Dispatcher()
-    dispatcher.map(settings.coyote_addr_a, coyote_handler_a, "A")
-    dispatcher.map(settings.coyote_addr_b, coyote_handler_b, "B")
-    server = osc_server.AsyncIOOSCUDPServer(
-        (settings.vrc_host, settings.vrc_osc_port), dispatcher, asyncio.get_event_loop()
-    )
-    transport, _ = await server.create_serve_endpoint()
+    """
+    Start the OSC listener on the running loop, i.e. the control loop.
+
+    With `osc_fast_path`, the datagrams are received by TimedOSCProtocol, which only decodes the messages of the routed
+    addresses and hands anything unusual to the python-osc dispatcher.
+    """
+    global transport, protocol
+    loop = asyncio.get_running_loop()
+    address = config.osc_address
+    dispatcher = build_dispatcher()
+    if settings.osc_fast_path:
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: TimedOSCProtocol(
+                record_and_route, dispatcher.call_handlers_for_packet
+            ),
+            local_addr=address,
+        )
+        subscribe_osc()
+    else:
+        server = osc_server.AsyncIOOSCUDPServer(address, dispatcher, loop)
+        transport, _ = await server.create_serve_endpoint()
+        protocol = None
     print(transport)
 
 
-param_queue_a = []
-param_queue_b = []
-last_time_a = time.time()
-cur_time_a = time.time()
-last_time_b = time.time()
-cur_time_b = time.time()
-
-
-def get_avg(queue: List[float]) -> float:
-    """
-              ▲
-              │
-              │
-              │                max_limit
-          1.0 │               xx───────
-              │              xx
-              │             xx
-              │            xx
-              │           xx
-              │          xx
-    min_power │   ┌─────xx
-              │   │       min_limit
-              └───┴──────────────────────────►
-              start_limit
-    """
-    s = 0.0
-    for x in queue:
-        s += x
-    s /= len(queue)
-    if s <= settings.min_limit:
-        # map [START_LIMIT, MIN_LIMIT] to MIN_OOWER
-        s = settings.min_power
-    elif s >= settings.min_limit:
-        # map [MAX_LIMIT, 1] to 1
-        s = 1
-    else:
-        # map [MIN_LIMIT, MAX_LIMIT] to [MIN_POWER, 1]
-        s = (s - settings.min_limit) / (settings.max_limit - settings.min_limit) * (
-            1 - settings.min_power
-        ) + settings.min_power
-    return s
+def subscribe_osc():
+    """
+    Subscribe the fast path to the routed addresses, and to all the addresses while recording. Must be called whenever
+    the routes change or the recorder starts or stops.
+    """
+    if protocol is not None:
+        table = config.routes
+        protocol.subscribe(
+            [addr for addr, route in table.items() if route is not None],
+            table.is_routed,
+        )
+        protocol.accept_all = recorder.active
 
 
-def coyote_handler_a(addr, args, dis):
+async def ensure_osc_server():
+    """
+    Start the OSC listener unless it is running, it is shared by all the devices.
     """
-    This function will calculate the avarage value of values from OSC
-    within 1 second, and then set the power of the channel A by the result.
+    if transport is None or transport.is_closing():
+        await serve_osc()
+
+
+def close_osc_server():
+    if transport is not None:
+        transport.close()
+
+
+async def configure_osc_server():
     """
-    global param_queue_a, last_time_a, cur_time_a
-    cur_time_a = time.time()
-    # print("A: [{0}] ~ {1}".format(addr, dis))
+    Publish the address of the OSC listener from `settings.vrc_host` and `settings.vrc_osc_port`, and move the
+    listener there if it is running. The socket is only rebound if the address actually changed, and the devices keep
+    playing meanwhile. Runs on the control loop.
 
-    if dis < 0.1:
-        loop = asyncio.get_event_loop()
-        asyncio.ensure_future(ci.set_pwm(1, -1), loop=loop)
+    :raise OSError: The new address cannot be bound, the listener is then back on the previous one.
+    """
+    address = (settings.vrc_host, int(settings.vrc_osc_port))
+    previous = config.osc_address
+    if address == previous:
         return
-    if cur_time_a - last_time_a > settings.window_size:
-        last_time_a = time.time()
-        if len(param_queue_a) == 0 or not settings.can_update_power:
-            param_queue_a.append(dis)
-            return
-        s = get_avg(param_queue_a)
-        loop = asyncio.get_event_loop()
-        if s < 0.1:
-            asyncio.ensure_future(ci.set_pwm(1, -1), loop=loop)
-        else:
-            asyncio.ensure_future(
-                ci.set_pwm(int(settings.coyote_max_power_a * s), -1), loop=loop
-            )
-        param_queue_a = []
-    else:
-        param_queue_a.append(dis)
+    publish(config._replace(osc_address=address))
+    if transport is None or transport.is_closing():
+        return
+    close_osc_server()
+    # The socket is closed on the next iteration of the loop.
+    await asyncio.sleep(0)
+    try:
+        await serve_osc()
+    except OSError:
+        publish(config._replace(osc_address=previous))
+        await serve_osc()
+        raise
+
+
+async def replay_log(path: str, speed: float = 0, requests: list = None) -> dict:
+    """
+    Feed a recorded OSC log through the channel handlers, into the devices.
+
+    The log is routed through its own copy of the routing table, whose filters start empty and see the recorded time
+    instead of the wall clock, and the live OSC messages are not routed meanwhile (they are still recorded). Every
+    power requested by the handlers is collected before the device decides whether to apply it, so replaying a log
+    always gives the same power requests, whatever the state of the device, the replay speed or the other tasks of the
+    loop. Runs on the control loop.
+
+    :param path: Path of the log.
+    :param speed: 1 for real time, N for N times faster, 0 for as fast as possible.
+    :param requests: List to which the power requests are appended, as (time, device uid, channel, power).
+    :return: messages: number of messages replayed, requests: number of power requests, digest: hash of the requests
+    """
+    global replaying
+    if requests is None:
+        requests = []
+    table = build_routes(config.curves, {})
+    clock = VirtualClock()
+
+    def request(target: Channel, power: int):
+        requests.append((clock.now, target.interface.device_uid, target.channel, power))
+        request_power(target, power)
+
+    def dispatch(address: str, value: float):
+        route = table[address]
+        if route is not None:
+            route_value(route, value, clock.now, request)
+
+    replaying += 1
+    try:
+        count = await replay(read_log(path), dispatch, speed, clock)
+    finally:
+        replaying -= 1
+    return {
+        "messages": count,
+        "requests": len(requests),
+        "digest": hashlib.sha256(repr(requests).encode()).hexdigest()[:16],
+    }
+
 
+def filter_params(addr: str) -> dict:
+    """
+    Settings of the input filter of an OSC address from `settings.input_filters`.
+
+    Addresses without a filter of their own use a moving average over `window_size` seconds.
+    """
+    return {
+        "kind": FILTER_MOVING_AVERAGE,
+        "window": settings.window_size,
+        **settings.input_filters.get(addr, {}),
+    }
 
-def coyote_handler_b(addr, args, dis):
+
+def get_input(addr: str, input_states: dict = None) -> Input:
     """
-    This function will calculate the avarage value of values from OSC
-    within 1 second, and then set the power of the channel B by the result.
+    Get the input of an address, creating it.
+
+    :param input_states: {address: Input} to look the address up in, defaults to the inputs of the live routing table.
     """
-    global param_queue_b, last_time_b, cur_time_b
-    cur_time_b = time.time()
-    # print("B: [{0}] ~ {1}".format(addr, dis))
+    if input_states is None:
+        input_states = inputs
+    input_state = input_states.get(addr)
+    if input_state is None:
+        input_state = input_states[addr] = Input(addr, filter_params(addr))
+    return input_state
+
 
-    if dis < 0.1:
-        loop = asyncio.get_event_loop()
-        asyncio.ensure_future(ci.set_pwm(-1, 1), loop=loop)
+def configure_filters():
+    """
+    Recreate the input filters whose settings changed and publish them, must be called whenever the filter settings
+    change. The other filters keep their state, and so do the moving averages of which only the window changed.
+    """
+    global inputs
+    rebuilt = {}
+    for addr, input_state in inputs.items():
+        params = filter_params(addr)
+        previous = input_state.params
+        if params != previous:
+            if params["kind"] == FILTER_MOVING_AVERAGE and previous == {
+                **params,
+                "window": previous["window"],
+            }:
+                input_state.input_filter.resize(params["window"])
+                input_state.params = params
+            else:
+                input_state = Input(addr, params)
+        rebuilt[addr] = input_state
+    inputs = rebuilt
+    configure_routes()
+
+
+def build_routes(curves: dict, input_states: dict = None) -> RoutingTable:
+    """
+    Build the OSC routing table from the registered devices and `settings.osc_routes`. The inputs of the addresses
+    already routed are kept.
+
+    :param curves: Transfer curves of the channels {"a": TransferCurve, "b": TransferCurve}.
+    :param input_states: {address: Input} of the table, defaults to the inputs of the live routing table.
+    """
+    table = RoutingTable(inputs if input_states is None else input_states)
+    for interface, channel, max_power, combine, channel_inputs in registry.channels():
+        target = Channel(interface, channel, max_power, combine, curves[channel])
+        for addr, weight in channel_inputs:
+            if not addr:
+                continue
+            if not is_pattern(addr):
+                table.route(addr).add(target, weight)
+                continue
+            try:
+                table.patterns.add(addr, (target, weight))
+            except ValueError as e:
+                logging.error(f"Ignoring the OSC route {addr}: {e}")
+    for addr in list(table):
+        table.route_patterns(addr)
+    return table
+
+
+def publish(snapshot: ControlConfig):
+    """
+    Make a new configuration snapshot current, the OSC handler picks it up from the next message. Runs on the control
+    loop.
+    """
+    global config
+    config = snapshot
+    subscribe_osc()
+
+
+def configure_routes():
+    """
+    Rebuild the OSC routing table and publish it, must be called whenever the addresses, max power, combine modes or
+    routes of the devices change.
+    """
+    publish(config._replace(routes=build_routes(config.curves)))
+
+
+def compile_curve(channel: str, kind: str = None, points: list = None) -> TransferCurve:
+    """
+    Compile the transfer curve of a channel from the settings.
+
+    :param channel: "a" or "b".
+    :param kind: Kind of the curve, defaults to the one set for the channel.
+    :param points: Control points of a "points" curve, default to the ones set for the channel.
+    """
+    return build_curve(
+        kind or getattr(settings, "coyote_curve_" + channel),
+        settings.start_limit,
+        settings.min_limit,
+        settings.max_limit,
+        settings.min_power,
+        rate=settings.curve_rate,
+        steepness=settings.curve_steepness,
+        points=points or getattr(settings, "coyote_curve_points_" + channel),
+    )
+
+
+def compile_curves() -> dict:
+    """
+    Compile the transfer curves of both channels from the settings.
+
+    :return: {"a": TransferCurve, "b": TransferCurve}
+    """
+    return {"a": compile_curve("a"), "b": compile_curve("b")}
+
+
+def configure_curves():
+    """
+    Recompile the transfer curves and publish them, must be called whenever their settings change.
+    """
+    curves = compile_curves()
+    publish(config._replace(curves=curves, routes=build_routes(curves)))
+
+
+def get_avg(input_filter, curve: TransferCurve, now: float = None) -> float:
+    """
+    Map the filtered input to a power rate through the transfer curve.
+    """
+    return curve(input_filter.value(now))
+
+
+curves = compile_curves()
+config = ControlConfig(
+    build_routes(curves), curves, (settings.vrc_host, int(settings.vrc_osc_port))
+)
+del curves
+
+
+def osc_handler(addr, *args):
+    """
+    This function will filter the values of an OSC address, and then set the power of every channel mapped to the
+    address, on every device, by the combined inputs of the channel.
+    The power schedulers coalesce the requests, so the power follows the filter without further throttling.
+    """
+    route = config.routes[addr]
+    if route is None or not args:
         return
-    if cur_time_b - last_time_b > settings.window_size:
-        last_time_b = time.time()
-        if len(param_queue_b) == 0 or not settings.can_update_power:
-            param_queue_b.append(dis)
-            return
-        s = get_avg(param_queue_b)
-        loop = asyncio.get_event_loop()
-        if s < 0.1:
-            asyncio.ensure_future(ci.set_pwm(-1, 1), loop=loop)
+    input_state = route.input
+    start = time.monotonic()
+    input_state.messages.inc()
+    if received_at is not None:
+        input_state.dispatch_latency.record(start - received_at)
+    route_value(route, args[0], start, request_power)
+    input_state.filter_latency.record(time.monotonic() - start)
+
+
+def route_value(route: Route, value: float, now: float, request):
+    """
+    Filter a value of a routed address, and request the power of every channel fed by the address from the combined
+    inputs of the channel.
+
+    :param now: Monotonic time of the value.
+    :param request: Function called as request(Channel, power).
+    """
+    input_state = route.input
+    active = value >= 0.1
+    if active is not input_state.active:
+        input_state.active = active
+        for target in route.targets:
+            target.update(input_state)
+    if active:
+        input_state.input_filter.push(value, now)
+    for target in route.targets:
+        combined = target.value(now)
+        if combined is None:
+            request(target, 1)
         else:
-            asyncio.ensure_future(
-                ci.set_pwm(-1, int(settings.coyote_max_power_b * s)), loop=loop
-            )
-        param_queue_b = []
+            s = target.curve(combined)
+            request(target, 1 if s < 0.1 else int(target.max_power * s))
+
+
+def request_power(target: Channel, power: int):
+    """
+    Request the power of a channel. Powers above the minimum are ignored while the pattern player does not let the
+    power be updated, see CoyoteInterface.can_update_power.
+    """
+    interface = target.interface
+    if power > 1 and not interface.can_update_power:
+        return
+    if target.channel == "a":
+        interface.request_pwm(power, -1, received_at)
     else:
-        param_queue_b.append(dis)
+        interface.request_pwm(-1, power, received_at)
 
 
 async def main():
-    await asyncio.gather(start_channel_a(), start_channel_b(), serve_osc())
+    await asyncio.gather(start_channels(), ensure_osc_server())
     # await ci.stop()
     # await ci.disconnect()
 
 
+async def connect_coyote():
+    if ci.device is None:
+        await ci.search_for_device()
+    await ci.connect(retries=3)
+
+
+async def disconnect_coyote():
+    await ci.stop()
+    await ci.disconnect()
+    # The OSC listener keeps feeding the other devices
+    if not any(device.is_connected for device in registry):
+        close_osc_server()
+
+
 class StartRequest(BaseModel):
     uid: str
 
 
 @router.post("/start")
 async def start_coyote(req: StartRequest, background_tasks: BackgroundTasks):
-    global ci
     if ci is not None and ci.is_connected:
         return {"msg": "already started"}
     settings.coyote_uid = req.uid
-    settings.dump()
-    ci = CoyoteInterface(
-        device_uid=settings.coyote_uid, power_multiplier=1.28, safe_mode=True
-    )
-    if ci.device is None:
-        await ci.search_for_device()
-    await ci.connect(retries=3)
-    background_tasks.add_task(main)
+    persistence.mark_dirty()
+    # Created here, as it loads the patterns, and installed on the control loop which owns the routing table.
+    interface = create_interface(settings.coyote_uid)
+    await control_loop.call(set_interface, interface)
+    await control_loop.run(connect_coyote())
+    background_tasks.add_task(control_loop.run, main())
     return {"msg": "starting"}
 
 
 @router.get("/stop")
 async def stop_coyote():
-    if not ci.is_connected:
+    if ci is None or not ci.is_connected:
         return {"msg": "not started"}
-    await ci.stop()
-    await ci.disconnect()
-    transport.close()
+    await control_loop.run(disconnect_coyote())
     return {"msg": "stopping"}
 
 
@@ -206,6 +747,7 @@ async def update_max_power(req: UpdatePowerRequest):
     Set the max_power of the channel A and B.
     """
     try:
+        ci = await ensure_interface()
         if settings.coyote_max_power_a != 0:
             percentage_a = ci.pow_a / settings.coyote_max_power_a
         else:
@@ -216,8 +758,11 @@ async def update_max_power(req: UpdatePowerRequest):
             percentage_b = 0.5
         settings.coyote_max_power_a = req.pow_a
         settings.coyote_max_power_b = req.pow_b
-        await ci.set_pwm(int(percentage_a * req.pow_a), int(percentage_b * req.pow_b))
-        settings.dump()
+        await control_loop.call(configure_routes)
+        await control_loop.call(
+            ci.request_pwm, int(percentage_a * req.pow_a), int(percentage_b * req.pow_b)
+        )
+        persistence.mark_dirty()
         return {"msg": "success"}
     except Exception as e:
         raise HTTPException(
@@ -249,17 +794,13 @@ class UpdateOscAddrRequest(BaseModel):
 @router.post("/osc_addr")
 async def update_osc_addr(req: UpdateOscAddrRequest):
     """
-    Set the osc param address of the channel A and B.
+    Set the osc param address of the channel A and B, the device keeps playing.
     """
-    if ci.is_connected:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Please stop the device first.",
-        )
     try:
         settings.coyote_addr_a = req.addr_a
         settings.coyote_addr_b = req.addr_b
-        settings.dump()
+        await control_loop.call(configure_routes)
+        persistence.mark_dirty()
         return {"msg": "success"}
     except Exception as e:
         raise HTTPException(
@@ -290,7 +831,7 @@ async def get_patterns():
     """
     try:
         return {
-            "patterns": list(ci.patterns.keys()),
+            "patterns": list((await ensure_interface()).patterns.keys()),
         }
     except Exception as e:
         raise HTTPException(
@@ -309,14 +850,14 @@ async def update_pattern(req: UpdatePatternRequest):
     Set the pattern of the device.
     """
     try:
+        ci = await ensure_interface()
         if req.pattern_a in ci.patterns.keys():
             settings.coyote_pattern_a = req.pattern_a
-            ci.pattern_name_a = req.pattern_a
+            await control_loop.call(ci.switch_pattern, "a", req.pattern_a)
         if req.pattern_b in ci.patterns.keys():
             settings.coyote_pattern_b = req.pattern_b
-            ci.pattern_name_b = req.pattern_b
-        ci.switch_pattern = True
-        settings.dump()
+            await control_loop.call(ci.switch_pattern, "b", req.pattern_b)
+        persistence.mark_dirty()
         return {"msg": "success"}
     except Exception as e:
         raise HTTPException(
@@ -340,6 +881,311 @@ async def get_pattern() -> UpdatePatternRequest:
         )
 
 
+class UpdateCurveRequest(BaseModel):
+    channel: str
+    kind: str
+    points: list = None
+
+
+# Largest number of samples of a curve returned by the API.
+MAX_CURVE_SAMPLES = 1024
+
+
+def check_curve_request(req: UpdateCurveRequest) -> TransferCurve:
+    """
+    Compile the curve of a request.
+
+    :raise HTTPException: 400 if the channel, the kind or the control points are invalid.
+    """
+    if req.channel not in ("a", "b") or req.kind not in CURVE_KINDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Expected channel a or b and a curve in {CURVE_KINDS}",
+        )
+    try:
+        return compile_curve(req.channel, req.kind, req.points)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid control points: {e}",
+        )
+
+
+def check_curve_samples(samples: int):
+    """
+    :raise HTTPException: 400 if the number of samples of a curve is out of range.
+    """
+    if not 2 <= samples <= MAX_CURVE_SAMPLES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Expected between 2 and {MAX_CURVE_SAMPLES} samples",
+        )
+
+
+@router.post("/curve")
+async def update_curve(req: UpdateCurveRequest):
+    """
+    Set the transfer curve of a channel.
+    """
+    # Compile first, so that invalid control points are rejected before being saved.
+    check_curve_request(req)
+    try:
+        setattr(settings, "coyote_curve_" + req.channel, req.kind)
+        if req.points:
+            setattr(settings, "coyote_curve_points_" + req.channel, req.points)
+        await control_loop.call(configure_curves)
+        persistence.mark_dirty()
+        return {"msg": "success"}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@router.get("/curve")
+async def get_curve(samples: int = 101):
+    """
+    Get the transfer curves of both channels, sampled at `samples` evenly spaced inputs.
+    """
+    check_curve_samples(samples)
+    try:
+        curves = config.curves
+        return {
+            channel: {"kind": curve.kind, "samples": curve.sample(samples)}
+            for channel, curve in curves.items()
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@router.post("/curve/preview")
+async def preview_curve(req: UpdateCurveRequest, samples: int = 101):
+    """
+    Sample a transfer curve without applying it.
+    """
+    check_curve_samples(samples)
+    curve = check_curve_request(req)
+    try:
+        return {"kind": curve.kind, "samples": curve.sample(samples)}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+class UpdateFilterRequest(BaseModel):
+    addr: str
+    kind: str
+    window: float = None
+    min_cutoff: float = 1.0
+    beta: float = 0.0
+    d_cutoff: float = 1.0
+
+
+@router.post("/filter")
+async def update_filter(req: UpdateFilterRequest):
+    """
+    Set the input filter of an OSC address.
+    """
+    if req.kind not in FILTER_KINDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Expected a filter in {FILTER_KINDS}",
+        )
+    try:
+        params = {"kind": req.kind}
+        if req.window is not None:
+            params["window"] = req.window
+        if req.kind == "one_euro":
+            params.update(
+                min_cutoff=req.min_cutoff, beta=req.beta, d_cutoff=req.d_cutoff
+            )
+        settings.input_filters = {**settings.input_filters, req.addr: params}
+        await control_loop.call(configure_filters)
+        persistence.mark_dirty()
+        return {"msg": "success"}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+def filter_states() -> dict:
+    """The input filters of both channels and the latency (in seconds) they add."""
+    return {
+        channel: {
+            "addr": addr,
+            "kind": settings.input_filters.get(addr, {}).get(
+                "kind", FILTER_MOVING_AVERAGE
+            ),
+            "latency": get_input(addr).input_filter.latency,
+        }
+        for channel, addr in (
+            ("a", settings.coyote_addr_a),
+            ("b", settings.coyote_addr_b),
+        )
+    }
+
+
+@router.get("/filters")
+async def get_filters():
+    """
+    Get the input filters of both channels and the latency (in seconds) they add.
+    """
+    try:
+        # The inputs belong to the control loop
+        return await control_loop.call(filter_states)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+class UpdateRoutesRequest(BaseModel):
+    routes: List[RouteSettings]
+    combine_a: str = None
+    combine_b: str = None
+
+
+@router.post("/routes")
+async def update_routes(req: UpdateRoutesRequest):
+    """
+    Replace the additional OSC routes (`osc_routes`), and set the combine mode of the channels if given. The routing
+    table is rebuilt and swapped at once, without stopping the devices.
+    """
+    for route in req.routes:
+        if route.channel not in ("a", "b"):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unknown channel {route.channel} of {route.address}",
+            )
+        if route.weight < 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Negative weight of {route.address}",
+            )
+        try:
+            check_pattern(route.address)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    for combine in (req.combine_a, req.combine_b):
+        if combine is not None and combine not in COMBINE_MODES:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Expected a combine mode in {COMBINE_MODES}",
+            )
+    try:
+        settings.osc_routes = req.routes
+        if req.combine_a is not None:
+            settings.coyote_combine_a = req.combine_a
+        if req.combine_b is not None:
+            settings.coyote_combine_b = req.combine_b
+        await control_loop.call(configure_routes)
+        persistence.mark_dirty()
+        return {"msg": "success"}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@router.get("/routes")
+async def get_routes():
+    """
+    Get the additional OSC routes, the combine mode of the channels and the addresses routed so far.
+    """
+    try:
+        return {
+            "routes": settings.osc_routes,
+            "combine_a": settings.coyote_combine_a,
+            "combine_b": settings.coyote_combine_b,
+            "routed": sorted(
+                addr for addr, route in list(config.routes.items()) if route is not None
+            ),
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+def start_recorder(path: str):
+    recorder.start(path)
+    subscribe_osc()
+
+
+def stop_recorder():
+    recorder.stop()
+    subscribe_osc()
+
+
+class RecordRequest(BaseModel):
+    path: str
+
+
+@router.post("/record")
+async def start_recording(req: RecordRequest):
+    """
+    Record the received OSC messages into a log, `path` is relative to `osc_log_dir`.
+    """
+    try:
+        path = log_path(settings.osc_log_dir, req.path)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    try:
+        os.makedirs(settings.osc_log_dir, exist_ok=True)
+        await control_loop.call(start_recorder, path)
+        return {"msg": "success"}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@router.get("/record/stop")
+async def stop_recording():
+    """
+    Stop recording the received OSC messages.
+    """
+    try:
+        path, count = recorder.path, recorder.count
+        await control_loop.call(stop_recorder)
+        return {"path": path, "messages": count}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+class ReplayRequest(BaseModel):
+    path: str
+    speed: float = 1.0
+
+
+@router.post("/replay")
+async def replay_recording(req: ReplayRequest):
+    """
+    Replay a log through the OSC handlers, i.e. into the device, `path` is relative to `osc_log_dir`.
+    """
+    try:
+        path = log_path(settings.osc_log_dir, req.path)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if not os.path.isfile(path):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"No log {req.path}"
+        )
+    try:
+        await ensure_interface()
+        return await control_loop.run(replay_log(path, req.speed))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
 @router.get("/status")
 async def get_status():
     """
@@ -349,13 +1195,15 @@ async def get_status():
         if ci and ci.is_connected:
             return {
                 "is_connected": ci.is_connected,
-                "battery_level": await ci.get_bettery_level(),
+                "battery_level": await control_loop.run(ci.get_bettery_level()),
+                "battery_age": ci.battery_age(),
                 "uid": settings.coyote_uid,
             }
         else:
             return {
                 "is_connected": False,
                 "battery_level": 0,
+                "battery_age": None,
                 "uid": "",
             }
     except Exception as e:
@@ -364,6 +1212,118 @@ async def get_status():
         )
 
 
+@router.get("/stats")
+async def get_stats():
+    """
+    Get the performance counters of the device.
+    """
+    try:
+        ci = await ensure_interface()
+        return {
+            "power": ci.power_scheduler.stats(),
+            "verify": ci.verify_stats(),
+            "playback": ci.player.stats(),
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+def collect_metrics() -> list:
+    """
+    Samples of the counters kept by the devices and their writers, for the /metrics endpoint.
+    """
+    samples = []
+    for device in registry:
+        ci = device.interface
+        scheduler = ci.power_scheduler
+        labels = {"device": device.id}
+        samples += [
+            (
+                "osctoys_connected",
+                "gauge",
+                "Whether the device is connected",
+                labels,
+                int(bool(ci.is_connected)),
+            ),
+            (
+                "osctoys_battery_level",
+                "gauge",
+                "Battery level of the device (%)",
+                labels,
+                ci.battery,
+            ),
+            (
+                "osctoys_power_requests_total",
+                "counter",
+                "Power updates requested",
+                labels,
+                scheduler.requested,
+            ),
+            (
+                "osctoys_power_coalesced_total",
+                "counter",
+                "Power updates replaced by a newer one before being written",
+                labels,
+                scheduler.coalesced,
+            ),
+            (
+                "osctoys_power_dropped_total",
+                "counter",
+                "Power updates which did not result in a write",
+                labels,
+                scheduler.dropped,
+            ),
+            (
+                "osctoys_power_errors_total",
+                "counter",
+                "Power writes which failed",
+                labels,
+                scheduler.errors,
+            ),
+            (
+                "osctoys_verify_mismatches_total",
+                "counter",
+                "Power read-backs different from the written value",
+                labels,
+                ci.verify_mismatches,
+            ),
+            (
+                "osctoys_reconnects_total",
+                "counter",
+                "Reconnections after the device stopped answering",
+                labels,
+                ci.reconnects,
+            ),
+        ]
+        samples += [
+            (
+                "osctoys_pattern_overruns_total",
+                "counter",
+                "Pattern states written more than a state late",
+                {**labels, "channel": channel},
+                jitter.overruns,
+            )
+            for channel, jitter in ci.player.jitter.items()
+        ]
+        if isinstance(ci, CoyoteWorkerClient):
+            samples.append(
+                (
+                    "osctoys_worker_restarts_total",
+                    "counter",
+                    "Restarts of the bluetooth worker process of the device",
+                    labels,
+                    ci.restarts,
+                )
+            )
+    # Group the samples by name, as expected by the text format.
+    return sorted(samples, key=lambda sample: sample[0])
+
+
+metrics.registry.add_collector(collect_metrics)
+
+
 @router.get("/uid")
 async def get_uid():
     """
@@ -0,0 +1,294 @@
+from fastapi import APIRouter, HTTPException, status
+
+from pydantic import BaseModel
+from common.control_loop import control_loop
+from common.osc_routing import COMBINE_MODES
+from routers import coyote
+from settings import DeviceSettings, persistence, settings
+from toys.estim.coyote.dg_registry import CoyoteDevice
+
+
+router = APIRouter(prefix="/api/devices")
+
+
+async def get_device(device_id: str) -> CoyoteDevice:
+    registry = await coyote.ensure_registry()
+    device = await control_loop.call(registry.get, device_id)
+    if device is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Unknown device {device_id}",
+        )
+    return device
+
+
+async def start_devices(devices: list = None) -> dict:
+    """
+    Connect to the devices in parallel, and start the playback of the ones which connected. Runs on the control loop.
+
+    :param devices: The devices to start, defaults to all the devices which are not connected.
+    """
+    if devices is None:
+        devices = [device for device in coyote.registry if not device.is_connected]
+    results = await coyote.registry.connect(devices)
+    for device in devices:
+        if device.is_connected:
+            device.start()
+    await coyote.ensure_osc_server()
+    return results
+
+
+async def stop_devices():
+    """
+    Stop all the devices and the OSC listener. Runs on the control loop.
+    """
+    await coyote.get_registry().stop()
+    coyote.close_osc_server()
+
+
+async def stop_device_and_listener(device: CoyoteDevice):
+    """
+    Stop a device, and the OSC listener if no device is left connected. Runs on the control loop.
+    """
+    await device.stop()
+    if not any(device.is_connected for device in coyote.registry):
+        coyote.close_osc_server()
+
+
+def device_statuses() -> list:
+    """The status of every device. Runs on the control loop, which adds and removes the devices."""
+    return [device.status() for device in coyote.registry]
+
+
+def register_device(config: DeviceSettings) -> CoyoteDevice:
+    """
+    Register an additional device and route its channels. Runs on the control loop.
+
+    :raise ValueError: See DeviceRegistry.add().
+    """
+    device = coyote.registry.add(config)
+    settings.coyote_devices = [*settings.coyote_devices, config]
+    coyote.configure_routes()
+    return device
+
+
+def unregister_device(device: CoyoteDevice):
+    """
+    Unregister a stopped device and remove the routes of its channels. Runs on the control loop.
+    """
+    coyote.registry.remove(device.id)
+    settings.coyote_devices = [
+        config for config in settings.coyote_devices if config is not device.config
+    ]
+    coyote.configure_routes()
+
+
+@router.get("")
+async def get_devices():
+    """
+    Get the status of all the devices.
+    """
+    try:
+        await coyote.ensure_registry()
+        return {"devices": await control_loop.call(device_statuses)}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@router.post("")
+async def add_device(req: DeviceSettings):
+    """
+    Register an additional device.
+    """
+    try:
+        await coyote.ensure_registry()
+        device = await control_loop.call(register_device, req)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    try:
+        persistence.mark_dirty()
+        return device.status()
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@router.post("/start")
+async def start_all():
+    """
+    Connect to all the devices which are not connected, in parallel, and start them.
+    """
+    try:
+        await coyote.ensure_registry()
+        return {"connected": await control_loop.run(start_devices())}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@router.get("/stop")
+async def stop_all():
+    """
+    Stop all the devices and the OSC listener.
+    """
+    try:
+        await control_loop.run(stop_devices())
+        return {"msg": "stopping"}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@router.get("/{device_id}")
+async def get_device_status(device_id: str):
+    """
+    Get the status of a device.
+    """
+    device = await get_device(device_id)
+    try:
+        return device.status()
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@router.delete("/{device_id}")
+async def remove_device(device_id: str):
+    """
+    Stop and unregister an additional device.
+    """
+    device = await get_device(device_id)
+    if device is coyote.registry.primary:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The main device cannot be removed.",
+        )
+    try:
+        await control_loop.run(device.stop())
+        await control_loop.call(unregister_device, device)
+        persistence.mark_dirty()
+        return {"msg": "success"}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@router.post("/{device_id}/start")
+async def start_device(device_id: str):
+    """
+    Connect to a device and start it.
+    """
+    device = await get_device(device_id)
+    try:
+        if device.is_connected:
+            return {"msg": "already started"}
+        connected = await control_loop.run(start_devices([device]))
+        if not connected[device.id]:
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY, detail=device.error
+            )
+        return {"msg": "starting"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@router.get("/{device_id}/stop")
+async def stop_device(device_id: str):
+    """
+    Stop a device, the other devices keep running.
+    """
+    device = await get_device(device_id)
+    try:
+        if not device.is_connected:
+            return {"msg": "not started"}
+        await control_loop.run(stop_device_and_listener(device))
+        return {"msg": "stopping"}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+class UpdateDeviceRequest(BaseModel):
+    name: str = None
+    addr_a: str = None
+    addr_b: str = None
+    max_power_a: int = None
+    max_power_b: int = None
+    pattern_a: str = None
+    pattern_b: str = None
+    combine_a: str = None
+    combine_b: str = None
+
+
+@router.post("/{device_id}/settings")
+async def update_device(device_id: str, req: UpdateDeviceRequest):
+    """
+    Change the settings of a device, the fields left out are not changed. The settings of the main device are the
+    `coyote_*` settings.
+    """
+    device = await get_device(device_id)
+    ci = device.interface
+    for channel in ("a", "b"):
+        pattern = getattr(req, "pattern_" + channel)
+        if pattern is not None and pattern not in ci.patterns:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unknown pattern {pattern}",
+            )
+        combine = getattr(req, "combine_" + channel)
+        if combine is not None and combine not in COMBINE_MODES:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Expected a combine mode in {COMBINE_MODES}",
+            )
+    try:
+        changes = req.dict(exclude_none=True)
+        if device is coyote.registry.primary:
+            changes.pop("name", None)
+            for name, value in changes.items():
+                setattr(settings, "coyote_" + name, value)
+        else:
+            for name, value in changes.items():
+                setattr(device.config, name, value)
+        for channel in ("a", "b"):
+            if "pattern_" + channel in changes:
+                await control_loop.call(
+                    ci.switch_pattern, channel, changes["pattern_" + channel]
+                )
+        await control_loop.call(coyote.configure_routes)
+        persistence.mark_dirty()
+        return device.status()
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@router.get("/{device_id}/stats")
+async def get_device_stats(device_id: str):
+    """
+    Get the performance counters of a device.
+    """
+    ci = (await get_device(device_id)).interface
+    try:
+        return {
+            "power": ci.power_scheduler.stats(),
+            "verify": ci.verify_stats(),
+            "playback": ci.player.stats(),
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, HTTPException, status
 from pydantic import BaseModel
-from routers.coyote import ci
-from settings import settings
+from common.control_loop import control_loop
+from routers import coyote
+from settings import persistence, settings
 
 
 router = APIRouter(prefix="/api/osc_server")
@@ -15,18 +16,26 @@ class OSCAddress(BaseModel):
 @router.post("/address")
 async def update_address(req: OSCAddress):
     """
-    Set the OSC address of the device.
+    Set the OSC address of the device. A running listener is moved to the new address, the devices keep playing.
     """
-    if ci.is_connected:
+    try:
+        port = int(req.port)
+    except ValueError:
+        port = -1
+    if not 0 < port < 65536:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Cannot change the address while connected.",
+            detail=f"Invalid port {req.port}",
         )
+    previous = (settings.vrc_host, settings.vrc_osc_port)
     try:
         settings.vrc_host = req.host
-        settings.vrc_osc_port = req.port
+        settings.vrc_osc_port = port
+        await control_loop.run(coyote.configure_osc_server())
+        persistence.mark_dirty()
         return {"msg": "success"}
     except Exception as e:
+        settings.vrc_host, settings.vrc_osc_port = previous
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
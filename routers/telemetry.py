@@ -0,0 +1,163 @@
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+import asyncio
+import logging
+import time
+
+from common.control_loop import control_loop
+from routers import coyote
+from settings import settings
+
+router = APIRouter(prefix="/api/telemetry")
+
+
+def take_snapshot(now: float, last: dict) -> dict:
+    """
+    Collect the current state of the device and the OSC input. Called on the control loop, which owns that state.
+
+    :param now: Current monotonic time, used to compute the write rates.
+    :param last: State kept between two snapshots by the caller (counters and time of the previous snapshot).
+    """
+    ci = coyote.ci
+    snapshot = {
+        "connected": False,
+        "battery": 0,
+        "pow_a": 0,
+        "pow_b": 0,
+        "pattern_a": None,
+        "pattern_b": None,
+        "input_a": round(
+            coyote.get_input(settings.coyote_addr_a).input_filter.value(), 3
+        ),
+        "input_b": round(
+            coyote.get_input(settings.coyote_addr_b).input_filter.value(), 3
+        ),
+        "power_writes": 0.0,
+        "pattern_writes": 0.0,
+    }
+    if ci is None:
+        return snapshot
+    cursors = ci.player.cursors
+    snapshot.update(
+        {
+            "connected": ci.is_connected,
+            "battery": ci.battery if ci.is_connected else 0,
+            "pow_a": ci.pow_a,
+            "pow_b": ci.pow_b,
+            "pattern_a": cursors["a"].pattern_name if "a" in cursors else None,
+            "pattern_b": cursors["b"].pattern_name if "b" in cursors else None,
+        }
+    )
+    # Write rates (per second) since the previous snapshot
+    counters = (ci.power_scheduler.written, ci.player.writes)
+    if "counters" in last and now > last["time"]:
+        elapsed = now - last["time"]
+        snapshot["power_writes"] = round(
+            (counters[0] - last["counters"][0]) / elapsed, 1
+        )
+        snapshot["pattern_writes"] = round(
+            (counters[1] - last["counters"][1]) / elapsed, 1
+        )
+    last["counters"] = counters
+    last["time"] = now
+    return snapshot
+
+
+class Subscriber:
+    """
+    A connected client.
+
+    Changes not yet sent to the client are merged into `pending`, so a slow client receives fewer, larger deltas
+    instead of holding up the producer or queueing without bound.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.ready = asyncio.Event()
+
+    def push(self, delta: dict):
+        self.pending.update(delta)
+        self.ready.set()
+
+    async def next(self) -> dict:
+        await self.ready.wait()
+        self.ready.clear()
+        delta, self.pending = self.pending, {}
+        return delta
+
+
+class TelemetryHub:
+    """
+    Single producer of the telemetry stream, shared by all subscribers.
+
+    The producer samples the state every `telemetry_interval` seconds while there are subscribers, and pushes only
+    the fields which have changed.
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.snapshot = {}
+        self._last = {}
+        self._task = None
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber()
+        if self.snapshot:
+            subscriber.push(self.snapshot)
+        self.subscribers.add(subscriber)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    async def _run(self):
+        while self.subscribers:
+            try:
+                snapshot = await control_loop.call(
+                    take_snapshot, time.monotonic(), self._last
+                )
+            except Exception as e:
+                logging.error(f"Failed to take telemetry snapshot: {e}")
+                snapshot = self.snapshot
+            delta = {
+                k: v
+                for k, v in snapshot.items()
+                if k not in self.snapshot or self.snapshot[k] != v
+            }
+            self.snapshot = snapshot
+            if delta:
+                for subscriber in self.subscribers:
+                    subscriber.push(delta)
+            await asyncio.sleep(settings.telemetry_interval)
+
+
+hub = TelemetryHub()
+
+
+async def send_updates(websocket: WebSocket, subscriber: Subscriber):
+    while True:
+        await websocket.send_json(await subscriber.next())
+
+
+@router.websocket("/ws")
+async def telemetry_stream(websocket: WebSocket):
+    """
+    Stream the device state to the client.
+
+    The first message holds the full snapshot, the following ones only the fields which have changed.
+    """
+    await websocket.accept()
+    subscriber = hub.subscribe()
+    # Updates are sent from a separate task, so that a disconnect is noticed even while nothing changes.
+    sender = asyncio.ensure_future(send_updates(websocket, subscriber))
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        hub.unsubscribe(subscriber)
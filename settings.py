@@ -53,9 +53,38 @@ MIN_POWER = 0.5
 CAN_UPDATE_POWER = True
 WARN_ON_STACK_DUMP_SOUND = True
 
+from typing import List, Literal
+
 from pydantic import BaseModel
 
 
+class DeviceSettings(BaseModel):
+    # Bluetooth address of the coyote, which is also its id in the API.
+    uid: str
+    # Name shown in the WebUI, e.g. the participant wearing it.
+    name: str = ""
+    # The settings below follow the `coyote_*` settings of the same name when left unset.
+    addr_a: str = None
+    addr_b: str = None
+    max_power_a: int = None
+    max_power_b: int = None
+    pattern_a: str = None
+    pattern_b: str = None
+    combine_a: Literal["max", "sum", "mean"] = None
+    combine_b: Literal["max", "sum", "mean"] = None
+
+
+class RouteSettings(BaseModel):
+    # OSC address, or OSC pattern, e.g. "/avatar/parameters/Tail*" or "/avatar/parameters/{HandL,HandR}Dis".
+    address: str
+    # Channel fed by the address, "a" or "b".
+    channel: str
+    # Weight of the address among the inputs of the channel.
+    weight: float = 1.0
+    # Bluetooth address of the coyote, empty for all the coyotes.
+    device: str = ""
+
+
 class Settings(BaseModel):
     # Set to the Bluetooth UID for your particular Coyote device
     # if `coyote_uid` is `None`, the program will try detactig cotoye automatically
@@ -74,8 +103,58 @@ class Settings(BaseModel):
     # OSC address bind to channel B.
     # The value of this address must be a float number between 0 and 1.
     coyote_addr_b: str = "/avatar/parameters/EarRDis"
+    # Additional OSC addresses (or patterns) mapped to the channels, combined with `coyote_addr_a` and
+    # `coyote_addr_b`, see RouteSettings.
+    osc_routes: List[RouteSettings] = []
+    # How the inputs of a channel are combined: "max", "sum" (capped at 1) or "mean" (weighted).
+    # One of the COMBINE_* values of common/osc_routing.py, anything else is rejected when the settings are loaded.
+    coyote_combine_a: Literal["max", "sum", "mean"] = "max"
+    coyote_combine_b: Literal["max", "sum", "mean"] = "max"
     # bluetooth connection timeout (in seconds) of coyote
     coyote_connect_timeout: int = 40
+    # Minimal interval (in seconds) between two power writes to the coyote.
+    # The coyote processes one command per 100 ms cycle, more frequent power updates are coalesced.
+    coyote_power_interval: float = 0.1
+    # Read-back verification of power writes: "always", "sampled" (every `coyote_verify_interval`-th write) or "off".
+    # One of the VERIFY_* values of dg_interface, anything else is rejected when the settings are loaded.
+    coyote_verify_mode: Literal["always", "sampled", "off"] = "sampled"
+    coyote_verify_interval: int = 10
+    # Write power levels without waiting for a response, if the coyote allows it.
+    coyote_write_without_response: bool = True
+    # Pattern playback timing: "tick" plays each pattern state for `coyote_pattern_tick` seconds,
+    # "state" plays each state for its own pulse + pause duration.
+    # One of the TIMING_* values of dg_player, anything else is rejected when the settings are loaded.
+    coyote_pattern_timing: Literal["tick", "state"] = "tick"
+    coyote_pattern_tick: float = 0.1
+    # Interval (in seconds) of refreshing the battery level, if the coyote doesn't notify about changes.
+    coyote_battery_ttl: float = 60
+
+    # Additional coyotes, driven by the same OSC stream as the main one (see toys/estim/coyote/dg_registry.py).
+    coyote_devices: List[DeviceSettings] = []
+
+    # Simulate the coyote in process instead of connecting over bluetooth (see toys/estim/coyote/dg_mock.py).
+    coyote_mock: bool = False
+    # Time (in seconds) taken by every read and write of the mock, plus a random jitter of up to `coyote_mock_jitter`.
+    coyote_mock_latency: float = 0.01
+    coyote_mock_jitter: float = 0.005
+    # Probability of a lost write, and of a disconnect on every read or write of the mock.
+    coyote_mock_drop_rate: float = 0.0
+    coyote_mock_disconnect_rate: float = 0.0
+    # Seed of the simulated faults, for reproducible runs.
+    coyote_mock_seed: int = 0
+    # Run the bluetooth I/O of every coyote in a supervised worker process (see toys/estim/coyote/dg_worker.py).
+    coyote_worker: bool = False
+
+    # Run the OSC listener and the device I/O on their own event loop, in a dedicated thread (see
+    # common/control_loop.py), and use uvloop for that loop if it is installed (not available on Windows).
+    control_loop_thread: bool = False
+    control_loop_uvloop: bool = False
+
+    # Only decode the OSC messages of the routed addresses, skipping the other avatar parameters before parsing them
+    # (see common/osc_fast.py). Turn off to parse every message with python-osc.
+    osc_fast_path: bool = True
+    # Directory of the OSC logs recorded and replayed through the API, which cannot reach files outside of it.
+    osc_log_dir: str = "osc_logs"
 
     # Host ip of VRChat client.
     vrc_host: str = "127.0.0.1"
@@ -85,6 +164,13 @@ class Settings(BaseModel):
 
     # Window size of the moving average filter (in seconds).
     window_size: float = 0.1
+    # Input filters by OSC address, e.g.
+    #   {"/avatar/parameters/EarLDis": {"kind": "one_euro", "min_cutoff": 1.0, "beta": 0.05}}
+    # kind: "moving_average", "ema", "median" or "one_euro".
+    # window: window (moving average, median) or time constant (ema) in seconds, defaults to `window_size`.
+    # min_cutoff, beta, d_cutoff: parameters of the one_euro filter.
+    # Addresses not listed here use a moving average over `window_size`.
+    input_filters: dict = {}
 
     #             ▲
     #             │
@@ -110,22 +196,119 @@ class Settings(BaseModel):
     # The minimum power rate of the e-stim device.
     min_power: float = 0.5
 
-    can_update_power: bool = True
+    # Transfer curve of each channel: "linear" (above), "exponential", "s_curve" or "points".
+    coyote_curve_a: str = "linear"
+    coyote_curve_b: str = "linear"
+    # Control points [[input, power rate], ...] of the "points" curve.
+    coyote_curve_points_a: list = [[0.0, 0.0], [1.0, 1.0]]
+    coyote_curve_points_b: list = [[0.0, 0.0], [1.0, 1.0]]
+    # Growth rate of the "exponential" curve, the larger the flatter its start.
+    curve_rate: float = 3.0
+    # Steepness of the "s_curve" curve, the larger the closer to a step at the middle of [start_limit, max_limit].
+    curve_steepness: float = 10.0
+
+    # Delay (in seconds) between a change of the settings and writing them to `settings.yaml`.
+    # Changes within that delay are written at once.
+    settings_save_delay: float = 1.0
+    # Interval (in seconds) between two updates of the live telemetry stream.
+    telemetry_interval: float = 0.2
+
     warn_on_stack_dump_sound: bool = True
 
     def dump(self):
-        with open("settings.yaml", "w") as f:
-            yaml.dump(self.dict(), f)
+        write_settings(self.dict())
 
     @classmethod
     def load(cls):
-        with open("settings.yaml", "r") as f:
+        with open(SETTINGS_PATH, "r") as f:
             settings_dict = yaml.safe_load(f)
         return Settings(**settings_dict)
 
 
+import asyncio
+import logging
+import os
 import yaml
 
+SETTINGS_PATH = "settings.yaml"
+
+
+def write_settings(settings_dict: dict, path: str = SETTINGS_PATH):
+    """
+    Write the settings to `path` atomically, i.e. a crash never leaves a truncated file behind.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        yaml.dump(settings_dict, f)
+    os.replace(tmp_path, path)
+
+
+class SettingsPersistence:
+    """
+    Debounced persistence of the settings.
+
+    Route handlers call `mark_dirty()` after changing the settings. The settings are written
+    `settings_save_delay` seconds later in an executor thread, so the event loop running the OSC server and the
+    BLE writes is never blocked by file IO, and a burst of changes (e.g. dragging a slider) ends up in one write.
+    `flush()` must be awaited on shutdown to write the pending changes.
+    """
+
+    def __init__(self, settings: Settings, path: str = SETTINGS_PATH):
+        self.settings = settings
+        self.path = path
+        self.dirty = False
+        self.writes = 0
+        self._timer = None
+        self._lock = None
+
+    def mark_dirty(self):
+        """
+        Schedule a write of the settings.
+        """
+        self.dirty = True
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Not called from the event loop, e.g. from a script.
+            self.settings.dump()
+            self.dirty = False
+            return
+        if self._timer is None or self._timer.done():
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        # mark_dirty() does not schedule another write while this one is pending, so the changes made during the
+        # write, and the ones of a failed write, are written after another delay.
+        while True:
+            await asyncio.sleep(self.settings.settings_save_delay)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Failed to save settings: {e}")
+            if not self.dirty:
+                return
+
+    async def flush(self):
+        """
+        Write the pending changes, if any.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            # Copy on the loop, so that the written file is a consistent state of the settings.
+            settings_dict = self.settings.dict()
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, write_settings, settings_dict, self.path
+                )
+            except Exception:
+                self.dirty = True
+                raise
+            self.writes += 1
+
 
 def load_settings():
     with open("settings.yaml", "r") as f:
@@ -136,3 +319,4 @@ def load_settings():
 # settings = load_settings()
 
 settings = Settings.load()
+persistence = SettingsPersistence(settings)
@@ -9,6 +9,13 @@ Licensed under the MIT License, (c) 2022 S. F. S.
 """
 
 import struct
+from array import array
+
+# NumPy is optional, the batch encoders fall back to plain python if it is not installed.
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 def encode_power(pow_a: int, pow_b: int) -> bytes:
@@ -59,6 +66,143 @@ def encode_pattern(ax: int, ay: int, az: int) -> bytes:
     return bytes([b1, b2, b0])  # cut and append first byte behind the third byte (??) # fixme, this makes no sense
 
 
+def _pattern_index(ax, ay, az):
+    """
+    Index of a pattern state in the lookup table of `pattern_table()`. Works on ints and NumPy arrays alike.
+    """
+    return (
+        ((az & 0b00011111) << 15)
+        | ((ay & 0b00000011_11111111) << 5)
+        | (ax & 0b00011111)
+    )
+
+
+_pattern_table = None
+
+
+def pattern_table():
+    """
+    Lookup table of the encoded messages of every pattern state in the 5/10/5-bit (ax, ay, az) space.
+
+    The table is built on first use and shared afterwards. It holds 2 ** 20 three-byte messages (3 MiB), the message
+    of a state is found at index `((az & 31) << 15) | ((ay & 1023) << 5) | (ax & 31)`.
+
+    :return: uint8 array of shape (2 ** 20, 3) if NumPy is available, else a flat bytes object of 3 * 2 ** 20 bytes.
+    """
+    global _pattern_table
+    if _pattern_table is None:
+        if np is not None:
+            index = np.arange(1 << 20, dtype=np.int64)
+            _pattern_table = _encode_pattern_np(
+                index & 31, (index >> 5) & 1023, index >> 15
+            )
+        else:
+            _pattern_table = b"".join(
+                encode_pattern(i & 31, (i >> 5) & 1023, i >> 15) for i in range(1 << 20)
+            )
+    return _pattern_table
+
+
+def encode_pattern_lut(ax: int, ay: int, az: int) -> bytes:
+    """
+    Same as `encode_pattern`, but looks the message up in `pattern_table()`.
+    """
+    index = _pattern_index(ax, ay, az)
+    if np is not None:
+        return pattern_table()[index].tobytes()
+    return pattern_table()[3 * index : 3 * index + 3]
+
+
+def _encode_power_np(pow_a, pow_b):
+    out = np.empty((len(pow_a), 3), dtype=np.uint8)
+    out[:, 0] = pow_b & 0b11111111
+    out[:, 1] = ((pow_a & 0b00011111) << 3) | ((pow_b & 0b11111111111) >> 8)
+    out[:, 2] = (pow_a >> 5) & 0b00111111
+    return out
+
+
+def _encode_pattern_np(ax, ay, az):
+    b_ = (
+        ((az & 0b00000001) << 15)
+        | ((ay & 0b00000011_11111111) << 5)
+        | (ax & 0b00011111)
+    )
+    out = np.empty((len(ax), 3), dtype=np.uint8)
+    # Same byte order as struct.pack("H", b_) in encode_pattern
+    if struct.pack("H", 1) == b"\x01\x00":
+        out[:, 0] = b_ & 0xFF
+        out[:, 1] = b_ >> 8
+    else:
+        out[:, 0] = b_ >> 8
+        out[:, 1] = b_ & 0xFF
+    out[:, 2] = (az & 0b00011110) >> 1
+    return out
+
+
+def encode_power_batch(powers):
+    """
+    Encodes many e-stim power settings at once, see `encode_power`.
+
+    :param powers: Sequence or (n, 2) array of (pow_a, pow_b) pairs.
+    :return: Packed uint8 array of n three-byte messages: a flat numpy.ndarray if NumPy is available, else array("B").
+    """
+    if np is not None:
+        powers = np.asarray(powers, dtype=np.int64).reshape(-1, 2)
+        return _encode_power_np(powers[:, 0], powers[:, 1]).reshape(-1)
+    out = array("B")
+    for pow_a, pow_b in powers:
+        out.frombytes(encode_power(int(pow_a), int(pow_b)))
+    return out
+
+
+def encode_pattern_batch(states, use_table: bool = False):
+    """
+    Encodes many e-stim pattern states at once, see `encode_pattern`.
+
+    :param states: Sequence or (n, 3) array of (ax, ay, az) states.
+    :param use_table: Look the messages up in `pattern_table()` instead of computing them.
+    :return: Packed uint8 array of n three-byte messages: a flat numpy.ndarray if NumPy is available, else array("B").
+    """
+    if np is not None:
+        states = np.asarray(states, dtype=np.int64).reshape(-1, 3)
+        ax, ay, az = states[:, 0], states[:, 1], states[:, 2]
+        if use_table:
+            return pattern_table()[_pattern_index(ax, ay, az)].reshape(-1)
+        return _encode_pattern_np(ax, ay, az).reshape(-1)
+    encode = encode_pattern_lut if use_table else encode_pattern
+    out = array("B")
+    for ax, ay, az in states:
+        out.frombytes(encode(int(ax), int(ay), int(az)))
+    return out
+
+
+def decode_power(message) -> tuple:
+    """
+    Inverse of encode_power(), decodes a three-byte power message as written to the device.
+
+    :param message: three-byte bytes-like object
+    :return: (pow_a, pow_b)
+    """
+    b2, b1, b0 = message[0], message[1], message[2]
+    pow_a = (b0 << 5) | (b1 >> 3)
+    pow_b = ((b1 & 0b00000111) << 8) | b2
+    return pow_a, pow_b
+
+
+def decode_pattern(message) -> tuple:
+    """
+    Inverse of encode_pattern(), decodes a three-byte pattern message as written to the device.
+
+    :param message: three-byte bytes-like object
+    :return: (ax, ay, az)
+    """
+    (b_,) = struct.unpack("H", bytes(message[0:2]))
+    ax = b_ & 0b00011111
+    ay = (b_ >> 5) & 0b00000011_11111111
+    az = (message[2] << 1) | (b_ >> 15)
+    return ax, ay, az
+
+
 def test_function_validity():
     """
     This function verifies that the encoding functions work exactly the same as their original javascript version.
@@ -138,6 +282,20 @@ def test_function_validity():
             raise Exception(f"Error, {bytes(ba)} does not match {out}")
     print("No errors found!")
 
+    print("Testing batch power encoding")
+    out = bytes(encode_power_batch([sample[:2] for sample in power_test_data]))
+    expected = b"".join(bytes(sample[2]) for sample in power_test_data)
+    if out != expected:
+        raise Exception("Error, batch power encoding does not match")
+    print("No errors found!")
+
+    print("Testing power decoding")
+    for sample in power_test_data:
+        pow_a, pow_b, ba, hex_repr, bit_repr = sample
+        if decode_power(bytes(ba)) != (pow_a, pow_b):
+            raise Exception(f"Error, {bytes(ba)} does not decode to {(pow_a, pow_b)}")
+    print("No errors found!")
+
     print("Testing pattern data")
     with open("fuzzy_pattern_data.json", "r") as infile:
         pattern_test_data = json.load(infile)
@@ -160,3 +318,19 @@ def test_function_validity():
         else:
             raise Exception(f"Error, {bytes(ba)} does not match {out}")
     print("No errors found!")
+
+    print("Testing batch pattern encoding")
+    states = [sample[:3] for sample in pattern_test_data]
+    expected = b"".join(bytes(sample[3]) for sample in pattern_test_data)
+    if bytes(encode_pattern_batch(states)) != expected:
+        raise Exception("Error, batch pattern encoding does not match")
+    if bytes(encode_pattern_batch(states, use_table=True)) != expected:
+        raise Exception("Error, lookup table pattern encoding does not match")
+    print("No errors found!")
+
+    print("Testing pattern decoding")
+    for sample in pattern_test_data:
+        ax, ay, az, ba, hex_repr, bit_repr = sample
+        if decode_pattern(bytes(ba)) != (ax, ay, az):
+            raise Exception(f"Error, {bytes(ba)} does not decode to {(ax, ay, az)}")
+    print("No errors found!")
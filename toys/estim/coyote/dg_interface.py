@@ -51,10 +51,15 @@ Licensed under the MIT License, (c) 2022 S. F. S.
 
 import traceback
 from typing import Tuple
-import bleak  # bluetooth functionality
 
 # custom functionality for encoding communication to the bluetooth device
 import toys.estim.coyote.dg_encoding as dg_encoding
+from toys.estim.coyote.dg_scheduler import PowerScheduler
+from toys.estim.coyote.dg_player import MultiplexPlayer
+from toys.estim.coyote.dg_pattern_cache import PatternCache
+import toys.estim.coyote.dg_mock as dg_mock
+from common import metrics
+from toys.estim.pattern import Pattern
 import logging
 import time
 import asyncio
@@ -65,6 +70,11 @@ from common.util import *
 from settings import settings
 import copy
 
+# Read-back verification modes of the power characteristic, see CoyoteInterface.set_pwm().
+VERIFY_ALWAYS = "always"  # read back every power write
+VERIFY_SAMPLED = "sampled"  # read back every `coyote_verify_interval`-th power write
+VERIFY_OFF = "off"  # never read back
+
 
 class CoyoteInterface(Estim):
     """
@@ -82,7 +92,6 @@ class CoyoteInterface(Estim):
 
     pattern_name_a: str
     pattern_name_b: str
-    switch_pattern: bool = False
 
     def __init__(
         self,
@@ -100,17 +109,23 @@ class CoyoteInterface(Estim):
         """
         super().__init__("coyote")
         self.battery = -1
+        # Monotonic time of the last battery level update, and the task refreshing it if notifications are not
+        # supported; see self._start_battery_monitor()
+        self.battery_updated_at = None
+        self._battery_task = None
         self.pow_a = 1
         self.pow_b = 1
         # Set bluetooth device uid and device reference
         if device_uid is not None and device_uid != "":
             self.device_uid = device_uid
-            self.device = bleak.BleakClient(
-                self.device_uid, timeout=settings.coyote_connect_timeout
-            )
+            self.device = self._create_client(self.device_uid)
+        elif self.is_mock:
+            self.device_uid = dg_mock.MOCK_ADDRESS
+            self.device = self._create_client(self.device_uid)
         else:
             # attempt to find device automatically if device_uid left blank.
             print("Coyote UID was left blank. Trying to find the device automatically.")
+            self.device_uid = None
             self.device = None
 
         # Bluetooth characteristic placeholders; populated in self.connect()
@@ -120,6 +135,20 @@ class CoyoteInterface(Estim):
         self._pwm_a34 = None  # channel b
         self._pwm_b34 = None  # channel a
 
+        # Whether the power characteristic accepts writes without response; populated in self.connect()
+        self._pwm_ab2_without_response = False
+
+        # Counters of the power writes and their read-back verification, see self.set_pwm()
+        self.power_writes = 0
+        self.verified_writes = 0
+        self.verify_mismatches = 0
+        self._power_write_latency = metrics.stage(metrics.STAGE_POWER_WRITE, "ab")
+        # Number of reconnections after the device stopped answering, see self.is_running()
+        self.reconnects = 0
+        # Cleared by a power write, set again once the next pattern state was written; the OSC handlers do not
+        # request power meanwhile.
+        self.can_update_power = True
+
         # Caution: the channels a & b are actually switched compared to the official spec, so that a34 outputs to
         # channel b, and b34 to channel a. This is corrected automatically if the following flag is set.
         self.channels_switched = True
@@ -148,6 +177,16 @@ class CoyoteInterface(Estim):
         # Do not disable you're unless absolutely certain that you know what you are doing!
         self.safe_mode = safe_mode
 
+        # Single writer for the power characteristic. Use self.request_pwm() to update the power from hot paths, the
+        # requests are coalesced and flushed at most once per device cycle.
+        self.power_scheduler = PowerScheduler(self, settings.coyote_power_interval)
+
+        # Deadline driven pattern player of both channels, see self.play()
+        self.player = MultiplexPlayer(self)
+
+        # Patterns pre-encoded to the byte messages of the pattern characteristics, see self.set_pattern()
+        self.pattern_cache = PatternCache()
+
         # todo: import patterns from patterns.json and choose according to type of in-game event
         # Placeholder e-stim patterns
         #
@@ -167,6 +206,31 @@ class CoyoteInterface(Estim):
     # Internal methods
     #
 
+    @property
+    def is_mock(self) -> bool:
+        """Whether the device is simulated by dg_mock instead of being reached through bleak."""
+        return settings.coyote_mock or dg_mock.enabled
+
+    def _create_client(self, device_uid: str):
+        """
+        Create the bluetooth client of the device, or the mock device.
+
+        :param device_uid: Bluetooth address of the device.
+        """
+        if self.is_mock:
+            return dg_mock.MockCoyoteClient(
+                device_uid,
+                latency=settings.coyote_mock_latency,
+                jitter=settings.coyote_mock_jitter,
+                drop_rate=settings.coyote_mock_drop_rate,
+                disconnect_rate=settings.coyote_mock_disconnect_rate,
+                seed=settings.coyote_mock_seed,
+                timeout=settings.coyote_connect_timeout,
+            )
+        import bleak  # bluetooth functionality, imported on first use to keep startup fast
+
+        return bleak.BleakClient(device_uid, timeout=settings.coyote_connect_timeout)
+
     def _get_pwm(self) -> Tuple[int, int]:  # return pow_a, pow_b
         """
         Return tuple of current power level of channel a and channel b.
@@ -175,14 +239,29 @@ class CoyoteInterface(Estim):
         # todo
         raise NotImplementedError()
 
-    async def set_pwm(self, pow_a: int, pow_b: int):
+    def request_pwm(self, pow_a: int, pow_b: int, received_at: float = None):
+        """
+        Request power level of channel a and channel b without waiting for the device.
+
+        Only the latest request of each channel is written, see PowerScheduler.
+
+        :param pow_a: Output power of channel a, if set to -1, the power level will not be changed
+        :param pow_b: Output power of channel b, if set to -1, the power level will not be changed
+        :param received_at: Monotonic time at which the OSC message behind the request was received.
+        """
+        self.power_scheduler.request(pow_a, pow_b, received_at)
+
+    async def set_pwm(self, pow_a: int, pow_b: int) -> bool:
         """
         Set power level of channel a and channel b
 
         Valid input range (int): 0 <= pow_[a|b] <= 2047
 
+        Prefer self.request_pwm(), this writes to the device directly and must only be called by the PowerScheduler.
+
         :param pow_a: Output power of channel a, if set to -1, the power level will not be changed
         :param pow_b: Output power of channel b, if set to -1, the power level will not be changed
+        :return: True if the power was written to the device.
         """
 
         if pow_a < 0:
@@ -191,13 +270,13 @@ class CoyoteInterface(Estim):
             pow_b = self.pow_b
 
         if abs(pow_a - self.pow_a) < 10 and abs(pow_b - self.pow_b) < 10:
-            return
+            return False
 
         logging.info(f"set_pwm({pow_a}, {pow_b})")
         self.pow_a = pow_a
         self.pow_b = pow_b
 
-        settings.can_update_power = False
+        self.can_update_power = False
 
         # "self.safe_mode == True" limits the amount of e-stim intensity to 37.5 % (768/2047).
         if self.safe_mode:
@@ -210,11 +289,27 @@ class CoyoteInterface(Estim):
             message = dg_encoding.encode_power(pow_a, pow_b)
 
             # Communicate byte sequence to device
-            await self.device.write_gatt_char(self._pwm_ab2.uuid, message)
-            # Read & confirm new values
-            output = await self.device.read_gatt_char(self._pwm_ab2)
-            # logging.info(
-            #     f"Wrote byte sequence to _pwm_ab2: {message}, confirmation: {output}")
+            start = time.monotonic()
+            await self.device.write_gatt_char(
+                self._pwm_ab2,
+                message,
+                response=not (
+                    settings.coyote_write_without_response
+                    and self._pwm_ab2_without_response
+                ),
+            )
+            self._power_write_latency.record(time.monotonic() - start)
+            self.power_writes += 1
+            if self._should_verify():
+                # Read & confirm new values
+                output = await self.device.read_gatt_char(self._pwm_ab2)
+                self.verified_writes += 1
+                if bytes(output) != message:
+                    self.verify_mismatches += 1
+                    logging.warning(
+                        f"Power read-back mismatch: wrote {message}, device reports {output}"
+                    )
+            return True
         else:
             if self.safe_mode:
                 logging.error("Caution, safe mode is enabled.")
@@ -225,26 +320,51 @@ class CoyoteInterface(Estim):
                 logging.error(
                     f"Input values pow_a ({pow_a}) & pow_b ({pow_b}) must both be within the range 0-2047!"
                 )
+            return False
 
-    def _calculate_pattern_duration(self, pattern: list) -> int:
+    def _should_verify(self) -> bool:
+        """
+        Whether the power write which has just been counted in self.power_writes should be read back.
+        """
+        if settings.coyote_verify_mode == VERIFY_ALWAYS:
+            return True
+        if settings.coyote_verify_mode == VERIFY_SAMPLED:
+            return self.power_writes % max(1, settings.coyote_verify_interval) == 0
+        return False
+
+    def verify_stats(self) -> dict:
+        return {
+            "mode": settings.coyote_verify_mode,
+            "write_without_response": settings.coyote_write_without_response
+            and self._pwm_ab2_without_response,
+            "writes": self.power_writes,
+            "verified": self.verified_writes,
+            "mismatches": self.verify_mismatches,
+        }
+
+    def _calculate_pattern_duration(self, pattern: Pattern) -> int:
         """
         Calculates total duration of a pattern's combined pulses and pauses. Output duration is in milliseconds.
 
-        :param pattern: List of lists of the schema [[ax, ay, az], [ax, ay, az], ...] representing an e-stim pattern.
+        :param pattern: The e-stim pattern.
         :return: Total duration of pattern duration in milliseconds.
         """
-        return sum([x[0] + x[1] for x in pattern])
+        return pattern.duration
 
-    def _truncate_pattern(self, duration: int, pattern: list) -> list:
+    def _truncate_pattern(self, duration: int, pattern: Pattern) -> Pattern:
         """
         Shorten pattern if it is too long for a given duration.
 
+        The first state is always kept, even if it is longer than the duration on its own.
+
         :param duration: Intended duration (ms) as given as parameter to vibrate function.
         :param pattern: Pattern which is longer than duration (ms).
         :return: A shortened pattern which is not longer than duration.
         """
-        # todo
-        raise NotImplementedError
+        truncated = pattern.truncate(duration)
+        if not len(truncated) and len(pattern):
+            truncated = pattern.truncate(pattern.state_start(1))
+        return truncated
 
     def _debug(self, strength: int = 256, duration: int = 10, step: int = 1):
         """
@@ -266,6 +386,13 @@ class CoyoteInterface(Estim):
         self.device_uid = None
         self.device_alias = "D-LAB ESTIM01"
 
+        if self.is_mock:
+            self.device_uid = dg_mock.MOCK_ADDRESS
+            self.device = self._create_client(self.device_uid)
+            return
+
+        import bleak  # bluetooth functionality
+
         print("Scanning for Bluetooth devices.")
         self.scanner = bleak.BleakScanner()
         bluetooth_devices = await self.scanner.discover(timeout=10)
@@ -293,9 +420,7 @@ class CoyoteInterface(Estim):
                         # Save UUID of found device to self.device_uid and instantiate BLEAK as normal.
                         self.device_uid = bluetooth_device.address
                         print(f"Coyote found! UUID: {self.device_uid}")
-                        self.device = bleak.BleakClient(
-                            self.device_uid, timeout=settings.coyote_connect_timeout
-                        )
+                        self.device = self._create_client(self.device_uid)
             if not self.device_uid:
                 raise RuntimeError(
                     "BLEAK failed to find the DG-Lab Coyote automatically."
@@ -364,6 +489,9 @@ class CoyoteInterface(Estim):
                     if characteristic.uuid == "955a1504-0fe2-f5aa-a094-84b8d4f3e8ad":
                         # logging.info("found channels strength characteristic: ", characteristic.uuid)
                         self._pwm_ab2 = characteristic
+                        self._pwm_ab2_without_response = (
+                            "write-without-response" in characteristic.properties
+                        )
 
                     if characteristic.uuid == "955a1505-0fe2-f5aa-a094-84b8d4f3e8ad":
                         # logging.info("found channel A characteristic: ", characteristic.uuid)
@@ -398,7 +526,7 @@ class CoyoteInterface(Estim):
         # Convert from bytearray to hex to decimal
         battery_level_dec = int(battery_level.hex(), 16)
         print("Current device battery level: ", battery_level_dec)
-        self.battery = battery_level_dec
+        self._set_battery(battery_level_dec)
 
         # write output power = 0 to device
         logging.info(
@@ -420,6 +548,9 @@ class CoyoteInterface(Estim):
         else:
             logging.error("Device read/write functionality could not be confirmed.")
 
+        self.power_scheduler.start()
+        await self._start_battery_monitor()
+
     async def shutdown(self):
         await self.disconnect()
 
@@ -431,13 +562,52 @@ class CoyoteInterface(Estim):
         print("Disconnecting...")
         self.stop_signal = True
         self.is_connected = False
+        await self.power_scheduler.stop()
+        self._stop_battery_monitor()
         output = await self.device.disconnect()
 
         if not self.device.is_connected:
             print("Disconnected!")
 
-    async def get_bettery_level(self) -> int:
-        """Get battery level."""
+    def _set_battery(self, battery_level: int):
+        self.battery = battery_level
+        self.battery_updated_at = time.monotonic()
+
+    def _on_battery_notification(self, sender, data: bytearray):
+        # Convert from bytearray to hex to decimal
+        self._set_battery(int(data.hex(), 16))
+
+    async def _start_battery_monitor(self):
+        """
+        Keep self.battery up to date, by notifications if the characteristic supports them, otherwise by reading it
+        every `coyote_battery_ttl` seconds in the background.
+        """
+        self._stop_battery_monitor()
+        if "notify" in self._battery_level.properties:
+            try:
+                await self.device.start_notify(
+                    self._battery_level, self._on_battery_notification
+                )
+                return
+            except Exception as e:
+                logging.error(f"Failed to subscribe to battery notifications: {e}")
+        self._battery_task = asyncio.ensure_future(self._refresh_battery_level())
+
+    def _stop_battery_monitor(self):
+        if self._battery_task is not None:
+            self._battery_task.cancel()
+            self._battery_task = None
+
+    async def _refresh_battery_level(self):
+        while self.is_connected:
+            await asyncio.sleep(settings.coyote_battery_ttl)
+            try:
+                await self.read_battery_level()
+            except Exception as e:
+                logging.error(f"Failed to read battery level: {e}")
+
+    async def read_battery_level(self) -> int:
+        """Read battery level from the device."""
 
         if not self.is_connected:
             return 0
@@ -446,32 +616,77 @@ class CoyoteInterface(Estim):
 
         # Convert from bytearray to hex to decimal
         battery_level_dec = int(battery_level.hex(), 16)
-        self.battery = battery_level_dec
+        self._set_battery(battery_level_dec)
         return battery_level_dec
 
+    async def get_bettery_level(self) -> int:
+        """Get the cached battery level, kept up to date in the background without a read per call."""
+
+        if not self.is_connected:
+            return 0
+        return self.battery
+
+    def battery_age(self) -> float:
+        """Seconds since the battery level was last updated, None if it is unknown."""
+        if self.battery_updated_at is None:
+            return None
+        return time.monotonic() - self.battery_updated_at
+
     async def signal(
-        self, power: int, pattern_name: str, duration: int, channel: str = "a"
+        self,
+        power: int,
+        pattern_name,
+        duration: int,
+        channel: str = "a",
+        offset: int = 0,
     ):
         """
         Send to device an e-stim pattern on channel a or b at a given power for a given duration.
 
+        Only the given channel is changed: the other channel keeps its power and its playback.
+
         :param power: Set e-stim power (0 <= x <= 2047)
-        :param pattern: Set pattern [ [ax, ay, az], [ax, ay, az], ...]
+        :param pattern_name: Name of the pattern in self.patterns, or a Pattern.
         :param duration: Set duration in milliseconds.
         :param channel: Set output channel a|b.
+        :param offset: Resume the pattern at this time (ms) since its start.
+        """
+        # Set killswitch
+        self.stop_signal = False
+
+        if channel == "a":
+            await self.power_scheduler.write_now(power, -1)
+            if isinstance(pattern_name, str):
+                self.pattern_name_a = pattern_name
+        else:
+            await self.power_scheduler.write_now(-1, power)
+            if isinstance(pattern_name, str):
+                self.pattern_name_b = pattern_name
+
+        if not self.player.is_playing:
+            self.player.timing = settings.coyote_pattern_timing
+            self.player.tick = settings.coyote_pattern_tick
+        await self.player.play_channel(channel, pattern_name, duration, offset)
+
+    async def play(
+        self, pow_a: int, pow_b: int, patterns: dict, duration: int, offset: int = 0
+    ):
         """
-        # todo: Enable multi-channel output, i.e. different patterns/power/durations on channels a & b simultaneously.
+        Send to device e-stim patterns on one or both channels at given powers for a given duration.
 
-        # Set channel target (a/b)
-        characteristic = self._pwm_b34 if channel == "b" else self._pwm_a34
+        Both channels are driven by the single MultiplexPlayer task.
 
+        :param pow_a: Set e-stim power of channel a (0 <= x <= 2047)
+        :param pow_b: Set e-stim power of channel b (0 <= x <= 2047)
+        :param patterns: Name of the pattern (or a Pattern) per channel, e.g. {"a": "vibrator_4", "b": "vibrator_4"}
+        :param duration: Set duration in milliseconds.
+        :param offset: Resume the patterns at this time (ms) since their start.
+        """
         # Set killswitch
         self.stop_signal = False
 
         # Set power
-        # todo: independent power strength for each individual channel. Perhaps thru
-        await self.set_pwm(power, power)
-        # self.get_pwm()?
+        await self.power_scheduler.write_now(pow_a, pow_b)
 
         # if we assume that the given duration is in milliseconds (?), then we must calculate how many times the
         # pattern can be executed within that time-frame, depending on the length of the pattern, so that the pattern
@@ -480,66 +695,42 @@ class CoyoteInterface(Estim):
         # If the pattern is way longer than the given duration, just run the pattern once. I don't know whether this
         # will be a big issue, to be honest.
 
+        if isinstance(patterns.get("a"), str):
+            self.pattern_name_a = patterns["a"]
+        if isinstance(patterns.get("b"), str):
+            self.pattern_name_b = patterns["b"]
+        # pattern_duration = self._calculate_pattern_duration(ci.patterns[pattern_name])
+
+        # Iterate over the patterns and send each value (ax, ay, az) to the device in succession, each state
+        # is scheduled against an absolute deadline.
+        self.player.timing = settings.coyote_pattern_timing
+        self.player.tick = settings.coyote_pattern_tick
+        await self.player.play(patterns, duration, offset)
+
+    def set_pattern(self, pattern_name: str, pattern):
+        """
+        Add or replace a pattern, invalidating its compiled version.
+
+        :param pattern_name: Name of the pattern.
+        :param pattern: A Pattern or a list of states [ [ax, ay, az], [ax, ay, az], ...]
+        """
+        if not isinstance(pattern, Pattern):
+            pattern = Pattern.from_states(pattern)
+        self.patterns[pattern_name] = pattern
+        self.pattern_cache.invalidate(pattern_name)
+
+    def switch_pattern(self, channel: str, pattern_name: str):
+        """
+        Switch the pattern of one channel without interrupting the other channel.
+
+        :param channel: Output channel a|b.
+        :param pattern_name: Name of the pattern in self.patterns.
+        """
         if channel == "a":
             self.pattern_name_a = pattern_name
         else:
             self.pattern_name_b = pattern_name
-        # pattern_duration = self._calculate_pattern_duration(ci.patterns[pattern_name])
-
-        last_power_check = time.time()
-
-        end_time = time.time() + duration / 1000
-        cur_time = time.time()
-        last_time = time.time() - 0.1
-        # Iterate over the pattern and send each value (ax, ay, az) to the device in succession
-        while cur_time < end_time:
-            pattern_name = (
-                self.pattern_name_a if channel == "a" else self.pattern_name_b
-            )
-            self.switch_pattern = False
-            for state in self.patterns[pattern_name]:
-                if self.switch_pattern:
-                    break
-                cur_time = time.time()
-                if cur_time - last_time < 0.1:
-                    await asyncio.sleep(0.01)
-                    continue
-
-                # info("cur time = {}, end time = {}".format(cur_time, end_time))
-                if cur_time >= end_time:
-                    info("Shock - Hit time limit, stopping")
-                    break
-                if self.stop_signal:
-                    print("ret1")
-                    return
-                # Check to see if power output has been reduced to zero once per second
-                if cur_time - last_power_check > 1.0:
-                    if not await self.is_running():
-                        print("ret2")
-                        return
-                    last_power_check = time.time()
-                # unpack pattern values
-                ax, ay, az = state
-
-                # Determine duration of state (ms)
-                time_delta = (
-                    ax + ay
-                )  # consists of sum of pulse duration and pause duration
-
-                # Encode pattern
-                message = dg_encoding.encode_pattern(ax, ay, az)
-
-                # Send message to bluetooth device
-                output = await self.device.write_gatt_char(characteristic, message)
-                last_time = time.time()
-
-                settings.can_update_power = True
-
-                # Sleep to avoid spamming the device and causing "frame tearing."
-                # fixme: Might work worse than a flat time.sleep(0.1)?
-                # time_delta / 1000)  # Convert from milliseconds to seconds
-                # print("working")
-                await asyncio.sleep(0.01)
+        self.player.switch_pattern(channel, pattern_name)
 
     async def is_running(self):
         if not self.is_connected:  # Process is shutting down.
@@ -550,6 +741,7 @@ class CoyoteInterface(Estim):
         except Exception as e:
             print(e)
             print("Reconnecting...")
+            self.reconnects += 1
             await self.connect()
             return False
         # If power is 0, stop() has been called outside this function.
@@ -591,13 +783,19 @@ class CoyoteInterface(Estim):
                 await asyncio.sleep(0.1)
                 timeout += 1
         if not pattern in self.patterns:
-            fail("Pattern {} not found - Using default")
-            pattern = ""
-        pattern = random.choice(self.patterns[pattern])
+            fail("Pattern {} not found - Using default".format(pattern))
+            pattern = "default"
+        if pattern == "default":
+            pattern = random.choice(self.patterns[pattern])
+        else:
+            pattern = self.patterns[pattern]
+        # Don't run a long pattern far beyond the intended duration.
+        if pattern.duration > duration * 1000:
+            pattern = self._truncate_pattern(duration * 1000, pattern)
         await self.signal(
             power=self.convert_power_vibrate(strength),
             # todo: Different patterns corresponding to in-game events.
-            pattern=pattern,
+            pattern_name=pattern,
             duration=(duration * 1000),
             channel="a",
         )  # [toy['id'] for toy in toys])
@@ -613,7 +811,7 @@ class CoyoteInterface(Estim):
         if not self.is_connected:
             return
         self.stop_signal = True
-        await self.set_pwm(0, 0)
+        await self.power_scheduler.write_now(0, 0)
 
     async def check_in(self):
         return await self.is_running()
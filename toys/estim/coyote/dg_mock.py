@@ -0,0 +1,214 @@
+"""
+In-process stand-in for the DG-Lab Coyote, to run the whole control pipeline without the device.
+
+`MockCoyoteClient` implements the part of the `bleak.BleakClient` API used by CoyoteInterface, and exposes the same
+services and characteristics as the device. Writes are decoded with the inverse functions of `dg_encoding` and kept as
+device state. Latency, jitter, dropped writes and disconnects are simulated on request.
+
+The mock is used instead of bleak if `settings.coyote_mock` is set, or if the app is started with `--mock`.
+"""
+
+import asyncio
+import random
+import time
+
+import toys.estim.coyote.dg_encoding as dg_encoding
+
+# Set by the `--mock` command line option; unlike `settings.coyote_mock` it is never saved.
+enabled = False
+
+MOCK_ADDRESS = "00:00:00:00:00:00"
+MOCK_NAME = "D-LAB ESTIM01"
+
+BATTERY_SERVICE = "955a180a-0fe2-f5aa-a094-84b8d4f3e8ad"
+BATTERY_LEVEL = "955a1500-0fe2-f5aa-a094-84b8d4f3e8ad"
+PWM_SERVICE = "955a180b-0fe2-f5aa-a094-84b8d4f3e8ad"
+PWM_AB2 = "955a1504-0fe2-f5aa-a094-84b8d4f3e8ad"
+PWM_A34 = "955a1505-0fe2-f5aa-a094-84b8d4f3e8ad"
+PWM_B34 = "955a1506-0fe2-f5aa-a094-84b8d4f3e8ad"
+CONFIG = "955a1507-0fe2-f5aa-a094-84b8d4f3e8ad"
+
+
+class MockCharacteristic:
+    def __init__(self, uuid: str, properties: list):
+        self.uuid = uuid
+        self.properties = properties
+
+    def __str__(self) -> str:
+        return self.uuid
+
+
+class MockService:
+    def __init__(self, uuid: str, characteristics: list):
+        self.uuid = uuid
+        self.characteristics = characteristics
+
+
+class MockBackend:
+    """Only holds the connection timeout, which CoyoteInterface.connect() doubles between retries."""
+
+    def __init__(self, timeout: float):
+        self._timeout = timeout
+
+
+class MockCoyoteClient:
+    """
+    Fake `bleak.BleakClient` of a Coyote.
+
+    Attributes:
+        pow_a (int): Power of channel a, as last written to the device.
+        pow_b (int): Power of channel b.
+        pattern_a (tuple): Pattern state (ax, ay, az) of channel a, as last written to the device.
+        pattern_b (tuple): Pattern state of channel b.
+        battery (int): Battery level (%).
+        writes (int): Number of writes applied to the device state.
+        drops (int): Number of writes lost.
+        disconnects (int): Number of simulated disconnects.
+        last_write_at (float): Monotonic time at which the last write was applied.
+    """
+
+    def __init__(
+        self,
+        address: str = MOCK_ADDRESS,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        drop_rate: float = 0.0,
+        disconnect_rate: float = 0.0,
+        battery: int = 100,
+        seed: int = None,
+        timeout: float = 10.0,
+    ):
+        """
+        :param address: Bluetooth address reported by the mock.
+        :param latency: Time (seconds) taken by every read and write.
+        :param jitter: Maximal random time (seconds) added to `latency`.
+        :param drop_rate: Probability that a write is lost. Writes with response raise an error when they are lost.
+        :param disconnect_rate: Probability that the device disconnects on a read or a write.
+        :param battery: Initial battery level (%).
+        :param seed: Seed of the simulated faults, for reproducible runs.
+        :param timeout: Connection timeout, unused.
+        """
+        self.address = address
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.disconnect_rate = disconnect_rate
+        self._random = random.Random(seed)
+        self._backend = MockBackend(timeout)
+        self._connected = False
+        self._notify = {}
+
+        self.pow_a = 0
+        self.pow_b = 0
+        self.pattern_a = (0, 0, 0)
+        self.pattern_b = (0, 0, 0)
+        self.battery = battery
+        self.writes = 0
+        self.drops = 0
+        self.disconnects = 0
+        self.last_write_at = None
+
+        self.services = [
+            MockService(
+                BATTERY_SERVICE, [MockCharacteristic(BATTERY_LEVEL, ["read", "notify"])]
+            ),
+            MockService(
+                PWM_SERVICE,
+                [
+                    MockCharacteristic(
+                        PWM_AB2, ["read", "write", "write-without-response", "notify"]
+                    ),
+                    MockCharacteristic(PWM_A34, ["read", "write"]),
+                    MockCharacteristic(PWM_B34, ["read", "write"]),
+                    MockCharacteristic(CONFIG, ["read"]),
+                ],
+            ),
+        ]
+
+    @property
+    def is_connected(self) -> bool:
+        return self._connected
+
+    async def _delay(self):
+        delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _check_connection(self):
+        if not self._connected:
+            raise ConnectionError("Mock Coyote is not connected")
+        if self.disconnect_rate and self._random.random() < self.disconnect_rate:
+            self._connected = False
+            self.disconnects += 1
+            raise ConnectionError("Mock Coyote disconnected")
+
+    async def connect(self, **kwargs) -> bool:
+        await self._delay()
+        self._connected = True
+        return True
+
+    async def disconnect(self) -> bool:
+        self._connected = False
+        self._notify.clear()
+        return True
+
+    async def read_gatt_char(self, characteristic, **kwargs) -> bytearray:
+        uuid = str(characteristic)
+        self._check_connection()
+        await self._delay()
+        if uuid == BATTERY_LEVEL:
+            return bytearray([self.battery])
+        if uuid == PWM_AB2:
+            return bytearray(dg_encoding.encode_power(self.pow_a, self.pow_b))
+        if uuid == PWM_A34:
+            return bytearray(dg_encoding.encode_pattern(*self.pattern_a))
+        if uuid == PWM_B34:
+            return bytearray(dg_encoding.encode_pattern(*self.pattern_b))
+        return bytearray(3)
+
+    async def write_gatt_char(self, characteristic, data, response: bool = False):
+        uuid = str(characteristic)
+        self._check_connection()
+        await self._delay()
+        if self.drop_rate and self._random.random() < self.drop_rate:
+            self.drops += 1
+            if response:
+                raise TimeoutError("Mock Coyote did not acknowledge the write")
+            return
+        # Same channel mapping as the device: xxxx1505 is channel b, xxxx1506 channel a.
+        if uuid == PWM_AB2:
+            self.pow_a, self.pow_b = dg_encoding.decode_power(data)
+        elif uuid == PWM_A34:
+            self.pattern_b = dg_encoding.decode_pattern(data)
+        elif uuid == PWM_B34:
+            self.pattern_a = dg_encoding.decode_pattern(data)
+        self.writes += 1
+        self.last_write_at = time.monotonic()
+        if uuid in self._notify:
+            self._notify[uuid](characteristic, bytearray(data))
+
+    async def start_notify(self, characteristic, callback, **kwargs):
+        self._notify[str(characteristic)] = callback
+
+    async def stop_notify(self, characteristic):
+        self._notify.pop(str(characteristic), None)
+
+    def set_battery(self, battery: int):
+        """Change the battery level, notifying the subscriber if any."""
+        self.battery = battery
+        callback = self._notify.get(BATTERY_LEVEL)
+        if callback is not None:
+            callback(BATTERY_LEVEL, bytearray([battery]))
+
+    def stats(self) -> dict:
+        return {
+            "connected": self._connected,
+            "pow_a": self.pow_a,
+            "pow_b": self.pow_b,
+            "pattern_a": self.pattern_a,
+            "pattern_b": self.pattern_b,
+            "battery": self.battery,
+            "writes": self.writes,
+            "drops": self.drops,
+            "disconnects": self.disconnects,
+        }
@@ -0,0 +1,76 @@
+"""
+Cache of e-stim patterns compiled to the byte messages written to the pattern characteristics of the Coyote.
+
+The patterns are fixed, so every state is encoded once with `dg_encoding.encode_pattern_batch` and stored in one
+contiguous buffer of 3-byte frames. Playback hands `memoryview` slices of that buffer straight to the GATT write.
+"""
+
+from array import array
+
+import toys.estim.coyote.dg_encoding as dg_encoding
+
+# Size of an encoded pattern state in bytes.
+FRAME_SIZE = 3
+
+
+class CompiledPattern:
+    """
+    Pre-encoded pattern.
+
+    Attributes:
+        source (list): The pattern this was compiled from, [[ax, ay, az], [ax, ay, az], ...].
+        frames (bytes): Encoded states, FRAME_SIZE bytes each.
+        durations (array): Duration (ms) of each state, i.e. pulse length + pause length.
+    """
+
+    __slots__ = ("source", "frames", "durations", "_view")
+
+    def __init__(self, source: list):
+        self.source = source
+        self.frames = bytes(dg_encoding.encode_pattern_batch(source))
+        self.durations = array("H", (ax + ay for ax, ay, az in source))
+        self._view = memoryview(self.frames)
+
+    def __len__(self) -> int:
+        return len(self.durations)
+
+    def frame(self, index: int) -> memoryview:
+        """
+        Return the encoded state at `index` without copying.
+        """
+        offset = index * FRAME_SIZE
+        return self._view[offset : offset + FRAME_SIZE]
+
+
+class PatternCache:
+    """
+    Compiled patterns by name.
+
+    An entry is recompiled when the pattern stored under its name is replaced by another object. Patterns modified in
+    place must be invalidated explicitly with `invalidate()`.
+    """
+
+    def __init__(self):
+        self._compiled = {}
+
+    def get(self, name: str, pattern: list) -> CompiledPattern:
+        """
+        Return the compiled version of `pattern`, compiling it on first use.
+
+        :param name: Name of the pattern.
+        :param pattern: The current pattern stored under that name.
+        """
+        compiled = self._compiled.get(name)
+        if compiled is None or compiled.source is not pattern:
+            compiled = CompiledPattern(pattern)
+            self._compiled[name] = compiled
+        return compiled
+
+    def invalidate(self, name: str = None):
+        """
+        Drop the compiled pattern `name`, or all of them if `name` is None.
+        """
+        if name is None:
+            self._compiled.clear()
+        else:
+            self._compiled.pop(name, None)
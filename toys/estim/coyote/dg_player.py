@@ -0,0 +1,384 @@
+"""
+Deadline driven playback of e-stim patterns.
+
+Every pattern state is scheduled against an absolute deadline on the event loop's monotonic clock. The next deadline
+is derived from the previous one rather than from the time the last write completed, so BLE latency does not
+accumulate into drift, and the player sleeps exactly until the next state is due.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+from array import array
+
+from common import metrics
+from common.util import *
+
+# Play every state for one device tick (`coyote_pattern_tick`), the coyote renders each waveform write for 100 ms.
+TIMING_TICK = "tick"
+# Play every state for its own duration, i.e. pulse length + pause length (ax + ay).
+TIMING_STATE = "state"
+
+# Lower bound of the duration of a single state (seconds), so that states of 0 ms do not flood the device.
+MIN_STATE_DURATION = 0.01
+# Interval (seconds) of the liveness check of the device.
+LIVENESS_INTERVAL = 1.0
+
+
+async def sleep_until(deadline: float):
+    """
+    Sleep until the given absolute time of the running event loop's clock.
+
+    :param deadline: Deadline in `loop.time()` seconds.
+    """
+    loop = asyncio.get_event_loop()
+    if deadline <= loop.time():
+        return
+    future = loop.create_future()
+    handle = loop.call_at(deadline, _wake, future)
+    try:
+        await future
+    finally:
+        handle.cancel()
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class JitterStats:
+    """
+    Lateness of the wakeups of a player compared to their deadlines (seconds).
+
+    The most recent samples are kept in a fixed-size ring to report percentiles without unbounded memory.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self._samples = array("d", bytes(8 * capacity))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.overruns = 0
+
+    def record(self, lateness: float):
+        self._samples[self.count % self.capacity] = lateness
+        self.count += 1
+        self.total += lateness
+        if lateness > self.max:
+            self.max = lateness
+
+    def stats(self) -> dict:
+        recent = sorted(self._samples[: min(self.count, self.capacity)])
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": recent[len(recent) // 2] * 1000 if recent else 0.0,
+            "p99_ms": recent[int(len(recent) * 0.99)] * 1000 if recent else 0.0,
+            "max_ms": self.max * 1000,
+            "overruns": self.overruns,
+        }
+
+
+class ChannelCursor:
+    """
+    Playback position of one channel.
+
+    Attributes:
+        channel (str): Output channel, either "a" or "b".
+        pattern_name (str): Name of the pattern being played.
+        pattern (Pattern): The pattern being played, if it was given directly instead of by name.
+        index (int): Index of the next state of the pattern.
+        deadline (float): Absolute time (`loop.time()`) at which the next state is due.
+        end_time (float): Absolute time (`loop.time()`) at which the playback of the channel ends.
+        switch_to (str): Pattern requested for this channel, applied before the next state is written.
+        done (asyncio.Future): Resolved once the channel stopped playing, i.e. it ended, was replaced or stopped.
+    """
+
+    __slots__ = (
+        "channel",
+        "characteristic",
+        "pattern_name",
+        "pattern",
+        "index",
+        "deadline",
+        "end_time",
+        "switch_to",
+        "done",
+    )
+
+    def __init__(
+        self, channel: str, characteristic, pattern, deadline: float, end_time: float
+    ):
+        """
+        :param channel: Output channel, either "a" or "b".
+        :param characteristic: The pattern characteristic of the channel.
+        :param pattern: Name of the pattern or a Pattern.
+        :param deadline: Absolute time (`loop.time()`) at which the first state is due.
+        :param end_time: Absolute time (`loop.time()`) at which the playback of the channel ends.
+        """
+        self.channel = channel
+        self.characteristic = characteristic
+        if isinstance(pattern, str):
+            self.pattern_name = pattern
+            self.pattern = None
+        else:
+            self.pattern_name = "custom_" + channel
+            self.pattern = pattern
+        self.index = 0
+        self.deadline = deadline
+        self.end_time = end_time
+        self.switch_to = None
+        self.done = asyncio.get_event_loop().create_future()
+
+    def finish(self):
+        if not self.done.done():
+            self.done.set_result(None)
+
+
+class MultiplexPlayer:
+    """
+    Plays the patterns of both channels of a CoyoteInterface from a single task.
+
+    The cursors of all playing channels are kept in one heap ordered by deadline, so the player wakes up once for
+    every due state of any channel, and the liveness check of the device is shared by all channels. Pattern switches
+    are requested per channel and do not interrupt the other channel, and play_channel() starts or replaces the
+    playback of one channel while the other one keeps playing.
+
+    Attributes:
+        interface (CoyoteInterface): The device to play on.
+        timing (str): TIMING_TICK or TIMING_STATE.
+        tick (float): Duration of a device tick in seconds.
+        jitter (dict): Measured lateness (JitterStats) of the state writes per channel.
+        wakeups (int): Number of times the player actually had to sleep until a deadline.
+        writes (int): Number of pattern states written to the device.
+    """
+
+    def __init__(self, interface, timing: str = TIMING_TICK, tick: float = 0.1):
+        self.interface = interface
+        self.timing = timing
+        self.tick = tick
+        self.cursors = {}
+        self.jitter = {"a": JitterStats(), "b": JitterStats()}
+        self._lateness = {
+            c: metrics.stage(metrics.STAGE_PATTERN_LATENESS, c) for c in ("a", "b")
+        }
+        self._write_latency = {
+            c: metrics.stage(metrics.STAGE_PATTERN_WRITE, c) for c in ("a", "b")
+        }
+        self._writes = {c: metrics.pattern_writes.labels(c) for c in ("a", "b")}
+        self.wakeups = 0
+        self.writes = 0
+        # Incremented by every call of self.play(), so that an older session stops once a newer one has started.
+        self._session = 0
+        # Deadline heap [(deadline, order, ChannelCursor)] of the running session, None while idle.
+        self._heap = None
+        self._order = itertools.count()
+        # Future the running session sleeps on, resolved early to wake it up.
+        self._wakeup = None
+
+    @property
+    def is_playing(self) -> bool:
+        return bool(self.cursors)
+
+    def state_duration(self, duration: int) -> float:
+        """
+        Duration (seconds) for which a state is played before the next one is due.
+
+        :param duration: duration of the state in ms, i.e. pulse length + pause length
+        """
+        if self.timing == TIMING_STATE:
+            return max(MIN_STATE_DURATION, duration / 1000)
+        return self.tick
+
+    def switch_pattern(self, channel: str, pattern_name: str):
+        """
+        Request another pattern for a channel. It starts from its first state when the channel's next state is due.
+
+        :param channel: Output channel, either "a" or "b".
+        :param pattern_name: Name of the pattern.
+        """
+        cursor = self.cursors.get(channel)
+        if cursor is not None and cursor.pattern_name != pattern_name:
+            cursor.switch_to = pattern_name
+
+    def _characteristic(self, channel: str):
+        ci = self.interface
+        return ci._pwm_b34 if channel == "b" else ci._pwm_a34
+
+    def _pattern(self, cursor: ChannelCursor):
+        if cursor.pattern is not None:
+            return cursor.pattern
+        return self.interface.patterns[cursor.pattern_name]
+
+    def _cursor(
+        self, channel: str, pattern, now: float, duration: int, offset: int
+    ) -> ChannelCursor:
+        cursor = ChannelCursor(
+            channel, self._characteristic(channel), pattern, now, now + duration / 1000
+        )
+        pattern = self._pattern(cursor)
+        # Compile the pattern before playback starts
+        self.interface.pattern_cache.get(cursor.pattern_name, pattern)
+        if offset:
+            cursor.index = pattern.seek(offset)[0]
+        return cursor
+
+    def _wake(self):
+        if self._wakeup is not None:
+            _wake(self._wakeup)
+
+    async def _sleep_until(self, deadline: float):
+        """
+        Like sleep_until(), but returns early when woken up by self._wake().
+        """
+        loop = asyncio.get_event_loop()
+        future = self._wakeup = loop.create_future()
+        handle = loop.call_at(deadline, _wake, future)
+        try:
+            await future
+        finally:
+            handle.cancel()
+            if self._wakeup is future:
+                self._wakeup = None
+
+    async def play_channel(self, channel: str, pattern, duration: int, offset: int = 0):
+        """
+        Play a pattern on one channel until the duration is over, it is replaced or the device is stopped. The other
+        channel keeps playing: the channel joins the running session, or starts one if the player is idle.
+
+        :param channel: Output channel, either "a" or "b".
+        :param pattern: Name of the pattern or a Pattern.
+        :param duration: Duration in milliseconds.
+        :param offset: Start the pattern with the state playing at this time (ms) since its start.
+        """
+        if self._heap is None:
+            await self.play({channel: pattern}, duration, offset)
+            return
+        now = asyncio.get_event_loop().time()
+        cursor = self._cursor(channel, pattern, now, duration, offset)
+        replaced = self.cursors.get(channel)
+        self.cursors[channel] = cursor
+        if replaced is not None:
+            replaced.finish()
+        heapq.heappush(self._heap, (now, next(self._order), cursor))
+        self._wake()
+        await cursor.done
+
+    async def play(self, patterns: dict, duration: int, offset: int = 0):
+        """
+        Play patterns in a loop until the duration is over or the device is stopped. Replaces the playback of all the
+        channels.
+
+        :param patterns: Name of the pattern (or a Pattern) to play per channel, e.g. {"a": "vibrator_4"}.
+        :param duration: Duration in milliseconds.
+        :param offset: Start the patterns with the state playing at this time (ms) since their start.
+        """
+        ci = self.interface
+        loop = asyncio.get_event_loop()
+        self._session += 1
+        session = self._session
+        # The replaced session returns at once
+        self._wake()
+
+        now = loop.time()
+        next_liveness_check = now + LIVENESS_INTERVAL
+        self.cursors = {
+            channel: self._cursor(channel, name, now, duration, offset)
+            for channel, name in patterns.items()
+        }
+        heap = self._heap = [
+            (now, next(self._order), cursor) for cursor in self.cursors.values()
+        ]
+        heapq.heapify(heap)
+        try:
+            while heap:
+                deadline, _, cursor = heap[0]
+                if ci.stop_signal or session != self._session:
+                    return
+                channel = cursor.channel
+                if self.cursors.get(channel) is not cursor:
+                    # Replaced by play_channel()
+                    heapq.heappop(heap)
+                    continue
+                if deadline >= cursor.end_time:
+                    info(f"Shock - Hit time limit, stopping channel {channel}")
+                    heapq.heappop(heap)
+                    del self.cursors[channel]
+                    cursor.finish()
+                    continue
+                if deadline > loop.time():
+                    self.wakeups += 1
+                    # Woken up early when a channel joins, look at the heap again.
+                    await self._sleep_until(deadline)
+                    continue
+                heapq.heappop(heap)
+                now = loop.time()
+                self.jitter[channel].record(now - deadline)
+                self._lateness[channel].record(now - deadline)
+
+                # Check to see if the device is still alive once per second, shared by all channels
+                if now >= next_liveness_check:
+                    if not await ci.is_running():
+                        return
+                    next_liveness_check = now + LIVENESS_INTERVAL
+
+                if cursor.switch_to is not None:
+                    cursor.pattern_name = cursor.switch_to
+                    cursor.pattern = None
+                    cursor.switch_to = None
+                    cursor.index = 0
+                pattern = self._pattern(cursor)
+                if not pattern:
+                    logging.error(
+                        f"Pattern {cursor.pattern_name} is empty, stopping channel {channel}"
+                    )
+                    del self.cursors[channel]
+                    cursor.finish()
+                    continue
+                compiled = ci.pattern_cache.get(cursor.pattern_name, pattern)
+                if cursor.index >= len(compiled):
+                    cursor.index = 0
+                frame = compiled.frame(cursor.index)
+                state_duration = compiled.durations[cursor.index]
+                cursor.index += 1
+
+                # Send the pre-encoded state to bluetooth device
+                start = loop.time()
+                await ci.device.write_gatt_char(cursor.characteristic, frame)
+                self._write_latency[channel].record(loop.time() - start)
+                self._writes[channel].inc()
+                self.writes += 1
+                ci.can_update_power = True
+
+                deadline += self.state_duration(state_duration)
+                now = loop.time()
+                if deadline < now:
+                    # We are more than a whole state behind (e.g. a slow write), resynchronize instead of bursting
+                    # the missed states to the device.
+                    self.jitter[channel].overruns += 1
+                    deadline = now
+                cursor.deadline = deadline
+                heapq.heappush(heap, (deadline, next(self._order), cursor))
+        finally:
+            for _, _, cursor in heap:
+                cursor.finish()
+            if session == self._session:
+                for cursor in self.cursors.values():
+                    cursor.finish()
+                self.cursors = {}
+                self._heap = None
+
+    def stats(self) -> dict:
+        return {
+            "playing": {
+                channel: cursor.pattern_name for channel, cursor in self.cursors.items()
+            },
+            "wakeups": self.wakeups,
+            "writes": self.writes,
+            "jitter": {
+                channel: jitter.stats() for channel, jitter in self.jitter.items()
+            },
+        }
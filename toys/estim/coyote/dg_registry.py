@@ -0,0 +1,253 @@
+"""
+Registry of the DG-Lab Coyote boxes driven by the app, keyed by bluetooth address.
+
+Every device has its own CoyoteInterface, i.e. its own power writer task, pattern player and battery monitor, and its
+own settings (DeviceSettings), which fall back to the main `coyote_*` settings when unset. All devices are fed from
+the same OSC stream: the registry lists the inputs of every channel, from which the OSC routing table is built.
+
+Devices connect in parallel, so a slow or unreachable device never holds up the others.
+"""
+
+import asyncio
+import logging
+import platform
+
+from common.shm_ring import ORDERED_STORES
+from settings import DeviceSettings, settings
+from toys.estim.coyote.dg_interface import CoyoteInterface
+from toys.estim.coyote.dg_worker import CoyoteWorkerClient
+
+
+def create_interface(device_uid: str):
+    """
+    Create the interface to a device: a CoyoteInterface, or a CoyoteWorkerClient if `settings.coyote_worker` is set
+    and the CPU supports it.
+
+    :param device_uid: The bluetooth address of the device, empty to search for it.
+    """
+    if settings.coyote_worker:
+        if ORDERED_STORES:
+            return CoyoteWorkerClient(device_uid)
+        logging.warning(
+            f"coyote_worker is not supported on {platform.machine()}, the device runs in the app"
+        )
+    return CoyoteInterface(device_uid=device_uid, power_multiplier=1.28, safe_mode=True)
+
+
+class CoyoteDevice:
+    """
+    One registered Coyote.
+
+    Attributes:
+        config (DeviceSettings): Settings of the device.
+        interface (CoyoteInterface): Interface to the device.
+        error (str): Error of the last connection attempt, None if it succeeded.
+        task (asyncio.Task): Playback of the patterns of both channels, while started.
+    """
+
+    def __init__(self, config: DeviceSettings, interface: CoyoteInterface = None):
+        """
+        :param config: Settings of the device.
+        :param interface: Interface to the device, created from `config.uid` if not given.
+        """
+        self.config = config
+        if interface is None:
+            interface = create_interface(config.uid)
+        self.interface = interface
+        self.error = None
+        self.task = None
+
+    @property
+    def id(self) -> str:
+        return self.interface.device_uid or self.config.uid
+
+    @property
+    def is_connected(self) -> bool:
+        return self.interface.is_connected
+
+    def get(self, name: str, channel: str):
+        """
+        Get a setting of a channel of the device, e.g. get("max_power", "a").
+
+        :param name: "addr", "max_power", "pattern" or "combine".
+        :param channel: "a" or "b".
+        """
+        value = getattr(self.config, f"{name}_{channel}")
+        if value is None:
+            value = getattr(settings, f"coyote_{name}_{channel}")
+        return value
+
+    async def connect(self, retries: int = 3) -> bool:
+        """
+        Connect to the device, searching for it first if its address is unknown.
+
+        :return: True if connected. Errors are logged and kept in self.error instead of being raised.
+        """
+        ci = self.interface
+        try:
+            if ci.device is None:
+                await ci.search_for_device()
+            await ci.connect(retries=retries)
+            self.error = None
+            return True
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+            logging.error(f"Failed to connect to coyote {self.id}: {self.error}")
+            return False
+
+    def start(self):
+        """Play the patterns of the device on both channels, until stopped."""
+        if self.task is not None and not self.task.done():
+            return
+        self.task = asyncio.ensure_future(self.play())
+
+    async def play(self):
+        ci = self.interface
+        await ci.play(
+            pow_a=int(self.get("max_power", "a") * settings.min_power),
+            pow_b=int(self.get("max_power", "b") * settings.min_power),
+            patterns={"a": self.get("pattern", "a"), "b": self.get("pattern", "b")},
+            duration=100000000,
+        )
+
+    async def stop(self):
+        """Set the power to zero, stop the playback and disconnect."""
+        ci = self.interface
+        if ci.is_connected:
+            await ci.stop()
+            await ci.disconnect()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.task = None
+
+    def status(self) -> dict:
+        ci = self.interface
+        return {
+            "id": self.id,
+            "name": self.config.name,
+            "is_connected": ci.is_connected,
+            "battery_level": ci.battery if ci.is_connected else 0,
+            "battery_age": ci.battery_age(),
+            "pow_a": ci.pow_a,
+            "pow_b": ci.pow_b,
+            "playing": ci.player.is_playing,
+            "error": self.error,
+            **{
+                f"{name}_{channel}": self.get(name, channel)
+                for name in ("addr", "max_power", "pattern", "combine")
+                for channel in ("a", "b")
+            },
+        }
+
+
+class DeviceRegistry:
+    """
+    The devices driven by the app.
+
+    The main device (`coyote_uid`) is kept apart from the additional devices (`coyote_devices`), because it is
+    created on demand by the single-device API and may not know its address before it was found.
+    """
+
+    def __init__(self):
+        self.primary = None
+        self.devices = {}
+
+    def __iter__(self):
+        if self.primary is not None:
+            yield self.primary
+        # A copy, as /metrics lists the devices from the web server's thread while the control loop adds or removes one.
+        yield from list(self.devices.values())
+
+    def __len__(self) -> int:
+        return len(self.devices) + (self.primary is not None)
+
+    def set_primary(self, interface: CoyoteInterface) -> CoyoteDevice:
+        """
+        Register the interface of the main device, replacing the previous one.
+        """
+        self.primary = CoyoteDevice(DeviceSettings(uid=settings.coyote_uid), interface)
+        return self.primary
+
+    def get(self, device_id: str) -> CoyoteDevice:
+        """
+        Find a device by id (bluetooth address), None if it is not registered.
+        """
+        for device in self:
+            if device.id.lower() == device_id.lower():
+                return device
+        return None
+
+    def add(self, config: DeviceSettings) -> CoyoteDevice:
+        """
+        Register an additional device.
+
+        :raise ValueError: The address is missing, or a device with the same id is already registered.
+        """
+        if not config.uid:
+            raise ValueError("The bluetooth address of the device is required")
+        if self.get(config.uid) is not None:
+            raise ValueError(f"Device {config.uid} is already registered")
+        device = self.devices[config.uid] = CoyoteDevice(config)
+        return device
+
+    def remove(self, device_id: str) -> CoyoteDevice:
+        """
+        Unregister an additional device, the caller is responsible for stopping it.
+
+        :raise KeyError: No such additional device.
+        """
+        device = self.get(device_id)
+        if device is None or device is self.primary:
+            raise KeyError(device_id)
+        return self.devices.pop(device.config.uid)
+
+    async def connect(self, devices: list = None) -> dict:
+        """
+        Connect to devices in parallel.
+
+        :param devices: The devices to connect to, defaults to all the devices which are not connected.
+        :return: Whether each device is connected, by id.
+        """
+        if devices is None:
+            devices = [device for device in self if not device.is_connected]
+        results = await asyncio.gather(*(device.connect() for device in devices))
+        return {device.id: connected for device, connected in zip(devices, results)}
+
+    async def stop(self):
+        """Stop all the devices, in parallel."""
+        await asyncio.gather(
+            *(device.stop() for device in self), return_exceptions=True
+        )
+
+    def channels(self) -> list:
+        """
+        The channels of all the devices, with the OSC addresses (or patterns) mapped to them: the address of the
+        channel, and the entries of `settings.osc_routes` for the channel and the device.
+
+        :return: [(CoyoteInterface, channel, max power, combine mode, [(address, weight), ...]), ...]
+        """
+        channels = []
+        for device in self:
+            device_id = device.id.lower()
+            for channel in ("a", "b"):
+                inputs = [(device.get("addr", channel), 1.0)]
+                inputs += [
+                    (route.address, route.weight)
+                    for route in settings.osc_routes
+                    if route.channel == channel
+                    and (not route.device or route.device.lower() == device_id)
+                ]
+                channels.append(
+                    (
+                        device.interface,
+                        channel,
+                        device.get("max_power", channel),
+                        device.get("combine", channel),
+                        inputs,
+                    )
+                )
+        return channels
@@ -0,0 +1,198 @@
+"""
+Coalescing writer for the power characteristic of the DG-Lab Coyote.
+
+The OSC handlers may request new power levels far more often than the device can take them. Instead of spawning a
+write task per request, producers call `PowerScheduler.request()`, which only stores the latest target of each channel
+(last writer wins). A single writer task per device flushes the targets at most once per device cycle.
+"""
+
+import asyncio
+import logging
+import time
+
+from common import metrics
+
+
+class PowerScheduler:
+    """
+    Single writer task for the power characteristic (`_pwm_ab2`) of one Coyote.
+
+    Attributes:
+        interval (float): Minimal time (seconds) between two power writes, i.e. the device cycle.
+        requested (int): Number of power updates requested by producers.
+        coalesced (int): Number of requested updates replaced by a newer one before they were written.
+        dropped (int): Number of flushed updates which did not result in a write (no significant change, out of
+                        range or failed).
+        written (int): Number of power writes sent to the device.
+    """
+
+    def __init__(self, interface, interval: float = 0.1):
+        """
+        :param interface: The CoyoteInterface to write to.
+        :param interval: Minimal time (seconds) between two power writes.
+        """
+        self.interface = interface
+        self.interval = interval
+
+        # Latest requested power of channel a and b, -1 if there is nothing to write for the channel.
+        self._target_a = -1
+        self._target_b = -1
+        # Monotonic times at which the pending target of each channel was first requested, and at which the OSC
+        # message behind it was received (None if unknown), for the latency metrics.
+        self._queued_a = None
+        self._queued_b = None
+        self._received_a = None
+        self._received_b = None
+
+        self._queue_latency_a = metrics.stage(metrics.STAGE_POWER_QUEUE, "a")
+        self._queue_latency_b = metrics.stage(metrics.STAGE_POWER_QUEUE, "b")
+        self._e2e_latency_a = metrics.stage(metrics.STAGE_OSC_TO_POWER, "a")
+        self._e2e_latency_b = metrics.stage(metrics.STAGE_OSC_TO_POWER, "b")
+        self._writes = metrics.power_writes.labels()
+
+        self._wakeup = None
+        self._lock = None
+        self._task = None
+
+        self.requested = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+        self._started_at = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def request(self, pow_a: int, pow_b: int, received_at: float = None):
+        """
+        Request new power levels. Never blocks; the latest request of each channel wins.
+
+        :param pow_a: Output power of channel a, if set to -1, the power level will not be changed
+        :param pow_b: Output power of channel b, if set to -1, the power level will not be changed
+        :param received_at: Monotonic time at which the OSC message behind the request was received.
+        """
+        self.requested += 1
+        replaced = False
+        if pow_a >= 0:
+            replaced = self._target_a >= 0
+            if not replaced:
+                # A coalesced request keeps the times of the oldest one, which waited the longest.
+                self._queued_a = time.monotonic()
+                self._received_a = received_at
+            self._target_a = pow_a
+        if pow_b >= 0:
+            if self._target_b >= 0:
+                replaced = True
+            else:
+                self._queued_b = time.monotonic()
+                self._received_b = received_at
+            self._target_b = pow_b
+        if replaced:
+            self.coalesced += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def clear(self):
+        """Forget the pending targets."""
+        if self._target_a >= 0 or self._target_b >= 0:
+            self.dropped += 1
+        self._target_a = -1
+        self._target_b = -1
+
+    def start(self):
+        """Start the writer task on the running event loop."""
+        if self.is_running:
+            return
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        if self._target_a >= 0 or self._target_b >= 0:
+            self._wakeup.set()
+        self._started_at = time.monotonic()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop the writer task. Pending targets are discarded."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._wakeup = None
+        self.clear()
+
+    async def write_now(self, pow_a: int, pow_b: int) -> bool:
+        """
+        Write power levels immediately, bypassing (and discarding) the pending targets.
+
+        Used for commands which must not be coalesced, e.g. stopping the output.
+
+        :param pow_a: Output power of channel a, if set to -1, the power level will not be changed
+        :param pow_b: Output power of channel b, if set to -1, the power level will not be changed
+        :return: True if the power was written to the device.
+        """
+        self.clear()
+        if self._lock is None:
+            return await self._write(pow_a, pow_b)
+        async with self._lock:
+            return await self._write(pow_a, pow_b)
+
+    async def _write(self, pow_a: int, pow_b: int) -> bool:
+        try:
+            written = await self.interface.set_pwm(pow_a, pow_b)
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Failed to write power ({pow_a}, {pow_b}): {e}")
+            written = False
+        if written:
+            self.written += 1
+            self._writes.inc()
+        else:
+            self.dropped += 1
+        return written
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            async with self._lock:
+                pow_a, pow_b = self._target_a, self._target_b
+                self._target_a = -1
+                self._target_b = -1
+                if pow_a < 0 and pow_b < 0:
+                    continue
+                deadline = loop.time() + self.interval
+                start = time.monotonic()
+                if pow_a >= 0:
+                    self._queue_latency_a.record(start - self._queued_a)
+                if pow_b >= 0:
+                    self._queue_latency_b.record(start - self._queued_b)
+                received_a = self._received_a if pow_a >= 0 else None
+                received_b = self._received_b if pow_b >= 0 else None
+                if await self._write(pow_a, pow_b):
+                    end = time.monotonic()
+                    if received_a is not None:
+                        self._e2e_latency_a.record(end - received_a)
+                    if received_b is not None:
+                        self._e2e_latency_b.record(end - received_b)
+            # Hold off until the device cycle is over, newer requests are coalesced meanwhile.
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+    def stats(self) -> dict:
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        return {
+            "running": self.is_running,
+            "interval": self.interval,
+            "requested": self.requested,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "written": self.written,
+            "errors": self.errors,
+            "writes_per_second": self.written / uptime if uptime > 0 else 0.0,
+            "max_writes_per_second": 1 / self.interval if self.interval > 0 else None,
+        }
@@ -0,0 +1,885 @@
+"""
+Run the bluetooth I/O of a DG-Lab Coyote in a worker process, with its own event loop, so that the timing of the
+patterns is not disturbed by the HTTP server, the OSC listener or the settings being saved.
+
+The app and the worker talk through two SpscRing in shared memory: power targets and pattern commands go to the
+worker in the command ring, status snapshots and metric samples come back in the telemetry ring. Posting a command
+also sends a byte on a socket pair, which wakes the event loop of the worker up at once (asyncio timers only have a
+resolution of ~15.6 ms on Windows); the app polls the telemetry ring. Neither side ever blocks on the other: a
+posted command never holds up an OSC handler and the worker never waits for the app.
+
+In the app, CoyoteWorkerClient stands in for CoyoteInterface and mirrors the state reported by the worker. It also
+supervises the worker: a worker which exits or stops reporting is restarted, and resumes the last playback.
+
+Enabled by `settings.coyote_worker`, on x86 only (see common/shm_ring.py).
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import socket
+import struct
+import time
+
+from common import metrics
+from common.shm_ring import PAYLOAD_SIZE, SpscRing
+from settings import settings
+from toys.estim.coyote.dg_interface import CoyoteInterface
+import toys.estim.coyote.dg_mock as dg_mock
+from toys.estim.estim import Estim
+
+# Commands (app -> worker). t1 of every record is the time.perf_counter() at which it was posted.
+CMD_POWER = 1  # a, b: power (-1: unchanged), t2: time.monotonic() of the OSC message, -1 if unknown
+CMD_POWER_NOW = 2  # a, b: power, written at once instead of being coalesced
+CMD_PLAY = 3  # a, b: power, t2: duration (ms), payload: "session\noffset\npattern_a\npattern_b"
+CMD_SWITCH_PATTERN = 4  # channel: 0 for a, 1 for b, payload: pattern name
+CMD_STOP = 5
+CMD_DISCONNECT = 6
+# channel: 0 for a, 1 for b, a: power, t2: duration (ms), payload: "session\noffset\npattern"
+CMD_SIGNAL = 7
+
+# Telemetry (worker -> app)
+TEL_STATUS = 1  # payload: STATUS
+TEL_SAMPLE = 2  # payload: "stage/channel", t2: latency (seconds)
+TEL_COUNT = 3  # payload: "metric/label", a: increment
+TEL_ERROR = 4  # payload: error message
+TEL_PLAY_ENDED = 5  # a: session of the CMD_PLAY or CMD_SIGNAL, channel: its channel, CHANNEL_BOTH for CMD_PLAY
+TEL_CONNECTED = 6  # payload: bluetooth address of the device
+
+# Channels by their index in the records.
+CHANNELS = ("a", "b")
+CHANNEL_BOTH = 2
+
+STATUS_FIELDS = (
+    "connected",
+    "battery",
+    "battery_age_ms",
+    "pow_a",
+    "pow_b",
+    "playing_a",
+    "playing_b",
+    "requested",
+    "coalesced",
+    "dropped",
+    "written",
+    "errors",
+    "reconnects",
+    "verified_writes",
+    "verify_mismatches",
+    "overruns_a",
+    "overruns_b",
+    "pattern_writes",
+)
+STATUS = struct.Struct(f"<{len(STATUS_FIELDS)}i")
+
+COMMAND_CAPACITY = 1024
+TELEMETRY_CAPACITY = 4096
+# Interval (seconds) of polling the telemetry ring in the app.
+CLIENT_POLL_INTERVAL = 0.005
+# Interval (seconds) of the status snapshots, which are also the heartbeat of the worker.
+STATUS_INTERVAL = 0.1
+# A worker which did not report for this long (seconds) is considered hung, and restarted.
+HEARTBEAT_TIMEOUT = 5.0
+# Delay (seconds) before restarting a worker, doubled after every restart up to RESTART_MAX_DELAY, and reset once
+# a worker ran for STABLE_AFTER seconds.
+RESTART_DELAY = 0.5
+RESTART_MAX_DELAY = 30.0
+STABLE_AFTER = 60.0
+# Time (seconds) given to the worker to disconnect from the device before it is killed.
+DISCONNECT_TIMEOUT = 5.0
+
+# Exit code of a worker which could not connect to the device.
+EXIT_CONNECT_FAILED = 2
+
+
+def _encode(text: str, truncate: bool = False) -> bytes:
+    """
+    :param truncate: Cut a text which does not fit in a record, instead of raising ValueError.
+    """
+    payload = text.encode()
+    if len(payload) > PAYLOAD_SIZE:
+        if not truncate:
+            raise ValueError(
+                f"{text!r} does not fit in the {PAYLOAD_SIZE} bytes of a record"
+            )
+        payload = payload[:PAYLOAD_SIZE]
+    return payload
+
+
+def _decode(payload: bytes) -> str:
+    return payload.rstrip(b"\0").decode(errors="replace")
+
+
+class ForwardedHistogram(metrics.Histogram):
+    """Histogram of the worker process, which sends its samples to the app instead of keeping them."""
+
+    __slots__ = ("_ring", "_key")
+
+    def __init__(self, ring: SpscRing, key: bytes):
+        super().__init__()
+        self._ring = ring
+        self._key = key
+
+    def record(self, seconds: float):
+        self._ring.put(TEL_SAMPLE, t2=seconds, payload=self._key)
+
+
+class ForwardedCounter(metrics.Counter):
+    """Counter of the worker process, which sends its increments to the app instead of keeping them."""
+
+    __slots__ = ("_ring", "_key")
+
+    def __init__(self, ring: SpscRing, key: bytes):
+        super().__init__()
+        self._ring = ring
+        self._key = key
+
+    def inc(self, n: int = 1):
+        self._ring.put(TEL_COUNT, a=n, payload=self._key)
+
+
+def forward_metrics(ring: SpscRing):
+    """
+    Send the output metrics of this process to the app. Must be called before the CoyoteInterface is created.
+    """
+    for name in (
+        metrics.STAGE_POWER_QUEUE,
+        metrics.STAGE_POWER_WRITE,
+        metrics.STAGE_OSC_TO_POWER,
+        metrics.STAGE_PATTERN_LATENESS,
+        metrics.STAGE_PATTERN_WRITE,
+        metrics.STAGE_IPC_COMMAND,
+    ):
+        for channel in ("a", "b", "ab"):
+            metrics.stage_latency.children[(name, channel)] = ForwardedHistogram(
+                ring, _encode(f"{name}/{channel}")
+            )
+    metrics.power_writes.children[()] = ForwardedCounter(
+        ring, _encode(f"{metrics.power_writes.name}/")
+    )
+    for channel in ("a", "b"):
+        metrics.pattern_writes.children[(channel,)] = ForwardedCounter(
+            ring, _encode(f"{metrics.pattern_writes.name}/{channel}")
+        )
+
+
+class Worker:
+    """
+    The worker side: drives the CoyoteInterface with the commands of the app.
+    """
+
+    def __init__(
+        self,
+        commands: SpscRing,
+        telemetry: SpscRing,
+        wakeup: socket.socket,
+        device_uid: str,
+    ):
+        """
+        :param wakeup: Socket receiving a byte whenever a command is posted.
+        """
+        self.commands = commands
+        self.telemetry = telemetry
+        self.wakeup = wakeup
+        forward_metrics(telemetry)
+        self.ci = CoyoteInterface(
+            device_uid=device_uid, power_multiplier=1.28, safe_mode=True
+        )
+        self.ipc_latency = metrics.stage(metrics.STAGE_IPC_COMMAND, "ab")
+        self.running = True
+        self.connected = None
+        self.tasks = set()
+
+    async def run(self) -> int:
+        """
+        Serve the commands until disconnected.
+
+        :return: Exit code of the process.
+        """
+        loop = asyncio.get_running_loop()
+        self.connected = asyncio.Event()
+        connecting = asyncio.ensure_future(self.connect())
+        woken = None
+        next_status = 0.0
+        try:
+            while self.running:
+                # Read the wakeup bytes before the ring, so that a command posted meanwhile sends a new one.
+                if woken is None or woken.done():
+                    woken = asyncio.ensure_future(loop.sock_recv(self.wakeup, 4096))
+                record = self.commands.get()
+                while record is not None:
+                    self.handle(*record)
+                    record = self.commands.get()
+                if connecting.done() and not connecting.result():
+                    return EXIT_CONNECT_FAILED
+                now = time.perf_counter()
+                if now >= next_status:
+                    self.send_status(now)
+                    next_status = now + STATUS_INTERVAL
+                waits = {woken} if connecting.done() else {woken, connecting}
+                await asyncio.wait(
+                    waits,
+                    timeout=max(next_status - time.perf_counter(), 0),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            if self.ci.is_connected:
+                await self.ci.stop()
+                await self.ci.disconnect()
+            return 0
+        finally:
+            connecting.cancel()
+            if woken is not None:
+                woken.cancel()
+
+    async def connect(self) -> bool:
+        ci = self.ci
+        try:
+            if ci.device is None:
+                await ci.search_for_device()
+            await ci.connect(retries=3)
+        except Exception as e:
+            self.telemetry.put(
+                TEL_ERROR, payload=_encode(str(e) or type(e).__name__, truncate=True)
+            )
+            return False
+        self.telemetry.put(TEL_CONNECTED, payload=_encode(ci.device_uid))
+        self.connected.set()
+        return True
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def handle(self, kind, channel, a, b, t1, t2, payload):
+        ci = self.ci
+        self.ipc_latency.record(time.perf_counter() - t1)
+        if kind == CMD_POWER:
+            ci.request_pwm(a, b, t2 if t2 >= 0 else None)
+        elif kind == CMD_POWER_NOW:
+            if ci.is_connected:
+                self.spawn(ci.power_scheduler.write_now(a, b))
+        elif kind == CMD_PLAY:
+            session, offset, pattern_a, pattern_b = _decode(payload).split("\n")
+            patterns = {"a": pattern_a, "b": pattern_b}
+            patterns = {c: name for c, name in patterns.items() if name}
+            self.spawn(self.play(int(session), a, b, patterns, int(t2), int(offset)))
+        elif kind == CMD_SIGNAL:
+            session, offset, pattern = _decode(payload).split("\n")
+            self.spawn(
+                self.signal(int(session), channel, a, pattern, int(t2), int(offset))
+            )
+        elif kind == CMD_SWITCH_PATTERN:
+            ci.switch_pattern(CHANNELS[channel], _decode(payload))
+        elif kind == CMD_STOP:
+            self.spawn(ci.stop())
+        elif kind == CMD_DISCONNECT:
+            self.running = False
+
+    async def play(
+        self,
+        session: int,
+        pow_a: int,
+        pow_b: int,
+        patterns: dict,
+        duration: int,
+        offset: int,
+    ):
+        await self.connected.wait()
+        try:
+            await self.ci.play(pow_a, pow_b, patterns, duration, offset)
+        except Exception as e:
+            logging.error(f"Playback failed: {e}")
+        finally:
+            self.telemetry.put(
+                TEL_PLAY_ENDED, CHANNEL_BOTH, a=session, t1=time.perf_counter()
+            )
+
+    async def signal(
+        self,
+        session: int,
+        channel: int,
+        power: int,
+        pattern_name: str,
+        duration: int,
+        offset: int,
+    ):
+        await self.connected.wait()
+        try:
+            await self.ci.signal(
+                power, pattern_name, duration, CHANNELS[channel], offset
+            )
+        except Exception as e:
+            logging.error(f"Playback failed: {e}")
+        finally:
+            self.telemetry.put(
+                TEL_PLAY_ENDED, channel, a=session, t1=time.perf_counter()
+            )
+
+    def send_status(self, now: float):
+        ci = self.ci
+        scheduler = ci.power_scheduler
+        player = ci.player
+        age = ci.battery_age()
+        status = STATUS.pack(
+            int(ci.is_connected),
+            ci.battery,
+            -1 if age is None else int(age * 1000),
+            ci.pow_a,
+            ci.pow_b,
+            int("a" in player.cursors),
+            int("b" in player.cursors),
+            scheduler.requested,
+            scheduler.coalesced,
+            scheduler.dropped,
+            scheduler.written,
+            scheduler.errors,
+            ci.reconnects,
+            ci.verified_writes,
+            ci.verify_mismatches,
+            player.jitter["a"].overruns,
+            player.jitter["b"].overruns,
+            player.writes,
+        )
+        self.telemetry.put(TEL_STATUS, t1=now, payload=status)
+
+
+def run_worker(
+    commands_name: str,
+    telemetry_name: str,
+    wakeup: socket.socket,
+    device_uid: str,
+    mock: bool,
+):
+    """
+    Entry point of the worker process.
+    """
+    logging.basicConfig(level=logging.INFO)
+    dg_mock.enabled = mock
+    commands = SpscRing.attach(commands_name, COMMAND_CAPACITY)
+    telemetry = SpscRing.attach(telemetry_name, TELEMETRY_CAPACITY)
+    wakeup.setblocking(False)
+    try:
+        code = asyncio.run(Worker(commands, telemetry, wakeup, device_uid).run())
+    finally:
+        commands.close()
+        telemetry.close()
+        wakeup.close()
+    raise SystemExit(code)
+
+
+class RemoteScheduler:
+    """Counters of the PowerScheduler of the worker, as last reported."""
+
+    def __init__(self):
+        self.requested = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+        self.started_at = None
+
+    def stats(self) -> dict:
+        uptime = time.monotonic() - self.started_at if self.started_at else 0.0
+        interval = settings.coyote_power_interval
+        return {
+            "running": self.started_at is not None,
+            "interval": interval,
+            "requested": self.requested,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "written": self.written,
+            "errors": self.errors,
+            "writes_per_second": self.written / uptime if uptime > 0 else 0.0,
+            "max_writes_per_second": 1 / interval if interval > 0 else None,
+        }
+
+
+class RemoteCursor:
+    __slots__ = ("channel", "pattern_name")
+
+    def __init__(self, channel: str, pattern_name: str):
+        self.channel = channel
+        self.pattern_name = pattern_name
+
+
+class RemoteJitter:
+    def __init__(self):
+        self.overruns = 0
+
+    def stats(self) -> dict:
+        return {"overruns": self.overruns}
+
+
+class RemotePlayer:
+    """State of the MultiplexPlayer of the worker: the patterns are the last ones requested by the app."""
+
+    def __init__(self):
+        self.patterns = {}
+        self.cursors = {}
+        self.jitter = {"a": RemoteJitter(), "b": RemoteJitter()}
+        self.writes = 0
+
+    @property
+    def is_playing(self) -> bool:
+        return bool(self.cursors)
+
+    def set_playing(self, playing_a: bool, playing_b: bool):
+        for channel, playing in (("a", playing_a), ("b", playing_b)):
+            name = self.patterns.get(channel)
+            if playing and name is not None:
+                cursor = self.cursors.get(channel)
+                if cursor is None or cursor.pattern_name != name:
+                    self.cursors[channel] = RemoteCursor(channel, name)
+            else:
+                self.cursors.pop(channel, None)
+
+    def stats(self) -> dict:
+        return {
+            "playing": {
+                channel: cursor.pattern_name for channel, cursor in self.cursors.items()
+            },
+            "writes": self.writes,
+            "jitter": {
+                channel: jitter.stats() for channel, jitter in self.jitter.items()
+            },
+        }
+
+
+class CoyoteWorkerClient(Estim):
+    """
+    Stand-in for CoyoteInterface, which runs the device in a supervised worker process.
+
+    Attributes:
+        device_uid (str): The bluetooth address of the device.
+        process (multiprocessing.Process): The worker process, while connected.
+        restarts (int): Number of times the worker was restarted.
+        error (str): Last error reported by the worker.
+    The other attributes mirror the ones of CoyoteInterface, as last reported by the worker.
+    """
+
+    def __init__(self, device_uid: str = ""):
+        super().__init__("coyote")
+        self.device_uid = device_uid
+        # The worker owns the bluetooth client
+        self.device = None
+        self.process = None
+        self.commands = None
+        self.telemetry = None
+        # Socket pair waking the worker up: the app writes to the first one, the worker reads the second one.
+        self.wakeup = None
+
+        self.is_connected = False
+        self.battery = -1
+        self.battery_updated_at = None
+        self.pow_a = 1
+        self.pow_b = 1
+        self.can_update_power = True
+        self.stop_signal = False
+        self.reconnects = 0
+        self.verified_writes = 0
+        self.verify_mismatches = 0
+        self.power_scheduler = RemoteScheduler()
+        self.player = RemotePlayer()
+
+        self.restarts = 0
+        self.error = None
+        self._connected_once = False
+        self._stopping = False
+        self._status_at = None
+        self._started_at = None
+        self._supervisor = None
+        # Playback of each channel, resumed by a restarted worker:
+        # {channel: (session, power, pattern, duration, offset)}
+        self._last_play = {}
+        # Playbacks posted to the worker and not ended yet, by session
+        self._session = 0
+        self._sessions = {}
+        # Histograms and counters of the metric samples forwarded by the worker, by payload
+        self._forwarded = {}
+        self._ipc_latency = metrics.stage(metrics.STAGE_IPC_TELEMETRY, "ab")
+
+    def _start_process(self):
+        self.commands.reset()
+        self.telemetry.reset()
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(
+            target=run_worker,
+            args=(
+                self.commands.name,
+                self.telemetry.name,
+                self.wakeup[1],
+                self.device_uid,
+                dg_mock.enabled or settings.coyote_mock,
+            ),
+            name=f"coyote-worker-{self.device_uid}",
+            daemon=True,
+        )
+        self.process.start()
+        # The heartbeat timeout runs from the start of the process.
+        self._status_at = time.perf_counter()
+        self._started_at = time.monotonic()
+
+    def _post(
+        self,
+        kind: int,
+        channel: int = 0,
+        a: int = 0,
+        b: int = 0,
+        t2: float = 0.0,
+        payload: bytes = b"",
+    ) -> bool:
+        if self.commands is None:
+            return False
+        if not self.commands.put(kind, channel, a, b, time.perf_counter(), t2, payload):
+            return False
+        try:
+            self.wakeup[0].send(b"\0")
+        except OSError:
+            # The socket buffer is full of wakeups the worker did not read yet, it will find the command anyway.
+            pass
+        return True
+
+    async def search_for_device(self):
+        """The worker searches for the device itself if its address is unknown."""
+
+    async def connect(self, retries: int = 3):
+        """
+        Start the worker and wait until it is connected to the device.
+
+        :param retries: Unused, the worker retries on its own.
+        :raise ConnectionError: The worker could not connect.
+        """
+        if self.process is not None and self.process.is_alive():
+            return
+        if self.commands is None:
+            self.commands = SpscRing.create(COMMAND_CAPACITY)
+            self.telemetry = SpscRing.create(TELEMETRY_CAPACITY)
+            self.wakeup = socket.socketpair()
+            self.wakeup[0].setblocking(False)
+        self._stopping = False
+        self._connected_once = False
+        self.error = None
+        self._start_process()
+        self._supervisor = asyncio.ensure_future(self._supervise())
+        while not self.is_connected:
+            if self.error is not None or not self.process.is_alive():
+                error = self.error or f"Worker exited with code {self.process.exitcode}"
+                await self.disconnect()
+                raise ConnectionError(error)
+            await asyncio.sleep(CLIENT_POLL_INTERVAL)
+        self.power_scheduler.started_at = time.monotonic()
+
+    async def disconnect(self):
+        """Disconnect the device and stop the worker."""
+        if self.process is None:
+            return
+        self._stopping = True
+        self._last_play = {}
+        self._post(CMD_DISCONNECT)
+        deadline = time.monotonic() + DISCONNECT_TIMEOUT
+        while self.process.is_alive() and time.monotonic() < deadline:
+            await asyncio.sleep(CLIENT_POLL_INTERVAL)
+        if self.process.is_alive():
+            logging.error("Coyote worker did not stop, killing it")
+            self.process.kill()
+        self._supervisor.cancel()
+        self._drain()
+        self.process = None
+        self.commands.close()
+        self.telemetry.close()
+        for wakeup in self.wakeup:
+            wakeup.close()
+        self.commands = None
+        self.telemetry = None
+        self.wakeup = None
+        self.is_connected = False
+        self.power_scheduler.started_at = None
+        self.player.set_playing(False, False)
+        self._end_sessions()
+
+    async def _supervise(self):
+        delay = RESTART_DELAY
+        while True:
+            self._drain()
+            if not self._stopping and self._connected_once:
+                alive = self.process.is_alive()
+                if (
+                    not alive
+                    or time.perf_counter() - self._status_at > HEARTBEAT_TIMEOUT
+                ):
+                    if alive:
+                        logging.error("Coyote worker stopped responding, killing it")
+                        self.process.kill()
+                        while self.process.is_alive():
+                            await asyncio.sleep(CLIENT_POLL_INTERVAL)
+                    if time.monotonic() - self._started_at > STABLE_AFTER:
+                        delay = RESTART_DELAY
+                    logging.error(
+                        f"Coyote worker exited with code {self.process.exitcode}, restarting in {delay:.1f} s"
+                    )
+                    self.is_connected = False
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RESTART_MAX_DELAY)
+                    if self._stopping:
+                        continue
+                    self.restarts += 1
+                    self._start_process()
+                    # The playbacks of the previous worker are lost, except the ones of the channels, which are
+                    # resumed channel by channel.
+                    self._end_sessions(
+                        keep={entry[0] for entry in self._last_play.values()}
+                    )
+                    for channel, entry in self._last_play.items():
+                        self._post_signal(channel, *entry)
+            await asyncio.sleep(CLIENT_POLL_INTERVAL)
+
+    def _drain(self):
+        """Apply the telemetry posted by the worker."""
+        telemetry = self.telemetry
+        record = telemetry.get()
+        while record is not None:
+            kind, channel, a, b, t1, t2, payload = record
+            if kind == TEL_STATUS:
+                now = time.perf_counter()
+                self._ipc_latency.record(now - t1)
+                self._status_at = now
+                self._apply_status(
+                    dict(zip(STATUS_FIELDS, STATUS.unpack_from(payload)))
+                )
+            elif kind == TEL_SAMPLE:
+                histogram = self._forwarded.get(payload)
+                if histogram is None:
+                    stage, channel_name = _decode(payload).split("/")
+                    histogram = self._forwarded[payload] = metrics.stage(
+                        stage, channel_name
+                    )
+                histogram.record(t2)
+            elif kind == TEL_COUNT:
+                counter = self._forwarded.get(payload)
+                if counter is None:
+                    name, label = _decode(payload).split("/")
+                    family = metrics.registry.families[name]
+                    counter = self._forwarded[payload] = family.labels(
+                        *((label,) if label else ())
+                    )
+                counter.inc(a)
+            elif kind == TEL_ERROR:
+                self.error = _decode(payload)
+                logging.error(f"Coyote worker: {self.error}")
+            elif kind == TEL_CONNECTED:
+                # Known once the worker found the device, and reused when the worker is restarted.
+                self.device_uid = _decode(payload)
+            elif kind == TEL_PLAY_ENDED:
+                self._play_ended(a, channel)
+            record = telemetry.get()
+
+    def _apply_status(self, status: dict):
+        self.is_connected = bool(status["connected"])
+        if self.is_connected:
+            self._connected_once = True
+        self.battery = status["battery"]
+        age = status["battery_age_ms"]
+        self.battery_updated_at = None if age < 0 else time.monotonic() - age / 1000
+        self.pow_a = status["pow_a"]
+        self.pow_b = status["pow_b"]
+        self.reconnects = status["reconnects"]
+        self.verified_writes = status["verified_writes"]
+        self.verify_mismatches = status["verify_mismatches"]
+        scheduler = self.power_scheduler
+        scheduler.requested = status["requested"]
+        scheduler.coalesced = status["coalesced"]
+        scheduler.dropped = status["dropped"]
+        scheduler.written = status["written"]
+        scheduler.errors = status["errors"]
+        player = self.player
+        player.set_playing(status["playing_a"], status["playing_b"])
+        player.jitter["a"].overruns = status["overruns_a"]
+        player.jitter["b"].overruns = status["overruns_b"]
+        player.writes = status["pattern_writes"]
+
+    def request_pwm(self, pow_a: int, pow_b: int, received_at: float = None):
+        """
+        Post power levels to the worker, which coalesces them like CoyoteInterface.request_pwm().
+        """
+        self._post(
+            CMD_POWER, a=pow_a, b=pow_b, t2=-1.0 if received_at is None else received_at
+        )
+
+    async def set_pwm(self, pow_a: int, pow_b: int) -> bool:
+        """
+        Post power levels to the worker, written at once.
+
+        :return: True if the command was posted.
+        """
+        return self._post(CMD_POWER_NOW, a=pow_a, b=pow_b)
+
+    def _end_sessions(self, keep=()):
+        """Resolve the playbacks which will not be reported as ended by the worker, all but the sessions in `keep`."""
+        for session in [session for session in self._sessions if session not in keep]:
+            self._end_session(session)
+
+    def _end_session(self, session: int):
+        ended = self._sessions.pop(session, None)
+        if ended is not None and not ended.done():
+            ended.set_result(None)
+
+    def _play_ended(self, session: int, channel: int):
+        """
+        The worker reported the end of a playback. A play resumed channel by channel ends with its last channel.
+        """
+        channels = CHANNELS if channel == CHANNEL_BOTH else (CHANNELS[channel],)
+        for name in channels:
+            entry = self._last_play.get(name)
+            if entry is not None and entry[0] == session:
+                del self._last_play[name]
+        if all(entry[0] != session for entry in self._last_play.values()):
+            self._end_session(session)
+
+    def _start_session(self, offset: int, *pattern_names) -> int:
+        """
+        :return: The session of a new playback.
+        :raise ValueError: The pattern names are too long to be posted to the worker.
+        """
+        session = self._session + 1
+        try:
+            _encode("\n".join((str(session), str(offset), *pattern_names)))
+        except ValueError:
+            raise ValueError(
+                f"The pattern names {list(pattern_names)} are too long to be posted to the worker"
+            ) from None
+        self._session = session
+        self.stop_signal = False
+        return session
+
+    async def _wait_session(self, session: int):
+        ended = self._sessions[session] = asyncio.get_running_loop().create_future()
+        try:
+            await ended
+        finally:
+            self._sessions.pop(session, None)
+
+    def _post_signal(
+        self,
+        channel: str,
+        session: int,
+        power: int,
+        pattern_name: str,
+        duration: int,
+        offset: int,
+    ):
+        self._post(
+            CMD_SIGNAL,
+            channel=CHANNELS.index(channel),
+            a=power,
+            t2=duration,
+            payload=_encode(f"{session}\n{offset}\n{pattern_name}"),
+        )
+
+    async def play(
+        self, pow_a: int, pow_b: int, patterns: dict, duration: int, offset: int = 0
+    ):
+        """
+        Play patterns in the worker, see CoyoteInterface.play(). Only patterns given by name are supported.
+
+        :raise ValueError: The pattern names are too long to be posted to the worker.
+        """
+        if not all(isinstance(pattern, str) for pattern in patterns.values()):
+            raise TypeError("The worker only plays patterns given by name")
+        pattern_a = patterns.get("a", "")
+        pattern_b = patterns.get("b", "")
+        session = self._start_session(offset, pattern_a, pattern_b)
+        if pattern_a:
+            self.pattern_name_a = pattern_a
+        if pattern_b:
+            self.pattern_name_b = pattern_b
+        self.player.patterns.update(patterns)
+        # The playback of all the channels is replaced, the previous ones end now, whenever the worker reports it.
+        self._end_sessions()
+        self._last_play = {
+            channel: (
+                session,
+                pow_a if channel == "a" else pow_b,
+                name,
+                duration,
+                offset,
+            )
+            for channel, name in patterns.items()
+        }
+        self._post(
+            CMD_PLAY,
+            a=pow_a,
+            b=pow_b,
+            t2=duration,
+            payload=_encode(f"{session}\n{offset}\n{pattern_a}\n{pattern_b}"),
+        )
+        await self._wait_session(session)
+
+    async def signal(
+        self,
+        power: int,
+        pattern_name,
+        duration: int,
+        channel: str = "a",
+        offset: int = 0,
+    ):
+        """
+        Play a pattern on one channel in the worker, see CoyoteInterface.signal(). The other channel keeps its power
+        and its playback.
+
+        :raise ValueError: The pattern name is too long to be posted to the worker.
+        """
+        if not isinstance(pattern_name, str):
+            raise TypeError("The worker only plays patterns given by name")
+        session = self._start_session(offset, pattern_name)
+        if channel == "a":
+            self.pattern_name_a = pattern_name
+        else:
+            self.pattern_name_b = pattern_name
+        self.player.patterns[channel] = pattern_name
+        replaced = self._last_play.get(channel)
+        self._last_play[channel] = (session, power, pattern_name, duration, offset)
+        # A playback which no longer plays on any channel ends now, whenever the worker reports it.
+        if replaced is not None and all(
+            entry[0] != replaced[0] for entry in self._last_play.values()
+        ):
+            self._end_session(replaced[0])
+        self._post_signal(channel, *self._last_play[channel])
+        await self._wait_session(session)
+
+    def switch_pattern(self, channel: str, pattern_name: str):
+        payload = _encode(pattern_name)
+        if channel == "a":
+            self.pattern_name_a = pattern_name
+        else:
+            self.pattern_name_b = pattern_name
+        self.player.patterns[channel] = pattern_name
+        entry = self._last_play.get(channel)
+        if entry is not None:
+            self._last_play[channel] = (*entry[:2], pattern_name, *entry[3:])
+        self._post(CMD_SWITCH_PATTERN, channel=CHANNELS.index(channel), payload=payload)
+
+    async def stop(self):
+        """Set power to zero, see CoyoteInterface.stop()."""
+        if not self.is_connected:
+            return
+        self.stop_signal = True
+        self._last_play = {}
+        self._post(CMD_STOP)
+
+    async def get_bettery_level(self) -> int:
+        return self.battery
+
+    def battery_age(self) -> float:
+        if self.battery_updated_at is None:
+            return None
+        return time.monotonic() - self.battery_updated_at
+
+    def verify_stats(self) -> dict:
+        return {
+            "mode": settings.coyote_verify_mode,
+            "write_without_response": settings.coyote_write_without_response,
+            "writes": self.power_scheduler.written,
+            "verified": self.verified_writes,
+            "mismatches": self.verify_mismatches,
+        }
@@ -1,5 +1,7 @@
 from typing import Dict, Any
 from toys.base import Toy, FEATURE_ESTIM
+from toys.estim.pattern import Pattern
+from toys.estim.pattern_pack import load_pack
 import json
 import io
 import random
@@ -10,15 +12,9 @@ class Estim(Toy):
     patterns: Dict[str, Any]
 
     def load_patterns(self):
-        with open("data/estim/pattern_dict.json") as pf:
-            patterns = json.loads(pf.read())
-            for k, v in patterns.items():
-                pattern_list = []
-                for pattern in v:
-                    with open("data/estim/patterns/{}".format(pattern)) as psf:
-                        pattern_list.extend(json.loads(psf.read()))
-                patterns[k] = pattern_list
-        patterns["default"] = [
+        # The JSON patterns in data/estim are compiled into a binary pack, which is shared by all instances.
+        patterns = load_pack()
+        default_patterns = [
             [
                 [10, 90, 10]
             ],  # Default pattern - simple, one-state pattern of 10 ms pulse, 90 ms pause, amplitude 10
@@ -45,6 +41,7 @@ class Estim(Toy):
                 [1, 9, 20],
             ],  # varied pattern of 20 states
         ]
+        patterns["default"] = [Pattern.from_states(p) for p in default_patterns]
         return patterns
 
     def __init__(self, name):
@@ -0,0 +1,128 @@
+"""
+Compact representation of an e-stim pattern.
+
+A pattern is a sequence of states (ax, ay, az):
+
+    ax pulse length: 0-31 ms
+    ay pause length: 0-1023 ms
+    az amplitude: 0-31
+
+The duration of a state is ax + ay milliseconds.
+"""
+
+from array import array
+from bisect import bisect_right
+
+
+class Pattern:
+    """
+    Array backed e-stim pattern with a cumulative time index.
+
+    The three state components are stored as separate columns of unsigned shorts. The end time (ms) of every state
+    is precomputed, so that seeking to an offset is a binary search and truncating is a zero-copy slice.
+
+    Attributes:
+        ax (memoryview): Pulse lengths (ms).
+        ay (memoryview): Pause lengths (ms).
+        az (memoryview): Amplitudes.
+        duration (int): Total duration of the pattern (ms).
+    """
+
+    __slots__ = ("ax", "ay", "az", "_ends", "duration")
+
+    def __init__(self, ax, ay, az, ends=None):
+        """
+        :param ax: Pulse lengths, any sequence of unsigned shorts supporting the buffer protocol.
+        :param ay: Pause lengths.
+        :param az: Amplitudes.
+        :param ends: Cumulative end times of the states, computed if omitted.
+        """
+        self.ax = memoryview(ax)
+        self.ay = memoryview(ay)
+        self.az = memoryview(az)
+        if ends is None:
+            ends = array("L")
+            t = 0
+            for x, y in zip(self.ax, self.ay):
+                t += x + y
+                ends.append(t)
+        self._ends = memoryview(ends)
+        self.duration = self._ends[-1] if len(self._ends) else 0
+
+    @classmethod
+    def from_states(cls, states) -> "Pattern":
+        """
+        Build a pattern from a list of states [[ax, ay, az], [ax, ay, az], ...].
+        """
+        return cls(
+            array("H", (s[0] for s in states)),
+            array("H", (s[1] for s in states)),
+            array("H", (s[2] for s in states)),
+        )
+
+    @classmethod
+    def from_records(cls, records: memoryview) -> "Pattern":
+        """
+        Build a pattern on top of interleaved records ax, ay, az, ax, ay, az, ... without copying them.
+
+        :param records: Flat memoryview of unsigned shorts, e.g. a slice of a pattern pack.
+        """
+        return cls(records[0::3], records[1::3], records[2::3])
+
+    def __len__(self) -> int:
+        return len(self.ax)
+
+    def __getitem__(self, index: int):
+        return (self.ax[index], self.ay[index], self.az[index])
+
+    def __iter__(self):
+        return zip(self.ax, self.ay, self.az)
+
+    def __repr__(self) -> str:
+        return f"Pattern({[list(state) for state in self]})"
+
+    def state_start(self, index: int) -> int:
+        """Start time (ms) of the state at `index`."""
+        return self._ends[index - 1] if index > 0 else 0
+
+    def seek(self, offset: int):
+        """
+        Find the state playing at a given time, in O(log n).
+
+        The pattern is looped, i.e. offsets beyond the duration wrap around.
+
+        :param offset: Time since the start of the pattern (ms).
+        :return: (index of the state, time (ms) since the start of that state)
+        """
+        if not self.duration:
+            return 0, 0
+        offset %= self.duration
+        index = bisect_right(self._ends, offset)
+        return index, offset - self.state_start(index)
+
+    def truncate(self, duration: int) -> "Pattern":
+        """
+        Shorten the pattern to the states which end within `duration`, without copying.
+
+        :param duration: Maximal duration (ms).
+        """
+        n = bisect_right(self._ends, duration)
+        return Pattern(self.ax[:n], self.ay[:n], self.az[:n], self._ends[:n])
+
+    def window(self, offset: int, duration: int):
+        """
+        Iterate over the states of a looping window of the pattern.
+
+        :param offset: Start of the window (ms), the first state is the one playing at that time.
+        :param duration: Length of the window (ms).
+        :return: Iterator of state indices.
+        """
+        if not self.duration:
+            return
+        index, elapsed = self.seek(offset)
+        elapsed = -elapsed
+        n = len(self)
+        while elapsed < duration:
+            yield index
+            elapsed += self.ax[index] + self.ay[index]
+            index = index + 1 if index + 1 < n else 0
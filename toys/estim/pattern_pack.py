@@ -0,0 +1,169 @@
+"""
+Binary pattern pack.
+
+The JSON files in `data/estim` stay the authoritative source of the e-stim patterns. They are compiled into a single
+binary pack, which is memory-mapped once per process and shared by every Estim instance, instead of being parsed into
+nested lists of ints for every instance.
+
+Layout (little-endian):
+
+    header      "<4sHHII"   magic b"OSCP", version, reserved, pattern count, offset of the state records
+    name index  per pattern "<IIH" offset (in states) of the first state record, state count, name length;
+                followed by the utf-8 encoded name
+    records     per state   "<HHH" ax, ay, az
+
+The pack is rebuilt whenever it is older than `pattern_dict.json` or one of the pattern files it references.
+
+Run `python -m toys.estim.pattern_pack` to (re)build the pack.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from toys.estim.pattern import Pattern
+
+PATTERN_DIR = "data/estim"
+PACK_PATH = PATTERN_DIR + "/patterns.pack"
+
+MAGIC = b"OSCP"
+VERSION = 1
+HEADER = struct.Struct("<4sHHII")
+INDEX_ENTRY = struct.Struct("<IIH")
+RECORD = struct.Struct("<HHH")
+
+
+def _source_files(pattern_dir: str) -> list:
+    with open(os.path.join(pattern_dir, "pattern_dict.json")) as pf:
+        pattern_dict = json.loads(pf.read())
+    files = [os.path.join(pattern_dir, "pattern_dict.json")]
+    for names in pattern_dict.values():
+        files.extend(os.path.join(pattern_dir, "patterns", name) for name in names)
+    return files
+
+
+def load_json_patterns(pattern_dir: str = PATTERN_DIR) -> dict:
+    """
+    Read the patterns from the JSON sources.
+
+    :return: Patterns by name, [[ax, ay, az], [ax, ay, az], ...]
+    """
+    with open(os.path.join(pattern_dir, "pattern_dict.json")) as pf:
+        patterns = json.loads(pf.read())
+    for k, v in patterns.items():
+        pattern_list = []
+        for pattern in v:
+            with open(os.path.join(pattern_dir, "patterns", pattern)) as psf:
+                pattern_list.extend(json.loads(psf.read()))
+        patterns[k] = pattern_list
+    return patterns
+
+
+def encode_pack(patterns: dict) -> bytes:
+    """
+    Serialize patterns into the pack format.
+
+    :param patterns: Patterns by name, [[ax, ay, az], [ax, ay, az], ...]
+    """
+    index = bytearray()
+    records = bytearray()
+    offset = 0
+    for name, pattern in patterns.items():
+        encoded_name = name.encode("utf-8")
+        index += INDEX_ENTRY.pack(offset, len(pattern), len(encoded_name))
+        index += encoded_name
+        for ax, ay, az in pattern:
+            records += RECORD.pack(ax, ay, az)
+        offset += len(pattern)
+    records_offset = HEADER.size + len(index)
+    # Align the records so that they can be cast to unsigned shorts.
+    padding = records_offset % 2
+    header = HEADER.pack(MAGIC, VERSION, 0, len(patterns), records_offset + padding)
+    return header + bytes(index) + bytes(padding) + bytes(records)
+
+
+def decode_pack(buffer) -> dict:
+    """
+    Read the patterns of a pack without copying the state records.
+
+    :param buffer: The pack, any object supporting the buffer protocol (e.g. an mmap).
+    :return: Patterns by name as Pattern views into `buffer`.
+    """
+    view = memoryview(buffer)
+    magic, version, _, count, records_offset = HEADER.unpack_from(view, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a pattern pack of version {}".format(VERSION))
+    records = view[records_offset:]
+    if sys.byteorder == "little":
+        records = records.cast("H")
+    else:
+        swapped = array("H", bytes(records))
+        swapped.byteswap()
+        records = memoryview(swapped)
+    patterns = {}
+    pos = HEADER.size
+    for _ in range(count):
+        offset, length, name_length = INDEX_ENTRY.unpack_from(view, pos)
+        pos += INDEX_ENTRY.size
+        name = bytes(view[pos : pos + name_length]).decode("utf-8")
+        pos += name_length
+        patterns[name] = Pattern.from_records(
+            records[3 * offset : 3 * (offset + length)]
+        )
+    return patterns
+
+
+def is_stale(pack_path: str = PACK_PATH, pattern_dir: str = PATTERN_DIR) -> bool:
+    """Whether the pack is missing or older than one of its JSON sources."""
+    try:
+        pack_mtime = os.path.getmtime(pack_path)
+    except OSError:
+        return True
+    return any(os.path.getmtime(f) > pack_mtime for f in _source_files(pattern_dir))
+
+
+def build_pack(pack_path: str = PACK_PATH, pattern_dir: str = PATTERN_DIR):
+    """Compile the JSON sources into the pack, replacing it atomically."""
+    data = encode_pack(load_json_patterns(pattern_dir))
+    tmp_path = pack_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, pack_path)
+
+
+_shared = {}
+
+
+def load_pack(pack_path: str = PACK_PATH, pattern_dir: str = PATTERN_DIR) -> dict:
+    """
+    Return the patterns of the pack, rebuilding it first if it is stale.
+
+    The pack is memory-mapped once per process; every call returns a new dict of views into the same mapping.
+    If the pack cannot be written (e.g. read-only installation), the patterns are packed in memory instead.
+
+    :return: Patterns by name as Pattern views.
+    """
+    key = os.path.abspath(pack_path)
+    if key not in _shared:
+        try:
+            if is_stale(pack_path, pattern_dir):
+                logging.info(f"Building pattern pack {pack_path}")
+                build_pack(pack_path, pattern_dir)
+            with open(pack_path, "rb") as f:
+                _shared[key] = decode_pack(
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                )
+        except OSError as e:
+            logging.error(f"Failed to use pattern pack {pack_path}: {e}")
+            _shared[key] = decode_pack(encode_pack(load_json_patterns(pattern_dir)))
+    return dict(_shared[key])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    build_pack()
+    print(f"Packed {len(load_pack())} patterns into {PACK_PATH}")